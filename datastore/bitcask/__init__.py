@@ -0,0 +1,704 @@
+
+__version__ = '1.0'
+__doc__ = '''
+log-structured (bitcask-style) datastore implementation.
+
+Objects are appended to segment files, and an in-memory hash index maps each
+key to the location of its latest value. See BitcaskDatastore.
+
+'''
+
+import os
+import json
+import mmap
+import zlib
+import struct
+import threading
+
+import datastore.core
+
+
+record_header = struct.Struct('>IQIi')
+'''Segment record header: crc32, sequence number, key size, value size.
+The crc32 covers everything in the record after itself.'''
+
+hint_header = struct.Struct('>QIiQ')
+'''Hint record header: sequence number, key size, value size, value offset.'''
+
+tombstone = -1
+'''Value size marking a deleted key.'''
+
+
+
+def collection_for(key):
+  '''Returns the collection (``str(key.path)``) of the stringified `key`.
+
+  Equivalent to ``str(Key(key).path)``, without constructing any Keys. Used
+  to rebuild the index of tens of millions of keys quickly.
+  '''
+  parent, _, name = key.rpartition('/')
+  field = name.split(':')[0] if ':' in name else ''
+  if field:
+    return parent + '/' + field
+  return parent or '/'
+
+
+def scan_records(data, size=None):
+  '''Generator over the valid records in segment `data` (a string or mmap).
+
+  Yields tuples ``(seq, key, value_offset, value_size, end_offset)``.
+  Iteration stops at the first truncated or corrupt record (bad checksum).
+  '''
+  size = len(data) if size is None else size
+  offset = 0
+
+  while offset + record_header.size <= size:
+    crc, seq, key_size, value_size = record_header.unpack_from(data, offset)
+    value_offset = offset + record_header.size + key_size
+    end = value_offset + max(value_size, 0)
+
+    if end > size:
+      break # truncated record (e.g. crash mid-write)
+
+    if zlib.crc32(buffer(data, offset + 4, end - offset - 4)) & 0xffffffff \
+        != crc:
+      break # corrupt record
+
+    key = data[offset + record_header.size:value_offset]
+    yield seq, key, value_offset, value_size, end
+    offset = end
+
+
+def write_hints(path, hints):
+  '''Writes hint file `path` listing `hints` records, atomically.'''
+  with open(path + '.tmp', 'wb') as f:
+    for seq, key, value_size, value_offset in hints:
+      f.write(hint_header.pack(seq, len(key), value_size, value_offset))
+      f.write(key)
+    f.flush()
+    os.fsync(f.fileno())
+  os.rename(path + '.tmp', path)
+
+
+def _fsync_directory(path):
+  '''fsyncs directory `path`, persisting renames and unlinks within it.'''
+  fd = os.open(path, os.O_RDONLY)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+
+
+class _SegmentWriter(object):
+  '''Appends records to a segment file, remembering hints for them.'''
+
+  def __init__(self, segment, path, size=0, hints=None):
+    self.segment = segment
+    self.path = path
+    self.file = open(path, 'ab', 0) # unbuffered: one write per record.
+    self.size = size
+    self.hints = hints if hints is not None else []
+
+  def append(self, seq, key, value):
+    '''Appends a record, returning the offset of its value.'''
+    value_size = tombstone if value is None else len(value)
+    body = struct.pack('>QIi', seq, len(key), value_size) + key + (value or '')
+    self.file.write(struct.pack('>I', zlib.crc32(body) & 0xffffffff) + body)
+
+    value_offset = self.size + record_header.size + len(key)
+    self.size += 4 + len(body)
+    self.hints.append((seq, key, value_size, value_offset))
+    return value_offset
+
+  def sync(self):
+    '''fsyncs the segment file.'''
+    os.fsync(self.file.fileno())
+
+  def close(self):
+    self.file.close()
+
+
+
+class BitcaskDatastore(datastore.Datastore):
+  '''Log-structured datastore, in the style of bitcask.
+
+  BitcaskDatastore appends every put and delete as a record to the active
+  segment file under `root`. Once the active segment grows past
+  `max_segment_size`, it becomes immutable and a new one is started.
+  An in-memory index maps every key to the segment and offset of its value,
+  so a get is a dict lookup plus a slice of the memory-mapped segment: no
+  open/close per read, and no inode per object.
+
+  Values must be strings (wrap with a SerializerShimDatastore otherwise)::
+
+      /data/000000000001.data   # immutable segment, memory-mapped
+      /data/000000000001.hint   # its hint file: keys and offsets only
+      /data/000000000002.data   # active segment
+
+  Implementation Notes:
+
+    Every record carries a crc32 checksum and a sequence number. On startup,
+    segments with a hint file are indexed from it without reading values.
+    Others (the active segment after a crash) are scanned; a torn record at
+    the tail is detected by its checksum, and the segment truncated there.
+    The latest sequence number for a key wins, regardless of segment order.
+
+    Compaction rewrites the live records of all immutable segments into new
+    segments, and deletes the old ones, reclaiming the space of overwritten
+    and deleted values. It runs in a background thread once the ratio of dead
+    bytes in immutable segments exceeds `compaction_ratio`, or explicitly via
+    ``compact``. A commit marker file makes swapping in the new segments safe
+    against crashes.
+
+  Hello World:
+
+      >>> import datastore.bitcask
+      >>>
+      >>> ds = datastore.bitcask.BitcaskDatastore('/tmp/.test_bitcask')
+      >>>
+      >>> hello = datastore.Key('hello')
+      >>> ds.put(hello, 'world')
+      >>> ds.contains(hello)
+      True
+      >>> ds.get(hello)
+      'world'
+      >>> ds.delete(hello)
+      >>> ds.get(hello)
+      None
+
+  '''
+
+  data_extension = '.data'
+  hint_extension = '.hint'
+  merge_extension = '.merge'
+  merge_marker = 'merge.commit'
+
+  def __init__(self, root, max_segment_size=64 * 1024 * 1024, sync=False,
+               compaction_ratio=0.5):
+    '''Initialize the datastore with given root directory `root`.
+
+    Args:
+      root: A path at which to store the segment files.
+
+      max_segment_size: size in bytes after which the active segment is
+          made immutable and a new one started.
+
+      sync: whether to fsync the active segment after every write.
+
+      compaction_ratio: ratio of dead to total bytes in immutable segments
+          that triggers a background compaction. None disables it.
+    '''
+    root = os.path.normpath(root)
+    if not os.path.isdir(root):
+      os.makedirs(root)
+
+    self.root_path = root
+    self.max_segment_size = int(max_segment_size)
+    self.sync = bool(sync)
+    self.compaction_ratio = compaction_ratio
+
+    self._lock = threading.RLock()
+    self._compaction_lock = threading.Lock()
+    self._compaction_thread = None
+
+    self._index = {}  # collection -> {key: (segment, value offset, size)}
+    self._maps = {}   # immutable segment -> mmap
+    self._sizes = {}  # segment -> bytes
+    self._dead = {}   # segment -> bytes of dead records
+    self._count = 0
+    self._seq = 0
+    self._next_segment = 1
+    self._active = None
+    self._active_reader = None
+
+    self._recover_merge()
+    self._load()
+
+
+  # segment pathing
+
+  def segment_path(self, segment, extension=None):
+    '''Returns the path of `segment`'s file with `extension` (data file).'''
+    extension = extension or self.data_extension
+    return os.path.join(self.root_path, '%012d%s' % (segment, extension))
+
+  def _segments(self):
+    '''Returns the sorted ids of segments on disk.'''
+    extension = self.data_extension
+    return sorted(int(name[:-len(extension)])
+        for name in os.listdir(self.root_path) if name.endswith(extension))
+
+
+  # startup
+
+  def _recover_merge(self):
+    '''Completes a committed compaction, or discards an uncommitted one.'''
+    marker = os.path.join(self.root_path, self.merge_marker)
+
+    if os.path.exists(marker):
+      with open(marker) as f:
+        merge = json.load(f)
+
+      for segment in merge['outputs']:
+        for extension in [self.data_extension, self.hint_extension]:
+          path = self.segment_path(segment, extension)
+          if os.path.exists(path + self.merge_extension):
+            os.rename(path + self.merge_extension, path)
+
+      for segment in merge['inputs']:
+        for extension in [self.data_extension, self.hint_extension]:
+          path = self.segment_path(segment, extension)
+          if os.path.exists(path):
+            os.remove(path)
+
+      os.remove(marker)
+
+    for name in os.listdir(self.root_path):
+      if name.endswith(self.merge_extension) or name.endswith('.tmp'):
+        os.remove(os.path.join(self.root_path, name))
+
+  def _read_hints(self, segment):
+    '''Returns the records listed in the hint file of `segment`.'''
+    with open(self.segment_path(segment, self.hint_extension), 'rb') as f:
+      data = f.read()
+
+    records = []
+    offset = 0
+    while offset < len(data):
+      seq, key_size, value_size, value_offset = \
+        hint_header.unpack_from(data, offset)
+      offset += hint_header.size
+      records.append((seq, data[offset:offset + key_size], value_size,
+          value_offset))
+      offset += key_size
+    return records
+
+  def _scan_segment(self, segment):
+    '''Returns the records in (and the valid size of) `segment`.'''
+    path = self.segment_path(segment)
+    size = os.path.getsize(path)
+    if size == 0:
+      return [], 0
+
+    with open(path, 'rb') as f:
+      data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    records = []
+    end = 0
+    for seq, key, value_offset, value_size, end in scan_records(data, size):
+      records.append((seq, key, value_size, value_offset))
+    data.close()
+    return records, end
+
+  def _load(self):
+    '''Rebuilds the index from the segments on disk.'''
+    segments = self._segments()
+    latest = {} # key -> (seq, segment, value offset, value size)
+    active_hints = None
+
+    for segment in segments:
+      path = self.segment_path(segment)
+      self._sizes[segment] = os.path.getsize(path)
+      self._dead[segment] = 0
+
+      if os.path.exists(self.segment_path(segment, self.hint_extension)):
+        records = self._read_hints(segment)
+
+      else:
+        records, end = self._scan_segment(segment)
+        if end < self._sizes[segment]:
+          # torn or corrupt tail. drop it so that appends stay readable.
+          with open(path, 'r+b') as f:
+            f.truncate(end)
+          self._sizes[segment] = end
+
+        if segment == segments[-1]:
+          active_hints = records # keep appending to this segment.
+
+      for seq, key, value_size, value_offset in records:
+        record_size = record_header.size + len(key) + max(value_size, 0)
+        current = latest.get(key)
+        if current is not None and current[0] > seq:
+          self._dead[segment] += record_size
+          continue
+
+        if current is not None:
+          self._dead[current[1]] += \
+            record_header.size + len(key) + max(current[3], 0)
+        if value_size == tombstone:
+          self._dead[segment] += record_size # tombstones are dead weight.
+        latest[key] = (seq, segment, value_offset, value_size)
+        self._seq = max(self._seq, seq)
+
+    for key, (seq, segment, value_offset, value_size) in latest.iteritems():
+      if value_size != tombstone:
+        collection = self._index.setdefault(collection_for(key), {})
+        collection[key] = (segment, value_offset, value_size)
+        self._count += 1
+    del latest
+
+    self._next_segment = (segments[-1] + 1) if segments else 1
+
+    for segment in segments:
+      if active_hints is None or segment != segments[-1]:
+        self._map(segment)
+
+    if active_hints is not None:
+      self._open_active(segments[-1], active_hints)
+    else:
+      self._open_active(self._allocate_segment(), [])
+
+  def _allocate_segment(self):
+    '''Returns a new segment id.'''
+    segment = self._next_segment
+    self._next_segment += 1
+    return segment
+
+  def _map(self, segment):
+    '''Memory-maps immutable `segment` (removing it if empty).'''
+    path = self.segment_path(segment)
+    if self._sizes.get(segment, 0) == 0:
+      os.remove(path)
+      self._sizes.pop(segment, None)
+      self._dead.pop(segment, None)
+      return
+
+    with open(path, 'rb') as f:
+      self._maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+  def _open_active(self, segment, hints):
+    '''Opens `segment` as the active segment.'''
+    path = self.segment_path(segment)
+    self._active_id = segment
+    self._active = _SegmentWriter(segment, path, self._sizes.get(segment, 0),
+        hints)
+    self._active_reader = open(path, 'rb')
+    self._sizes[segment] = self._active.size
+    self._dead.setdefault(segment, 0)
+
+
+  # record IO
+
+  def _location(self, key):
+    '''Returns the location of the value of stringified `key`, or None.'''
+    collection = self._index.get(collection_for(key))
+    return collection.get(key) if collection else None
+
+  def _read(self, location):
+    '''Reads the value at `location`.'''
+    segment, value_offset, value_size = location
+    data = self._maps.get(segment)
+    if data is not None:
+      return data[value_offset:value_offset + value_size]
+
+    self._active_reader.seek(value_offset)
+    return self._active_reader.read(value_size)
+
+  def _append(self, key, value):
+    '''Appends a record for `key` to the active segment. Returns its location.
+    Must be called with the lock held.'''
+    self._seq += 1
+    value_offset = self._active.append(self._seq, key, value)
+    self._sizes[self._active_id] = self._active.size
+    if self.sync:
+      self._active.sync()
+    return self._active_id, value_offset, len(value or '')
+
+  def _kill(self, key, location):
+    '''Accounts the record at `location` as dead.'''
+    if location is not None:
+      size = record_header.size + len(key) + location[2]
+      self._dead[location[0]] = self._dead.get(location[0], 0) + size
+
+  def _maybe_rollover(self):
+    '''Makes the active segment immutable if it is large enough.'''
+    if self._active.size < self.max_segment_size:
+      return
+
+    segment = self._active_id
+    self._active.sync()
+    write_hints(self.segment_path(segment, self.hint_extension),
+        self._active.hints)
+    self._active.close()
+    self._active_reader.close()
+    self._map(segment)
+    self._open_active(self._allocate_segment(), [])
+
+    if self.compaction_ratio is not None \
+        and self.dead_ratio() > self.compaction_ratio:
+      self.compact(background=True)
+
+
+  # Datastore implementation
+
+  def get(self, key):
+    '''Return the object named by key or None if it does not exist.
+
+    Args:
+      key: Key naming the object to retrieve
+
+    Returns:
+      object or None
+    '''
+    with self._lock:
+      location = self._location(str(key))
+      return self._read(location) if location else None
+
+  def get_buffer(self, key):
+    '''Return a zero-copy read-only buffer of the object named by `key`.
+
+    Values in immutable segments are returned as a buffer into the segment's
+    memory map, which stays valid even if compaction removes the segment.
+    Values in the active segment are returned as strings.
+
+    Args:
+      key: Key naming the object to retrieve
+
+    Returns:
+      buffer, string, or None
+    '''
+    with self._lock:
+      location = self._location(str(key))
+      if location is None:
+        return None
+
+      segment, value_offset, value_size = location
+      if segment in self._maps:
+        return buffer(self._maps[segment], value_offset, value_size)
+      return self._read(location)
+
+  def put(self, key, value):
+    '''Stores the object `value` named by `key`.
+
+    Args:
+      key: Key naming `value`
+      value: the object to store (a string).
+    '''
+    if value is None:
+      self.delete(key)
+      return
+
+    key = str(key)
+    with self._lock:
+      collection = self._index.setdefault(collection_for(key), {})
+      previous = collection.get(key)
+      collection[key] = self._append(key, value)
+      self._kill(key, previous)
+      if previous is None:
+        self._count += 1
+      self._maybe_rollover()
+
+  def delete(self, key):
+    '''Removes the object named by `key`.
+
+    Args:
+      key: Key naming the object to remove.
+    '''
+    key = str(key)
+    with self._lock:
+      collection_key = collection_for(key)
+      collection = self._index.get(collection_key)
+      if not collection or key not in collection:
+        return
+
+      location = self._append(key, None)
+      self._kill(key, collection.pop(key))
+      self._kill(key, location) # the tombstone itself.
+      self._count -= 1
+      if not collection:
+        del self._index[collection_key]
+      self._maybe_rollover()
+
+  def contains(self, key):
+    '''Returns whether the object named by `key` exists.
+    Only checks the in-memory index.
+
+    Args:
+      key: Key naming the object to check.
+
+    Returns:
+      boalean whether the object exists
+    '''
+    key = str(key)
+    with self._lock:
+      return self._location(key) is not None
+
+  def query(self, query):
+    '''Returns an iterable of objects matching criteria expressed in `query`
+    Iterates over the keys in the collection ``str(query.key)``, as of the
+    time of the call, reading each value lazily.
+
+    Args:
+      query: Query object describing the objects to return.
+
+    Raturns:
+      Cursor with all objects matching criteria
+    '''
+    with self._lock:
+      keys = list(self._index.get(str(query.key), {}))
+    return query(self._value_gen(keys)) # must apply filters, etc naively.
+
+  def _value_gen(self, keys):
+    '''Generator that reads the values of `keys` still in the datastore.'''
+    for key in keys:
+      with self._lock:
+        location = self._location(key)
+        value = self._read(location) if location else None
+      if value is not None:
+        yield value
+
+  def __len__(self):
+    return self._count
+
+
+  # compaction
+
+  def dead_ratio(self):
+    '''Returns the ratio of dead to total bytes in immutable segments.'''
+    with self._lock:
+      total = sum(self._sizes[s] for s in self._maps)
+      dead = sum(self._dead.get(s, 0) for s in self._maps)
+    return float(dead) / total if total else 0.0
+
+  def compact(self, background=False):
+    '''Rewrites the immutable segments, reclaiming the space of dead records.
+
+    Writes continue to go to the active segment while compacting. Only one
+    compaction runs at a time; if one already is, this call does nothing.
+
+    Args:
+      background: whether to compact in a new (daemon) thread.
+
+    Returns:
+      the compaction thread if `background`, else None.
+    '''
+    if not background:
+      if self._compaction_lock.acquire(False):
+        try:
+          self._compact()
+        finally:
+          self._compaction_lock.release()
+      return None
+
+    if self._compaction_thread and self._compaction_thread.is_alive():
+      return self._compaction_thread
+
+    thread = threading.Thread(target=self.compact, name='bitcask-compaction')
+    thread.daemon = True
+    thread.start()
+    self._compaction_thread = thread
+    return thread
+
+  def _compact(self):
+    '''Merges all immutable segments into new ones, and swaps them in.'''
+    with self._lock:
+      inputs = sorted(self._maps)
+      maps = dict(self._maps)
+    if not inputs:
+      return
+
+    writers = []
+    moved = [] # (key, old location, new location)
+
+    for segment in inputs:
+      data = maps[segment]
+      for seq, key, value_offset, value_size, end in scan_records(data):
+        location = (segment, value_offset, value_size)
+        if value_size == tombstone or self._location(key) != location:
+          continue # dead. (a racy check, but it is re-checked on swap.)
+
+        if not writers or writers[-1].size >= self.max_segment_size:
+          with self._lock:
+            output = self._allocate_segment()
+          path = self.segment_path(output) + self.merge_extension
+          writers.append(_SegmentWriter(output, path))
+
+        writer = writers[-1]
+        value = data[value_offset:value_offset + value_size]
+        new_offset = writer.append(seq, key, value)
+        moved.append((key, location, (writer.segment, new_offset, value_size)))
+
+    # finish up the outputs, along with their hint files.
+    outputs = {}
+    for writer in writers:
+      writer.sync()
+      writer.close()
+      path = self.segment_path(writer.segment, self.hint_extension)
+      write_hints(path + self.merge_extension, writer.hints)
+      outputs[writer.segment] = writer.size
+
+    with self._lock:
+      self._commit_merge(inputs, outputs, moved)
+
+  def _commit_merge(self, inputs, outputs, moved):
+    '''Swaps `outputs` in for `inputs`. Must be called with the lock held.
+
+    Args:
+      inputs: the ids of the segments compacted.
+      outputs: a dict of the new segment ids to their sizes.
+      moved: the (key, old location, new location) of every copied record.
+    '''
+    marker = os.path.join(self.root_path, self.merge_marker)
+    with open(marker + '.tmp', 'w') as f:
+      json.dump({'inputs': inputs, 'outputs': sorted(outputs)}, f)
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(marker + '.tmp', marker)
+    _fsync_directory(self.root_path)
+
+    # point of no return: the merge is committed.
+    for segment, size in outputs.items():
+      for extension in [self.data_extension, self.hint_extension]:
+        path = self.segment_path(segment, extension)
+        os.rename(path + self.merge_extension, path)
+      self._sizes[segment] = size
+      self._dead[segment] = 0
+      self._map(segment)
+
+    for key, old, new in moved:
+      collection = self._index.get(collection_for(key))
+      if collection and collection.get(key) == old:
+        collection[key] = new
+      else:
+        self._kill(key, new) # overwritten or deleted while compacting.
+
+    for segment in inputs:
+      # no need to close the maps: outstanding buffers keep them alive.
+      del self._maps[segment]
+      del self._sizes[segment]
+      del self._dead[segment]
+      os.remove(self.segment_path(segment))
+      hints = self.segment_path(segment, self.hint_extension)
+      if os.path.exists(hints):
+        os.remove(hints)
+
+    os.remove(marker)
+    _fsync_directory(self.root_path)
+
+
+  def close(self):
+    '''Closes the datastore, writing the hint file of the active segment.
+
+    The next time the datastore is opened, it will start a new segment.
+    '''
+    thread = self._compaction_thread
+    if thread:
+      thread.join()
+
+    with self._lock:
+      if self._active is None:
+        return
+
+      segment = self._active_id
+      self._active.sync()
+      self._active.close()
+      self._active_reader.close()
+      if self._active.size:
+        write_hints(self.segment_path(segment, self.hint_extension),
+            self._active.hints)
+      else:
+        os.remove(self.segment_path(segment))
+
+      self._active = None
+      self._maps.clear()
@@ -0,0 +1,149 @@
+
+import os
+import shutil
+import unittest
+
+from datastore import serialize
+from datastore.core.key import Key
+from datastore.core.query import Query
+from datastore.core.test.test_basic import TestDatastore
+
+from . import BitcaskDatastore, collection_for
+
+
+class TestBitcaskDatastore(TestDatastore):
+
+  tmp = os.path.normpath('/tmp/datastore.test.bitcask')
+
+  def setUp(self):
+    if os.path.exists(self.tmp):
+      shutil.rmtree(self.tmp)
+
+  def tearDown(self):
+    if os.path.exists(self.tmp):
+      shutil.rmtree(self.tmp)
+
+  def test_datastore(self):
+    dirs = map(str, range(0, 4))
+    dirs = map(lambda d: os.path.join(self.tmp, d), dirs)
+    stores = [BitcaskDatastore(dirs[0]),
+              BitcaskDatastore(dirs[1], max_segment_size=512),
+              BitcaskDatastore(dirs[2], max_segment_size=512, sync=True),
+              BitcaskDatastore(dirs[3], compaction_ratio=None)]
+    dses = map(serialize.shim, stores)
+    self.subtest_simple(dses, numelems=500)
+
+  def test_collection_for(self):
+    for key in ['/', '/a', '/a:b', '/a/b', '/a/b:c', '/a/b:c:d', '/a/:b',
+                '/Comedy/MontyPython/Actor:JohnCleese']:
+      self.assertEqual(collection_for(str(Key(key))), str(Key(key).path))
+
+  def test_reopen(self):
+    ds = BitcaskDatastore(self.tmp, max_segment_size=256)
+    for i in range(0, 100):
+      ds.put(Key('/a:%d' % i), 'value %d' % i)
+    for i in range(0, 100, 2):
+      ds.delete(Key('/a:%d' % i))
+    ds.put(Key('/a:1'), 'changed')
+    ds.close()
+
+    # all segments have hint files now
+    ds = BitcaskDatastore(self.tmp, max_segment_size=256)
+    self.assertEqual(len(ds), 50)
+    self.assertEqual(ds.get(Key('/a:1')), 'changed')
+    self.assertEqual(ds.get(Key('/a:2')), None)
+    self.assertEqual(ds.get(Key('/a:3')), 'value 3')
+    self.assertEqual(len(list(ds.query(Query(Key('/a'))))), 50)
+
+    # without hint files, segments are scanned.
+    ds.close()
+    for name in os.listdir(self.tmp):
+      if name.endswith(ds.hint_extension):
+        os.remove(os.path.join(self.tmp, name))
+
+    ds = BitcaskDatastore(self.tmp, max_segment_size=256)
+    self.assertEqual(len(ds), 50)
+    self.assertEqual(ds.get(Key('/a:1')), 'changed')
+    self.assertEqual(ds.get(Key('/a:2')), None)
+    ds.close()
+
+  def test_crash_recovery(self):
+    ds = BitcaskDatastore(self.tmp)
+    ds.put(Key('/a'), 'a')
+    ds.put(Key('/b'), 'b')
+    path = ds.segment_path(ds._active_id)
+    ds._active.close() # crash: no hint file is written.
+
+    # tear the last record in half.
+    size = os.path.getsize(path)
+    with open(path, 'r+b') as f:
+      f.truncate(size - 1)
+
+    ds = BitcaskDatastore(self.tmp)
+    self.assertEqual(ds.get(Key('/a')), 'a')
+    self.assertEqual(ds.get(Key('/b')), None)
+    self.assertTrue(os.path.getsize(path) < size - 1)
+
+    # appending after the truncated tail works.
+    ds.put(Key('/b'), 'bb')
+    ds.close()
+    ds = BitcaskDatastore(self.tmp)
+    self.assertEqual(ds.get(Key('/b')), 'bb')
+    ds.close()
+
+  def test_compaction(self):
+    ds = BitcaskDatastore(self.tmp, max_segment_size=1024,
+        compaction_ratio=None)
+    for n in range(0, 10):
+      for i in range(0, 50):
+        ds.put(Key('/a:%d' % i), '%d-%d' % (i, n))
+    for i in range(0, 25):
+      ds.delete(Key('/a:%d' % i))
+
+    buf = ds.get_buffer(Key('/a:30'))
+    size = sum(os.path.getsize(os.path.join(self.tmp, n))
+        for n in os.listdir(self.tmp))
+    self.assertTrue(ds.dead_ratio() > 0.5)
+
+    ds.compact()
+    self.assertTrue(ds.dead_ratio() < 0.1)
+    self.assertTrue(size > sum(os.path.getsize(os.path.join(self.tmp, n))
+        for n in os.listdir(self.tmp)))
+    self.assertEqual(str(buf), '30-9') # buffers outlive compaction.
+
+    for i in range(0, 50):
+      value = None if i < 25 else '%d-9' % i
+      self.assertEqual(ds.get(Key('/a:%d' % i)), value)
+
+    # background compaction, racing with writes.
+    ds.compaction_ratio = 0.3
+    for n in range(0, 10):
+      for i in range(0, 50):
+        ds.put(Key('/a:%d' % i), '%d-%d' % (i, n))
+    ds.close()
+
+    ds = BitcaskDatastore(self.tmp)
+    self.assertEqual(len(ds), 50)
+    for i in range(0, 50):
+      self.assertEqual(ds.get(Key('/a:%d' % i)), '%d-9' % i)
+    ds.close()
+
+  def test_merge_recovery(self):
+    ds = BitcaskDatastore(self.tmp, max_segment_size=64,
+        compaction_ratio=None)
+    for i in range(0, 20):
+      ds.put(Key('/a'), 'a%d' % i)
+
+    # an uncommitted merge output is discarded.
+    stray = ds.segment_path(999) + ds.merge_extension
+    open(stray, 'w').write('garbage')
+    ds.close()
+
+    ds = BitcaskDatastore(self.tmp)
+    self.assertFalse(os.path.exists(stray))
+    self.assertEqual(ds.get(Key('/a')), 'a19')
+    ds.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
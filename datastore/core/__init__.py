@@ -20,6 +20,7 @@ import basic
 from basic import Datastore
 from basic import NullDatastore
 from basic import DictDatastore
+from basic import ConcurrentDictDatastore
 from basic import InterfaceMappingDatastore
 
 from basic import ShimDatastore
@@ -40,9 +41,21 @@ import query
 from query import Query
 from query import Cursor
 
+import stream
+from stream import ChunkStream
+
 import serialize
 from serialize import SerializerShimDatastore
 
+import compression
+
+import envelope
+
+import schema
+
+import profiling
+from profiling import ProfilingDatastore
+
 
 # patch datastore with core variables
 import datastore
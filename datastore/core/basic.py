@@ -1,6 +1,9 @@
 
+import threading
+
 from key import Key
 from query import Cursor
+from stream import ChunkStream, read_all
 
 class Datastore(object):
   '''A Datastore represents storage for any key-value pair.
@@ -86,6 +89,38 @@ class Datastore(object):
     '''
     return self.get(key) is not None
 
+  # Streaming API. Datastores MAY provide native implementations.
+
+  def get_stream(self, key):
+    '''Returns a file-like object reading the (string) object named by `key`,
+    or None if it does not exist.
+
+    Streams let large values pass through datastores in chunks, without ever
+    being held in memory whole. The default implementation pays the cost of a
+    get, and so holds the whole value in memory. Datastores storing strings
+    may stream them natively.
+
+    Args:
+      key: Key naming the object to retrieve.
+
+    Returns:
+      file-like object or None
+    '''
+    value = self.get(key)
+    return ChunkStream([value]) if value is not None else None
+
+  def put_stream(self, key, stream):
+    '''Stores the (string) object read from `stream`, named by `key`.
+
+    The default implementation reads the whole stream into memory, and puts
+    it. Datastores storing strings may stream them natively.
+
+    Args:
+      key: Key naming the object.
+      stream: a file-like object, or an iterable of string chunks.
+    '''
+    self.put(key, read_all(stream))
+
 
 
 
@@ -209,6 +244,128 @@ class DictDatastore(Datastore):
 
 
 
+class ConcurrentDictDatastore(DictDatastore):
+  '''Thread-safe in-memory datastore backed by nested dicts.
+
+  Writes to a collection (``key.path``) hold the lock of its stripe: one of
+  `stripes` locks, picked by the hash of the collection. Writes to different
+  collections rarely contend, unlike with one global lock. Reads hold no
+  lock (single dict operations are atomic in CPython).
+
+  ``put_if_absent`` and ``compare_and_swap`` check and write atomically, and
+  queries run over a snapshot of their collection, taken under its lock.
+  '''
+
+  def __init__(self, stripes=64):
+    super(ConcurrentDictDatastore, self).__init__()
+    self._stripes = [threading.Lock() for _ in range(0, stripes)]
+
+  def _stripe(self, collection):
+    '''Returns the lock of the stripe `collection` belongs to.'''
+    return self._stripes[hash(collection) % len(self._stripes)]
+
+  def _collection(self, key):
+    '''Returns the namespace collection for `key`, if it exists, or an empty
+    (detached) one. Reads only.'''
+    return self._items.get(str(key.path), {})
+
+  def _write(self, key, update):
+    '''Runs `update(collection)` on the collection of `key`, holding its
+    stripe lock, and drops the collection if that leaves it empty. Returns
+    whatever `update` returns.'''
+    collection = str(key.path)
+    with self._stripe(collection):
+      objects = self._items.get(collection)
+      if objects is None:
+        objects = {}
+      result = update(objects)
+      if objects:
+        self._items[collection] = objects
+      else:
+        self._items.pop(collection, None)
+      return result
+
+  def put(self, key, value):
+    '''Stores the object `value` named by `key`.
+
+    Args:
+      key: Key naming `value`
+      value: the object to store.
+    '''
+    def update(objects):
+      if value is None:
+        objects.pop(key, None)
+      else:
+        objects[key] = value
+    self._write(key, update)
+
+  def delete(self, key):
+    '''Removes the object named by `key`.
+
+    Args:
+      key: Key naming the object to remove.
+    '''
+    self._write(key, lambda objects: objects.pop(key, None))
+
+  def put_if_absent(self, key, value):
+    '''Stores the object `value` named by `key`, unless one already exists.
+
+    Args:
+      key: Key naming `value`
+      value: the object to store.
+
+    Returns:
+      whether `value` was stored.
+    '''
+    def update(objects):
+      if key in objects:
+        return False
+      objects[key] = value
+      return True
+    return self._write(key, update)
+
+  def compare_and_swap(self, key, expected, value):
+    '''Stores the object `value` named by `key`, if the object currently
+    named by `key` equals `expected`.
+
+    Args:
+      key: Key naming `value`
+      expected: the object expected (None if it should not exist).
+      value: the object to store (None deletes).
+
+    Returns:
+      whether `value` was stored.
+    '''
+    def update(objects):
+      if objects.get(key) != expected:
+        return False
+      if value is None:
+        objects.pop(key, None)
+      else:
+        objects[key] = value
+      return True
+    return self._write(key, update)
+
+  def query(self, query):
+    '''Returns an iterable of objects matching criteria expressed in `query`
+
+    Naively applies the query operations on a snapshot of the objects within
+    the namespaced collection corresponding to ``query.key.path``, taken
+    under its stripe lock. Writes made after the query do not affect it.
+
+    Args:
+      query: Query object describing the objects to return.
+
+    Raturns:
+      iterable cursor with all objects matching criteria
+    '''
+    collection = str(query.key)
+    with self._stripe(collection):
+      objects = self._items.get(collection, {}).values()
+    return query(objects)
+
+
+
 
 class InterfaceMappingDatastore(Datastore):
   '''Represents simple wrapper datastore around an object that, though not a
@@ -358,6 +515,24 @@ class ShimDatastore(Datastore):
     '''
     return self.child_datastore.query(query)
 
+  def get_stream(self, key):
+    '''Returns a file-like object reading the object named by `key`, or None.
+
+    Default shim implementation simply returns
+    ``child_datastore.get_stream(key)``. Shims that transform values on
+    ``get`` must override it too (falling back to ``Datastore.get_stream``).
+    '''
+    return self.child_datastore.get_stream(key)
+
+  def put_stream(self, key, stream):
+    '''Stores the object read from `stream`, named by `key`.
+
+    Default shim implementation simply calls
+    ``child_datastore.put_stream(key, stream)``. Shims that transform values on
+    ``put`` must override it too (falling back to ``Datastore.put_stream``).
+    '''
+    self.child_datastore.put_stream(key, stream)
+
 
 
 
@@ -395,6 +570,19 @@ class CacheShimDatastore(ShimDatastore):
     self.cache_datastore.delete(key)
     self.child_datastore.delete(key)
 
+  def get_stream(self, key):
+    '''Returns a file-like object reading the object named by `key`.
+       Streams bypass the ``cache_datastore``.
+    '''
+    return self.child_datastore.get_stream(key)
+
+  def put_stream(self, key, stream):
+    '''Stores the object read from `stream`, named by `key`.
+       Streams bypass (and invalidate) the ``cache_datastore``.
+    '''
+    self.cache_datastore.delete(key)
+    self.child_datastore.put_stream(key, stream)
+
   def contains(self, key):
     '''Returns whether the object named by `key` exists.
        First checks ``cache_datastore``.
@@ -455,6 +643,20 @@ class LoggingDatastore(ShimDatastore):
     self.logger.info('%s: query %s' % (self, query))
     return super(LoggingDatastore, self).query(query)
 
+  def get_stream(self, key):
+    '''Returns a file-like object reading the object named by `key`.
+       LoggingDatastore logs the access.
+    '''
+    self.logger.info('%s: get_stream %s' % (self, key))
+    return super(LoggingDatastore, self).get_stream(key)
+
+  def put_stream(self, key, stream):
+    '''Stores the object read from `stream`, named by `key`.
+       LoggingDatastore logs the access.
+    '''
+    self.logger.info('%s: put_stream %s' % (self, key))
+    super(LoggingDatastore, self).put_stream(key, stream)
+
 
 
 
@@ -502,6 +704,14 @@ class KeyTransformDatastore(ShimDatastore):
     '''Returns whether the object named by key is in this datastore.'''
     return self.child_datastore.contains(self._transform(key))
 
+  def get_stream(self, key):
+    '''Returns a stream of the object named by keytransform(key).'''
+    return self.child_datastore.get_stream(self._transform(key))
+
+  def put_stream(self, key, stream):
+    '''Stores the object read from `stream` named by keytransform(key).'''
+    return self.child_datastore.put_stream(self._transform(key), stream)
+
   def query(self, query):
     '''Returns a sequence of objects matching criteria expressed in `query`'''
     query = query.copy()
@@ -790,6 +1000,14 @@ class SymlinkDatastore(ShimDatastore):
     results = super(SymlinkDatastore, self).query(query)
     return self._follow_link_gen(results)
 
+  def get_stream(self, key):
+    '''Returns a stream of the object named by `key`. Follows links.'''
+    return Datastore.get_stream(self, key)
+
+  def put_stream(self, key, stream):
+    '''Stores the object read from `stream` named by `key`. Follows links.'''
+    Datastore.put_stream(self, key, stream)
+
 
 
 
@@ -883,6 +1101,11 @@ class DirectoryDatastore(ShimDatastore):
     '''
     return query(self.directory_values_generator(query.key))
 
+  def put_stream(self, key, stream):
+    '''Stores the object read from `stream` named by `key`.
+       DirectoryDatastore stores a directory entry (through ``put``).
+    '''
+    Datastore.put_stream(self, key, stream)
 
 
   def directory(self, key):
@@ -999,6 +1222,16 @@ class TieredDatastore(DatastoreCollection):
         return True
     return False
 
+  def get_stream(self, key):
+    '''Returns a stream of the object named by key, through ``get`` (which
+    also populates the upper datastores).'''
+    return Datastore.get_stream(self, key)
+
+  def put_stream(self, key, stream):
+    '''Stores the object read from `stream` in all underlying datastores,
+    through ``put``.'''
+    Datastore.put_stream(self, key, stream)
+
 
 
 
@@ -1050,6 +1283,14 @@ class ShardedDatastore(DatastoreCollection):
     '''Returns whether the object is in this datastore.'''
     return self.shardDatastore(key).contains(key)
 
+  def get_stream(self, key):
+    '''Returns a stream of the object from the corresponding datastore.'''
+    return self.shardDatastore(key).get_stream(key)
+
+  def put_stream(self, key, stream):
+    '''Stores the object read from `stream` to the corresponding datastore.'''
+    self.shardDatastore(key).put_stream(key, stream)
+
   def query(self, query):
     '''Returns a sequence of objects matching criteria expressed in `query`'''
     cursor = Cursor(query, self.shard_query_generator(query))
@@ -0,0 +1,365 @@
+
+import bz2
+import zlib
+import threading
+
+from serialize import Serializer
+
+try:
+  import lzma
+except ImportError:
+  try:
+    from backports import lzma # backport, for python 2
+  except ImportError:
+    lzma = None
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+try:
+  import lz4.frame
+except ImportError:
+  lz4 = None
+
+
+raw_header = '\x00'
+'''Header byte of values stored uncompressed (below a compressor threshold).'''
+
+compressors = {}
+'''Maps header bytes to the Compressor classes that write them.'''
+
+
+
+def register(cls):
+  '''Class decorator registering Compressor `cls` under its header byte.'''
+  assert cls.header not in compressors, 'header %r taken' % cls.header
+  compressors[cls.header] = cls
+  return cls
+
+
+
+class Compressor(Serializer):
+  '''Compression stage for serializer Stacks, compressing serialized strings.
+
+  Compressed values start with a header byte naming the codec, so any
+  Compressor decodes values written by any other (installed) one, and values
+  smaller than `threshold` are stored as they are, behind a raw header::
+
+      >>> stack = Stack([json, zlib_compressor(threshold=128)])
+      >>> ds = datastore.serialize.shim(child, stack)
+
+  Compressors also stream (see Serializer): streamed values are always
+  compressed, whatever their size.
+  '''
+
+  header = None
+  '''Header byte of values compressed by this codec.'''
+
+  available = True
+  '''Whether the package this codec needs is installed.'''
+
+  def __init__(self, threshold=128):
+    '''Initializes the compressor.
+
+    Args:
+      threshold: size in bytes under which values are not compressed.
+    '''
+    if not self.available:
+      errstr = '%s is not available: its package is not installed.'
+      raise RuntimeError(errstr % self.__class__.__name__)
+    self.threshold = threshold
+    self._decoders = {self.header: self}
+
+  def compress(self, value):
+    '''Returns compressed string `value`.'''
+    raise NotImplementedError
+
+  def decompress(self, value):
+    '''Returns decompressed string `value`.'''
+    raise NotImplementedError
+
+  def compressobj(self):
+    '''Returns an incremental compressor (with `compress` and `flush`).'''
+    raise NotImplementedError
+
+  def decompressobj(self):
+    '''Returns an incremental decompressor (with `decompress`).'''
+    raise NotImplementedError
+
+  def add_decoder(self, compressor):
+    '''Decodes values with the header of `compressor` with it, rather than
+    with a default instance of its class (e.g. a zstd_compressor with the
+    dictionary they were compressed with). Returns self.'''
+    self._decoders[compressor.header] = compressor
+    return self
+
+  def decoder(self, header):
+    '''Returns the compressor decoding values with `header`: self, one given
+    to ``add_decoder``, or a default instance of its class.'''
+    decoder = self._decoders.get(header)
+    if decoder is None:
+      if header not in compressors:
+        raise ValueError('unknown compression header %r.' % header)
+      decoder = self._decoders[header] = compressors[header]()
+    return decoder
+
+  def dumps(self, value):
+    '''returns compressed `value`, with its header.'''
+    if len(value) < self.threshold:
+      return raw_header + value
+    return self.header + self.compress(value)
+
+  def loads(self, value):
+    '''returns decompressed `value`, whichever codec compressed it.'''
+    header = value[:1]
+    if header == raw_header:
+      return value[1:]
+    return self.decoder(header).decompress(value[1:])
+
+  def dumps_stream(self, chunks):
+    '''Generator that compresses string `chunks`, with a header.'''
+    yield self.header
+    compressor = self.compressobj()
+    for chunk in chunks:
+      chunk = compressor.compress(chunk)
+      if chunk:
+        yield chunk
+    yield compressor.flush()
+
+  def loads_stream(self, chunks):
+    '''Generator that decompresses string `chunks`, compressed by any codec.'''
+    decompressor = None
+    for chunk in chunks:
+      if decompressor is None:
+        if not chunk:
+          continue # no header byte yet.
+        header, chunk = chunk[:1], chunk[1:]
+        if header == raw_header:
+          decompressor = _RawDecompressor()
+        else:
+          decompressor = self.decoder(header).decompressobj()
+
+      chunk = decompressor.decompress(chunk)
+      if chunk:
+        yield chunk
+
+    if decompressor is not None and hasattr(decompressor, 'flush'):
+      chunk = decompressor.flush()
+      if chunk:
+        yield chunk
+
+
+
+class _RawDecompressor(object):
+  '''Incremental "decompressor" of uncompressed values.'''
+
+  def decompress(self, chunk):
+    return chunk
+
+
+
+@register
+class zlib_compressor(Compressor):
+  '''zlib (deflate) compression. Fast, with a moderate ratio.'''
+
+  header = 'z'
+
+  def __init__(self, threshold=128, level=6):
+    super(zlib_compressor, self).__init__(threshold)
+    self.level = level
+
+  def compress(self, value):
+    return zlib.compress(value, self.level)
+
+  def decompress(self, value):
+    return zlib.decompress(value)
+
+  def compressobj(self):
+    return zlib.compressobj(self.level)
+
+  def decompressobj(self):
+    return zlib.decompressobj()
+
+
+
+@register
+class bz2_compressor(Compressor):
+  '''bzip2 compression. Slow, with a good ratio on text.'''
+
+  header = 'b'
+
+  def __init__(self, threshold=128, level=9):
+    super(bz2_compressor, self).__init__(threshold)
+    self.level = level
+
+  def compress(self, value):
+    return bz2.compress(value, self.level)
+
+  def decompress(self, value):
+    return bz2.decompress(value)
+
+  def compressobj(self):
+    return bz2.BZ2Compressor(self.level)
+
+  def decompressobj(self):
+    return bz2.BZ2Decompressor()
+
+
+
+@register
+class lzma_compressor(Compressor):
+  '''lzma (xz) compression. Slowest, with the best ratio. Requires `lzma`
+  (the `backports.lzma` package on python 2).'''
+
+  header = 'x'
+  available = lzma is not None
+
+  def __init__(self, threshold=128, preset=6):
+    super(lzma_compressor, self).__init__(threshold)
+    self.preset = preset
+
+  def compress(self, value):
+    return lzma.compress(value, preset=self.preset)
+
+  def decompress(self, value):
+    return lzma.decompress(value)
+
+  def compressobj(self):
+    return lzma.LZMACompressor(preset=self.preset)
+
+  def decompressobj(self):
+    return lzma.LZMADecompressor()
+
+
+
+@register
+class zstd_compressor(Compressor):
+  '''zstandard compression. Fast, with a good ratio. Requires `zstandard`.
+
+  Small values (e.g. short json documents) compress poorly on their own, as
+  they share no history. A dictionary trained on sample values (see
+  `train_dictionary`) gives them one. Values compressed with a dictionary
+  can only be decompressed with the same dictionary, so keep it (e.g. as
+  ``dictionary.as_bytes()``) alongside the data. Other compressors decode
+  them once given a zstd_compressor with it::
+
+      >>> reader = zlib_compressor().add_decoder(
+      ...     zstd_compressor(dictionary=dictionary))
+  '''
+
+  header = 's'
+  available = zstandard is not None
+
+  def __init__(self, threshold=128, level=3, dictionary=None):
+    '''Initializes the compressor.
+
+    Args:
+      threshold: size in bytes under which values are not compressed.
+      level: zstd compression level (1-22).
+      dictionary: a trained dictionary (or its bytes) to compress with.
+    '''
+    super(zstd_compressor, self).__init__(threshold)
+    if isinstance(dictionary, str):
+      dictionary = zstandard.ZstdCompressionDict(dictionary)
+
+    self.level = level
+    self.dictionary = dictionary
+    self._local = threading.local()
+
+  def _codec(self):
+    '''Returns this thread's (ZstdCompressor, ZstdDecompressor): zstandard
+    objects must not be shared between threads.'''
+    local = self._local
+    if not hasattr(local, 'compressor'):
+      kwargs = {}
+      if self.dictionary is not None:
+        kwargs['dict_data'] = self.dictionary
+      local.compressor = zstandard.ZstdCompressor(level=self.level, **kwargs)
+      local.decompressor = zstandard.ZstdDecompressor(**kwargs)
+    return local.compressor, local.decompressor
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    del state['_local']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._local = threading.local()
+
+  @staticmethod
+  def train_dictionary(samples, size=16 * 1024):
+    '''Returns a dictionary of `size` bytes trained on sample values.
+
+    Args:
+      samples: serialized sample values (strings), ideally many.
+      size: size of the dictionary in bytes.
+    '''
+    return zstandard.train_dictionary(size, list(samples))
+
+  def compress(self, value):
+    return self._codec()[0].compress(value)
+
+  def decompress(self, value):
+    self._check_dictionary(value)
+    # streamed frames lack their content size, which decompress() requires.
+    return self._codec()[1].decompressobj().decompress(value)
+
+  def _check_dictionary(self, value):
+    '''Raises ValueError if frame `value` was compressed with a dictionary
+    other than this compressor's (frames record its id).'''
+    used = zstandard.get_frame_parameters(value).dict_id
+    ours = self.dictionary.dict_id() if self.dictionary is not None else 0
+    if used and used != ours:
+      raise ValueError('value was compressed with zstd dictionary %d, not '
+          'this one (see Compressor.add_decoder).' % used)
+
+  def compressobj(self):
+    return self._codec()[0].compressobj()
+
+  def decompressobj(self):
+    return self._codec()[1].decompressobj()
+
+
+
+class _LZ4FrameCompressor(object):
+  '''Adapts lz4.frame.LZ4FrameCompressor to compress/flush.'''
+
+  def __init__(self):
+    self._compressor = lz4.frame.LZ4FrameCompressor()
+    self._started = False
+
+  def _begin(self):
+    if self._started:
+      return ''
+    self._started = True
+    return self._compressor.begin()
+
+  def compress(self, chunk):
+    return self._begin() + self._compressor.compress(chunk)
+
+  def flush(self):
+    return self._begin() + self._compressor.flush()
+
+
+
+@register
+class lz4_compressor(Compressor):
+  '''lz4 compression. Fastest, with a lower ratio. Requires `lz4`.'''
+
+  header = 'l'
+  available = lz4 is not None
+
+  def compress(self, value):
+    return lz4.frame.compress(value)
+
+  def decompress(self, value):
+    return lz4.frame.decompress(value)
+
+  def compressobj(self):
+    return _LZ4FrameCompressor()
+
+  def decompressobj(self):
+    return lz4.frame.LZ4FrameDecompressor()
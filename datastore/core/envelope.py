@@ -0,0 +1,314 @@
+
+import json
+import time
+import pickle
+import struct
+import cPickle
+import threading
+
+from serialize import Serializer, SerializerShimDatastore, Stack
+from serialize import prettyjson, fastjson, fastjson_module, pickle_serializer
+from compression import Compressor, raw_header
+
+
+envelope_magic = '\xfe'
+'''First byte of enveloped values. Never starts json text or a pickle, so
+values written before envelopes (see Envelope `legacy`) by those are told
+apart. It does start msgpack values (fixint -2), and may start bson ones.'''
+
+envelope_header = struct.Struct('>cHB')
+'''Fixed part of envelope headers: magic, codec version, codec id length.
+The codec id follows, then the serialized value.'''
+
+text_serializers = set([json, pickle, cPickle, prettyjson, fastjson,
+    pickle_serializer]) | set([fastjson_module]) - set([None])
+'''Serializers whose values never start with `envelope_magic`: json text,
+and pickles (whose opcodes are ascii, but for protocol headers).'''
+
+
+def legacy_safe(serializer):
+  '''Returns whether values serialized by `serializer` never start with
+  `envelope_magic`, so can be told apart from envelopes (see Envelope).
+  Stacks are as safe as their last serializer, and Compressors as their
+  header bytes; other serializers (msgpack, bson, SchemaSerializer...) are
+  not known to be safe.'''
+  if isinstance(serializer, Stack):
+    return len(serializer) > 0 and legacy_safe(serializer[-1])
+  if isinstance(serializer, Compressor) or (isinstance(serializer, type) and
+      issubclass(serializer, Compressor)):
+    return envelope_magic not in (serializer.header, raw_header)
+  return serializer in text_serializers
+
+
+class Envelope(Serializer):
+  '''Serializer that tags each value with the codec (id and version) that
+  serialized it, so values written by different codecs live side by side.
+
+  Values are serialized by the `current` codec, and deserialized by whichever
+  registered codec wrote them. Switching to a faster codec is then a matter
+  of registering it and making it current: old values still load, and are
+  rewritten over time (see EnvelopeShimDatastore and Migrator)::
+
+      >>> envelope = Envelope({('json', 1): json,
+      ...     ('msgpack', 1): msgpack_serializer}, current=('msgpack', 1),
+      ...     legacy=json)
+      >>> ds = EnvelopeShimDatastore(child, envelope)
+
+  Values without an envelope are told apart by their first byte (see
+  `envelope_magic`), so the `legacy` serializer must never write it first:
+  json and pickle qualify, msgpack and bson do not (see `legacy_safe`).
+
+  Args:
+    codecs: dict of (codec id, version) -> serializer.
+    current: (codec id, version) of the codec to serialize with.
+    legacy: serializer of values stored without an envelope, if any.
+  '''
+
+  def __init__(self, codecs, current, legacy=None):
+    self.codecs = {}
+    self._headers = {}
+    for codec, serializer in dict(codecs).items():
+      self.register(codec[0], codec[1], serializer)
+
+    if current not in self.codecs:
+      raise ValueError('current codec %r is not registered.' % (current,))
+    self.current = current
+
+    if legacy is not None and not legacy_safe(legacy):
+      raise ValueError('values of %r may start with the envelope magic, '
+          'so cannot be told apart as legacy values.' % (legacy,))
+    self.legacy = legacy
+
+  def register(self, codec_id, version, serializer):
+    '''Registers `serializer` as version `version` of codec `codec_id`.'''
+    if not Serializer.implements_serializer_interface(serializer):
+      raise TypeError('%r is not a serializer.' % (serializer,))
+    codec = (str(codec_id), int(version))
+    self.codecs[codec] = serializer
+    self._headers[codec] = envelope_header.pack(envelope_magic, codec[1],
+        len(codec[0])) + codec[0]
+
+  def header(self, codec):
+    '''Returns the envelope header of values serialized by `codec`.'''
+    return self._headers[codec]
+
+  def codec(self, value):
+    '''Returns the (codec id, version) that serialized `value`, or None if
+    it has no envelope (a legacy value).'''
+    if value[:1] != envelope_magic or len(value) < envelope_header.size:
+      return None
+    _, version, length = envelope_header.unpack_from(value)
+    start = envelope_header.size
+    if len(value) < start + length:
+      return None # too short for its header: not an envelope.
+    return (value[start:start + length], version)
+
+  def is_current(self, value):
+    '''Returns whether `value` was serialized by the current codec.'''
+    return value.startswith(self._headers[self.current])
+
+  def dumps(self, value):
+    '''returns `value` serialized by the current codec, in an envelope.'''
+    return self._headers[self.current] + \
+        self.codecs[self.current].dumps(value)
+
+  def loads(self, value):
+    '''returns deserialized `value`, whichever registered codec wrote it.'''
+    codec = self.codec(value)
+    if codec is None:
+      if self.legacy is None:
+        raise ValueError('value has no envelope, and no legacy serializer.')
+      return self.legacy.loads(value)
+
+    if codec not in self.codecs:
+      raise ValueError('unknown codec %r (version %d).' % codec)
+    start = len(self._headers[codec])
+    return self.codecs[codec].loads(value[start:])
+
+
+
+class EnvelopeShimDatastore(SerializerShimDatastore):
+  '''SerializerShimDatastore over an Envelope, which rewrites values
+  serialized by an old codec (or legacy values) with the current codec when
+  they are read, if `reencode` is set.
+
+  Rewrites happen on ``get`` only (queries do not know the keys of their
+  results), and only replace the exact value read. With a child offering
+  ``compare_and_swap`` (e.g. ConcurrentDictDatastore), that check is atomic.
+  Otherwise, once a rewrite happened (see ``migrate``), writes through this
+  datastore take a lock that rewrites hold from check to write; writes to the
+  child bypassing it may then still be overwritten by a rewrite (with the
+  value they replaced).
+
+  Args:
+    datastore: a child datastore for the ShimDatastore superclass.
+    serializer: an Envelope.
+    reencode: whether ``get`` rewrites values not in the current codec.
+    kwargs: passed to SerializerShimDatastore (e.g. `cache_items`).
+  '''
+
+  def __init__(self, datastore, serializer, reencode=False, **kwargs):
+    if not isinstance(serializer, Envelope):
+      raise TypeError('EnvelopeShimDatastore requires an Envelope.')
+    super(EnvelopeShimDatastore, self).__init__(datastore, serializer,
+        **kwargs)
+    self.reencode = reencode
+    self.reencoded = 0
+    self._write_lock = threading.RLock()
+    self._lock_writes = False
+    self._unlocked_writes = set()
+
+  def get(self, key):
+    '''Return the object named by key or None if it does not exist.
+    Values not serialized by the current codec are rewritten with it, if
+    `reencode` is set.
+
+    Args:
+      key: Key naming the object to retrieve
+
+    Returns:
+      object or None
+    '''
+    if self.cache is not None:
+      value = self.cache.get(key)
+      if value is not None:
+        return value
+      generation = self.cache.generation
+
+    serialized = self.child_datastore.get(key)
+    if serialized is None:
+      return None
+
+    value = self.serializer.loads(serialized)
+    if self.reencode and not self.serializer.is_current(serialized):
+      if self._rewrite(key, serialized, value):
+        self.reencoded += 1
+
+    if self.cache is None:
+      return value
+    self.cache.put(key, value, len(serialized), generation)
+    return self.cache.read(value)
+
+  def put(self, key, value):
+    '''Stores the object `value` named by `key` (see SerializerShimDatastore).
+
+    Args:
+      key: Key naming `value`
+      value: the object to store.
+    '''
+    self._write(super(EnvelopeShimDatastore, self).put, key, value)
+
+  def delete(self, key):
+    '''Removes the object named by `key` (see SerializerShimDatastore).
+
+    Args:
+      key: Key naming the object to remove.
+    '''
+    self._write(super(EnvelopeShimDatastore, self).delete, key)
+
+  def put_stream(self, key, stream):
+    '''Stores the object read from `stream`, named by `key` (see
+    SerializerShimDatastore).
+
+    Args:
+      key: Key naming the object.
+      stream: a file-like object, or an iterable of string chunks.
+    '''
+    self._write(super(EnvelopeShimDatastore, self).put_stream, key, stream)
+
+  def _write(self, write, *args):
+    '''Calls `write(*args)`, holding `_write_lock` once writes are locked
+    (see `_rewrite`). Until then, writes in progress are tracked in
+    `_unlocked_writes`, for the first rewrite to wait for.'''
+    if not self._lock_writes:
+      token = object()
+      self._unlocked_writes.add(token)
+      try:
+        if not self._lock_writes: # checked again, once tracked.
+          return write(*args)
+      finally:
+        self._unlocked_writes.discard(token)
+
+    with self._write_lock:
+      return write(*args)
+
+  def _rewrite(self, key, serialized, value):
+    '''Replaces `serialized` (read from the child) with `value` serialized by
+    the current codec, unless it changed since. Returns whether it did.'''
+    reencoded = self.serializer.dumps(value)
+    compare_and_swap = getattr(self.child_datastore, 'compare_and_swap', None)
+    if compare_and_swap is not None:
+      return compare_and_swap(key, serialized, reencoded)
+
+    if not self._lock_writes:
+      self._lock_writes = True
+      while self._unlocked_writes: # writes started before it was set.
+        time.sleep(0.001)
+
+    with self._write_lock:
+      if self.child_datastore.get(key) != serialized:
+        return False
+      self.child_datastore.put(key, reencoded)
+      return True
+
+  def migrate(self, key):
+    '''Rewrites the object named by `key` with the current codec, if it was
+    serialized by another (and is not written meanwhile). Returns whether it
+    was rewritten.'''
+    serialized = self.child_datastore.get(key)
+    if serialized is None or self.serializer.is_current(serialized):
+      return False
+    value = self.serializer.loads(serialized)
+    return self._rewrite(key, serialized, value)
+
+
+
+class Migrator(object):
+  '''Rewrites the objects named by `keys` in an EnvelopeShimDatastore with
+  its current codec, on the calling thread (``run``) or in the background
+  (``start``)::
+
+      >>> migrator = Migrator(ds, keys)
+      >>> migrator.start()
+      >>> ...
+      >>> migrator.join()
+      >>> migrator.migrated
+      10000
+
+  Args:
+    datastore: an EnvelopeShimDatastore.
+    keys: iterable of the Keys to migrate.
+  '''
+
+  def __init__(self, datastore, keys):
+    self.datastore = datastore
+    self.keys = keys
+    self.scanned = 0
+    self.migrated = 0
+    self._stop = threading.Event()
+    self._thread = None
+
+  def run(self):
+    '''Migrates every key (until stopped). Returns the number rewritten.'''
+    for key in self.keys:
+      if self._stop.is_set():
+        break
+      if self.datastore.migrate(key):
+        self.migrated += 1
+      self.scanned += 1
+    return self.migrated
+
+  def start(self):
+    '''Runs the migration on a background (daemon) thread.'''
+    self._thread = threading.Thread(target=self.run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    '''Stops the migration after the key in progress.'''
+    self._stop.set()
+
+  def join(self, timeout=None):
+    '''Waits for a background migration to finish.'''
+    if self._thread is not None:
+      self._thread.join(timeout)
@@ -218,3 +218,17 @@ class Key(object):
     return '/' + '/'.join(filter(lambda p: p != '', path.split('/')))
 
 
+
+def sort_key(key):
+  '''Returns the string `key` is sorted by: its collection, then itself.
+
+  Sorting by collection (``key.path``) first keeps all the objects a query
+  can return contiguous, so that a query is a single seek and scan (e.g. in
+  sorted stores like datastore.lsm and datastore.lmdb).
+  '''
+  return '%s\x00%s' % (key.path, key)
+
+
+def collection_prefix(key):
+  '''Returns the sort key prefix of all objects in collection `key`.'''
+  return '%s\x00' % key
@@ -0,0 +1,325 @@
+
+import os
+import time
+import heapq
+import pstats
+import cProfile
+import threading
+import contextlib
+import StringIO
+
+from basic import ShimDatastore
+
+try:
+  import tracemalloc # python 3.4+, or the pytracemalloc backport.
+except ImportError:
+  tracemalloc = None
+
+
+profile_environ = 'DATASTORE_PROFILE'
+'''Environment variable that turns on profiling of ProfilingDatastores.
+Set it to the number of slowest calls to keep (e.g. DATASTORE_PROFILE=20).
+'''
+
+default_slowest = 10
+
+
+
+def _slowest_from_environ():
+  '''Returns the number of calls to keep, as requested by the environment.'''
+  try:
+    return int(os.environ.get(profile_environ, '')) or default_slowest
+  except ValueError:
+    return default_slowest
+
+
+
+class ProfiledCall(object):
+  '''Represents a single sampled datastore operation.'''
+
+  __slots__ = ('datastore', 'operation', 'key', 'duration', 'profile',
+               'allocations')
+
+  def __init__(self, datastore, operation, key, duration, profile=None,
+               allocations=None):
+    self.datastore = datastore
+    self.operation = operation
+    self.key = key
+    self.duration = duration
+    self.profile = profile
+    self.allocations = allocations
+
+  def __repr__(self):
+    return '<ProfiledCall %s.%s %s %.3fms>' % (self.datastore, self.operation,
+        self.key, self.duration * 1000)
+
+
+
+class Profiler(object):
+  '''Samples cProfile stacks (and tracemalloc snapshots) of the slowest calls.
+
+  Every call made while the profiler is enabled runs under its own
+  ``cProfile.Profile``. Only the `slowest` calls keep their profile around,
+  so memory use stays bounded no matter how many calls are made. Aggregate
+  timings per (datastore class, operation) are kept for all calls.
+
+  Profiling is off unless enabled, either through the ``DATASTORE_PROFILE``
+  environment variable, or with the ``active`` context manager::
+
+      >>> profiler = Profiler(slowest=5)
+      >>> ds = ProfilingDatastore(DictDatastore(), profiler=profiler)
+      >>> with profiler.active():
+      ...   ds.put(Key('/a'), 'a')
+      ...
+      >>> print profiler.report()
+
+  Args:
+    slowest: number of slowest calls to keep samples of.
+
+    memory: whether to also capture tracemalloc snapshots for the slowest
+        calls. Requires tracemalloc to be tracing (``tracemalloc.start()``).
+        Snapshots are taken around every call, so this is much more expensive.
+
+    enabled: whether profiling starts enabled. Defaults to whether the
+        ``DATASTORE_PROFILE`` environment variable is set.
+  '''
+
+  def __init__(self, slowest=None, memory=False, enabled=None):
+    if slowest is None:
+      slowest = _slowest_from_environ()
+
+    if enabled is None:
+      enabled = bool(os.environ.get(profile_environ))
+
+    self.slowest = int(slowest)
+    self.memory = bool(memory)
+    self.enabled = bool(enabled)
+    self.reset()
+
+  def reset(self):
+    '''Discards all collected samples and totals.'''
+    self._lock = threading.Lock()
+    self._local = threading.local()
+    self._heap = [] # min-heap of (duration, seq, ProfiledCall)
+    self._seq = 0
+    self.totals = {} # (datastore, operation) -> [calls, seconds, max]
+
+  @contextlib.contextmanager
+  def active(self):
+    '''Context manager that enables this profiler within its block.'''
+    enabled = self.enabled
+    self.enabled = True
+    try:
+      yield self
+    finally:
+      self.enabled = enabled
+
+  def _tracing(self):
+    '''Returns whether allocation snapshots should be taken.'''
+    return self.memory and tracemalloc is not None \
+       and tracemalloc.is_tracing()
+
+
+  def call(self, datastore, operation, key, function, *args):
+    '''Calls `function` with `args`, profiling it if this profiler is enabled.
+
+    Args:
+      datastore: name of the Datastore class the call is attributed to.
+      operation: name of the operation (get, put, ...).
+      key: the Key the operation is on (for the report).
+      function: the callable to profile.
+    '''
+    if not self.enabled:
+      return function(*args)
+
+    # cProfile cannot nest within a thread. nested calls are only timed, and
+    # show up within the stacks of the outermost call.
+    nested = getattr(self._local, 'profiling', False)
+    profile = None if nested else cProfile.Profile()
+    snapshot = self._tracing() and not nested and tracemalloc.take_snapshot()
+
+    self._local.profiling = True
+    start = time.time()
+    if profile:
+      profile.enable()
+
+    try:
+      return function(*args)
+
+    finally:
+      if profile:
+        profile.disable()
+      duration = time.time() - start
+      self._local.profiling = nested
+      self._record(datastore, operation, key, duration, profile, snapshot)
+
+  def _record(self, datastore, operation, key, duration, profile, snapshot):
+    '''Accounts for a call, keeping its samples if it is among the slowest.'''
+    with self._lock:
+      totals = self.totals.setdefault((datastore, operation), [0, 0.0, 0.0])
+      totals[0] += 1
+      totals[1] += duration
+      totals[2] = max(totals[2], duration)
+
+      if not profile or self.slowest <= 0:
+        return
+
+      if len(self._heap) >= self.slowest and duration <= self._heap[0][0]:
+        return # not slow enough to keep.
+
+      self._seq += 1
+      call = ProfiledCall(datastore, operation, key, duration, profile)
+      entry = (duration, self._seq, call)
+      if len(self._heap) < self.slowest:
+        heapq.heappush(self._heap, entry)
+      else:
+        heapq.heapreplace(self._heap, entry)
+
+    # only diff snapshots of calls we are keeping; it is expensive.
+    if snapshot:
+      call.allocations = tracemalloc.take_snapshot().compare_to(snapshot,
+          'lineno')
+
+
+  def slowest_calls(self):
+    '''Returns the sampled ProfiledCalls, slowest first.'''
+    with self._lock:
+      entries = sorted(self._heap, reverse=True)
+    return [call for _, _, call in entries]
+
+  def report(self, limit=20):
+    '''Returns a human readable report of where time and memory went.
+
+    The report lists the aggregate timings per datastore operation, the
+    slowest sampled calls, the functions with most time spent within those
+    calls (e.g. Key construction, query _object_getattr, serializer loads),
+    and -- if captured -- the lines that allocated most memory.
+
+    Args:
+      limit: maximum number of functions (and allocation sites) to list.
+    '''
+    out = StringIO.StringIO()
+    calls = self.slowest_calls()
+
+    out.write('datastore operations:\n')
+    totals = sorted(self.totals.items(), key=lambda i: i[1][1], reverse=True)
+    for (datastore, operation), (count, total, slowest) in totals:
+      out.write('  %-40s %8d calls %10.3fms total %10.3fms max\n' % (
+          '%s.%s' % (datastore, operation), count, total * 1000,
+          slowest * 1000))
+
+    out.write('\n%d slowest calls:\n' % len(calls))
+    for call in calls:
+      out.write('  %10.3fms %s.%s %s\n' % (call.duration * 1000,
+          call.datastore, call.operation, call.key))
+
+    if calls:
+      out.write('\nhot spots within the slowest calls:\n')
+      stats = pstats.Stats(calls[0].profile, stream=out)
+      for call in calls[1:]:
+        stats.add(call.profile)
+      stats.sort_stats('tottime').print_stats(limit)
+
+    allocations = [c for c in calls if c.allocations]
+    if allocations:
+      out.write('allocations within the slowest calls:\n')
+      for call in allocations:
+        out.write('  %s.%s %s\n' % (call.datastore, call.operation, call.key))
+        for stat in call.allocations[:limit]:
+          out.write('    %s\n' % stat)
+
+    return out.getvalue()
+
+
+
+default_profiler = Profiler()
+'''Profiler used by ProfilingDatastores that are not given their own.'''
+
+
+def profiling(profiler=None):
+  '''Returns a context manager enabling `profiler` (the default_profiler).'''
+  return (profiler or default_profiler).active()
+
+
+
+class ProfilingDatastore(ShimDatastore):
+  '''Wraps a datastore with a profiling shim.
+
+  While its profiler is enabled, every operation is timed and attributed to
+  the class of the ``child_datastore``, and the slowest ones are sampled with
+  cProfile (and tracemalloc). When disabled, calls pass straight through.
+
+  Note that ``query`` returns a lazy cursor, so only the cost of setting up
+  the query is profiled, not the cost of iterating over its results.
+
+  Args:
+    datastore: a child datastore for the ShimDatastore superclass.
+
+    profiler: the Profiler to record calls in (default_profiler by default).
+  '''
+
+  def __init__(self, datastore, profiler=None):
+    super(ProfilingDatastore, self).__init__(datastore)
+    self.profiler = profiler or default_profiler
+    self._name = datastore.__class__.__name__
+
+  def get(self, key):
+    '''Return the object named by key or None if it does not exist.
+       ProfilingDatastore profiles the access.
+    '''
+    return self.profiler.call(self._name, 'get', key,
+        self.child_datastore.get, key)
+
+  def put(self, key, value):
+    '''Stores the object `value` named by `key`.
+       ProfilingDatastore profiles the access.
+    '''
+    self.profiler.call(self._name, 'put', key,
+        self.child_datastore.put, key, value)
+
+  def delete(self, key):
+    '''Removes the object named by `key`.
+       ProfilingDatastore profiles the access.
+    '''
+    self.profiler.call(self._name, 'delete', key,
+        self.child_datastore.delete, key)
+
+  def contains(self, key):
+    '''Returns whether the object named by `key` exists.
+       ProfilingDatastore profiles the access.
+    '''
+    return self.profiler.call(self._name, 'contains', key,
+        self.child_datastore.contains, key)
+
+  def query(self, query):
+    '''Returns an iterable of objects matching criteria expressed in `query`.
+       ProfilingDatastore profiles the (lazy) query setup.
+    '''
+    return self.profiler.call(self._name, 'query', query.key,
+        self.child_datastore.query, query)
+
+  def get_stream(self, key):
+    '''Returns a stream of the object named by `key`.
+       ProfilingDatastore profiles opening the stream.
+    '''
+    return self.profiler.call(self._name, 'get_stream', key,
+        self.child_datastore.get_stream, key)
+
+  def put_stream(self, key, stream):
+    '''Stores the object read from `stream` named by `key`.
+       ProfilingDatastore profiles the access.
+    '''
+    self.profiler.call(self._name, 'put_stream', key,
+        self.child_datastore.put_stream, key, stream)
+
+
+
+def profile(datastore, profiler=None):
+  '''Return a ProfilingDatastore wrapping `datastore`.
+
+  Can be used as a syntacticly-nicer way to wrap a datastore::
+
+      my_store = datastore.profiling.profile(my_store)
+
+  '''
+  return ProfilingDatastore(datastore, profiler=profiler)
@@ -59,11 +59,15 @@ def limit_gen(limit, iterable):
   limit = int(limit)
   assert limit >= 0, 'negative limit'
 
+  if limit <= 0:
+    return
+
+  # stop as soon as the limit is reached, without pulling another element.
   for item in iterable:
-    if limit <= 0:
-      break
     yield item
     limit -= 1
+    if limit <= 0:
+      break
 
 
 def offset_gen(offset, iterable, skip_signal=None):
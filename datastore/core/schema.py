@@ -0,0 +1,170 @@
+
+import json
+import zlib
+import struct
+import threading
+
+from key import Key
+from serialize import Serializer, msgpack_serializer, msgpack
+
+
+schema_header = struct.Struct('>I')
+'''Header of values serialized by a SchemaSerializer: their schema id.'''
+
+no_schema = 0
+'''Schema id of values that are not mappings with string keys (serialized
+as they are).'''
+
+
+
+def schema_id(fields):
+  '''Returns the id of the schema of (sorted) `fields`: their crc32.'''
+  crc = zlib.crc32('\x00'.join(fields)) & 0xffffffff
+  return crc if crc != no_schema else 1
+
+
+
+class SchemaSerializer(Serializer):
+  '''Serializer of mappings sharing field names, storing the names once.
+
+  Collections often hold many values with the same fields (e.g. every
+  ``/User`` has a name, an email and a group). Values are serialized as the
+  list of their field values, in field name order, behind the id of their
+  schema: the crc32 of their sorted field names. Each schema (set of field
+  names) is registered the first time it is seen, and stored in the
+  `datastore` given, under the `namespace` key, so other processes (and later
+  runs) can deserialize the values that use it.
+
+  A value with a new set of fields gets a new schema, and values keep the
+  schema they were written with, so fields can be added or dropped at any
+  time. Values that are not mappings (or have non-string keys) are
+  serialized as they are, with schema id 0.
+
+  Field values are serialized with msgpack when installed (which also lets
+  queries deserialize single fields, see SerializerShimDatastore.query), and
+  json otherwise::
+
+      >>> schemas = datastore.DictDatastore()
+      >>> users = datastore.serialize.shim(child, SchemaSerializer(schemas))
+
+  Args:
+    datastore: a datastore to persist schemas in (optional).
+    namespace: Key under which schemas are stored in `datastore`.
+  '''
+
+  max_orders = 4096
+  '''Number of dict key orders whose schema is cached (see _schema_of).'''
+
+  def __init__(self, datastore=None, namespace=Key('/schemas')):
+    self.datastore = datastore
+    self.namespace = namespace
+    self.values_serializer = msgpack_serializer if msgpack else json
+    self._schemas = {} # schema id -> fields
+    self._orders = {} # tuple of keys in dict order -> (schema id, fields)
+    self._lock = threading.Lock()
+
+  def validation_copy(self):
+    '''Returns a SchemaSerializer like this one that persists no schemas, to
+    validate with (see serialize.validate_serializer).'''
+    copy = SchemaSerializer(None, self.namespace)
+    copy.values_serializer = self.values_serializer
+    return copy
+
+  def schema_key(self, schema):
+    '''Returns the Key schema id `schema` is stored under.'''
+    return self.namespace.child('%08x' % schema)
+
+  def register(self, fields):
+    '''Registers (and persists) the schema of `fields`. Returns its id.'''
+    fields = tuple(sorted(fields))
+    schema = schema_id(fields)
+    with self._lock:
+      known = self._schemas.get(schema)
+      if known is None and self.datastore is not None:
+        # another process (or a colliding schema) may have persisted it.
+        key = self.schema_key(schema)
+        stored = self.datastore.get(key)
+        if stored is None:
+          self.datastore.put(key, json.dumps(fields))
+        else:
+          known = self._schemas[schema] = tuple(json.loads(stored))
+      if known is None:
+        self._schemas[schema] = fields
+      elif tuple(known) != fields:
+        raise ValueError('schema id %08x collides: %r and %r' %
+            (schema, known, fields))
+    return schema
+
+  def fields(self, schema):
+    '''Returns the field names of schema id `schema`, loading them from the
+    datastore if needed.'''
+    fields = self._schemas.get(schema)
+    if fields is None:
+      stored = None
+      if self.datastore is not None:
+        stored = self.datastore.get(self.schema_key(schema))
+      if stored is None:
+        raise ValueError('unknown schema id %08x.' % schema)
+      fields = self._schemas[schema] = tuple(json.loads(stored))
+    return fields
+
+  def _schema_of(self, value):
+    '''Returns the (schema id, fields) of mapping `value`, or None. Cached
+    by the order of its keys, which saves sorting them; the cache is reset
+    once it holds `max_orders` orders.'''
+    order = tuple(value)
+    with self._lock:
+      cached = self._orders.get(order)
+    if cached is None:
+      if not all(isinstance(field, basestring) for field in order):
+        return None
+      schema = self.register(order)
+      with self._lock:
+        if len(self._orders) >= self.max_orders:
+          self._orders.clear()
+        cached = self._orders[order] = (schema, self._schemas[schema])
+    return cached
+
+  def dumps(self, value):
+    '''returns `value` serialized as its schema id and field values.'''
+    schema = None
+    if isinstance(value, dict):
+      schema = self._schema_of(value)
+
+    if schema is None:
+      return schema_header.pack(no_schema) + self.values_serializer.dumps(value)
+
+    schema, fields = schema
+    values = [value[field] for field in fields]
+    return schema_header.pack(schema) + self.values_serializer.dumps(values)
+
+  def loads(self, value):
+    '''returns deserialized `value`, as a dict of its fields.'''
+    schema, = schema_header.unpack_from(value)
+    values = self.values_serializer.loads(value[schema_header.size:])
+    if schema == no_schema:
+      return values
+    return dict(zip(self.fields(schema), values))
+
+  def loads_fields(self, value, fields):
+    '''returns a dict of the `fields` of deserialized `value` (those it has),
+    deserializing only those with msgpack.'''
+    schema, = schema_header.unpack_from(value)
+    if schema == no_schema:
+      raise ValueError('value has no schema.')
+
+    names = self.fields(schema)
+    if self.values_serializer is not msgpack_serializer:
+      values = self.values_serializer.loads(value[schema_header.size:])
+      return dict((n, v) for n, v in zip(names, values) if n in fields)
+
+    unpacker = msgpack.Unpacker(raw=False, max_buffer_size=0)
+    unpacker.feed(value[schema_header.size:])
+    unpacker.read_array_header()
+    result = {}
+    for name in names:
+      if name in fields:
+        result[name] = unpacker.unpack()
+      else:
+        unpacker.skip()
+    return result
@@ -1,14 +1,50 @@
 
 
 import json
+import copy
+import types
+import timeit
+import threading
+import collections
+import cPickle
+import importlib
+import itertools
 from basic import Datastore, ShimDatastore
+from stream import ChunkStream, iter_chunks
+from query import Query
+
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+
+# faster json implementations, in order of preference.
+fastjson_module = None
+for _name in ['orjson', 'ujson', 'simplejson']:
+  try:
+    fastjson_module = __import__(_name)
+    break
+  except ImportError:
+    pass
+del _name
 
 default_serializer = json
 
 
 
 class Serializer(object):
-  '''Serializing protocol. Serialized data must be a string.'''
+  '''Serializing protocol. Serialized data must be a string.
+
+  Serializers that transform strings into strings (e.g. compression) may also
+  implement the streaming protocol, ``dumps_stream`` and ``loads_stream``:
+  each takes an iterable of string chunks and returns an iterable of
+  transformed chunks. See SerializerShimDatastore.get_stream.
+
+  Serializers may also implement ``loads_many``, deserializing a list of
+  values at once faster than one by one (see loads_many), and
+  ``loads_fields``, deserializing only some fields of mapping values (see
+  SerializerShimDatastore.query).
+  '''
   @classmethod
   def loads(cls, value):
     '''returns deserialized `value`.'''
@@ -24,6 +60,11 @@ class Serializer(object):
     return hasattr(cls, 'loads') and callable(cls.loads) \
        and hasattr(cls, 'dumps') and callable(cls.dumps)
 
+  @staticmethod
+  def implements_stream_interface(cls):
+    return hasattr(cls, 'loads_stream') and callable(cls.loads_stream) \
+       and hasattr(cls, 'dumps_stream') and callable(cls.dumps_stream)
+
 
 
 class NonSerializer(Serializer):
@@ -40,6 +81,16 @@ class NonSerializer(Serializer):
     '''returns `value`.'''
     return value
 
+  @classmethod
+  def loads_stream(cls, chunks):
+    '''returns `chunks`.'''
+    return chunks
+
+  @classmethod
+  def dumps_stream(cls, chunks):
+    '''returns `chunks`.'''
+    return chunks
+
 
 
 class prettyjson(Serializer):
@@ -73,6 +124,41 @@ class Stack(Serializer, list):
       value = serializer.dumps(value)
     return value
 
+  def loads_many(self, values):
+    '''Returns the list of deserialized `values`.'''
+    for serializer in reversed(self):
+      values = loads_many(serializer, values)
+    return values
+
+  def loads_fields(self, value, fields):
+    '''Returns a dict of the `fields` of deserialized `value`, that the first
+    serializer decodes (see supports_fields).'''
+    for serializer in reversed(self[1:]):
+      value = serializer.loads(value)
+    return self[0].loads_fields(value, fields)
+
+  def stream_serializers(self):
+    '''Returns the serializers at the end of the stack that stream. Streams
+    carry values as serialized by the ones before them.'''
+    serializers = []
+    for serializer in reversed(self):
+      if not Serializer.implements_stream_interface(serializer):
+        break
+      serializers.insert(0, serializer)
+    return serializers
+
+  def loads_stream(self, chunks):
+    '''Returns deserialized `chunks`, by the streaming serializers.'''
+    for serializer in reversed(self.stream_serializers()):
+      chunks = serializer.loads_stream(chunks)
+    return chunks
+
+  def dumps_stream(self, chunks):
+    '''Returns serialized `chunks`, by the streaming serializers.'''
+    for serializer in self.stream_serializers():
+      chunks = serializer.dumps_stream(chunks)
+    return chunks
+
 
 
 class map_serializer(Serializer):
@@ -96,12 +182,253 @@ class map_serializer(Serializer):
 
 
 
+class msgpack_serializer(Serializer):
+  '''msgpack serializer. Compact and fast, and round-trips byte strings
+  (distinct from unicode strings). Requires the `msgpack` package.
+  '''
+
+  available = msgpack is not None
+
+  @classmethod
+  def loads(cls, value):
+    '''returns msgpack deserialized `value`.'''
+    return msgpack.unpackb(value, raw=False)
+
+  @classmethod
+  def dumps(cls, value):
+    '''returns msgpack serialized `value`.'''
+    return msgpack.packb(value, use_bin_type=True)
+
+  @classmethod
+  def loads_many(cls, values):
+    '''returns the list of msgpack deserialized `values`, unpacked in one
+    pass by a streaming Unpacker.'''
+    unpacker = msgpack.Unpacker(raw=False, max_buffer_size=0)
+    unpacker.feed(''.join(values))
+    result = list(unpacker)
+    if len(result) != len(values):
+      raise ValueError('msgpack values do not hold one object each.')
+    return result
+
+  @classmethod
+  def loads_fields(cls, value, fields):
+    '''returns a dict of the `fields` of msgpack map `value` (those it has).
+    Other fields are skipped over, without being deserialized.'''
+    unpacker = msgpack.Unpacker(raw=False, max_buffer_size=0)
+    unpacker.feed(value)
+    result = {}
+    for _ in xrange(unpacker.read_map_header()):
+      field = unpacker.unpack()
+      if field in fields:
+        result[field] = unpacker.unpack()
+      else:
+        unpacker.skip()
+    return result
+
+
+
+class pickle_serializer(Serializer):
+  '''pickle serializer, using the highest protocol. Round-trips most python
+  objects (tuples, sets, byte strings, ...). Only load trusted data with it:
+  unpickling can run arbitrary code.
+  '''
+
+  available = True
+  protocol = cPickle.HIGHEST_PROTOCOL
+
+  @classmethod
+  def loads(cls, value):
+    '''returns unpickled `value`.'''
+    return cPickle.loads(value)
+
+  @classmethod
+  def dumps(cls, value):
+    '''returns pickled `value`.'''
+    return cPickle.dumps(value, cls.protocol)
+
+
+
+class fastjson(Serializer):
+  '''json serializer using the fastest json package installed (orjson, ujson
+  or simplejson, see `fastjson_module`), or the standard json module.
+  '''
+
+  available = fastjson_module is not None
+  module = fastjson_module or json
+
+  @classmethod
+  def loads(cls, value):
+    '''returns json deserialized `value`.'''
+    return cls.module.loads(value)
+
+  @classmethod
+  def dumps(cls, value):
+    '''returns json serialized `value`.'''
+    value = cls.module.dumps(value)
+    return value if isinstance(value, str) else str(value)
+
+
+
+default_sample = {
+  'key': '/Comedy/MontyPython/Actor:JohnCleese',
+  'name': 'John Cleese',
+  'born': 1939,
+  'height': 1.96,
+  'active': True,
+  'sketches': ['ArgumentClinic', 'CheeseShop', 'DeadParrot'],
+  'roles': [{'sketch': 'CheeseShop', 'character': 'Mousebender'}] * 8,
+}
+'''Sample value that fastest_serializer benchmarks with, by default.'''
+
+
+def available_serializers(trusted=False):
+  '''Returns the serializers whose packages are installed. pickle is only
+  included if values come from `trusted` sources.'''
+  serializers = [json, fastjson, msgpack_serializer]
+  if trusted:
+    serializers.append(pickle_serializer)
+  return [s for s in serializers if getattr(s, 'available', True)]
+
+
+def fastest_serializer(sample=None, serializers=None, number=200):
+  '''Returns the fastest serializer that round-trips `sample` correctly.
+
+  Each candidate serializes and deserializes `sample` `number` times, and the
+  one taking the least time is returned.
+
+  Args:
+    sample: a value representative of those to store (default_sample).
+    serializers: candidates (the available_serializers() by default).
+    number: how many round-trips to time each serializer with.
+
+  Returns:
+    the fastest serializer.
+  '''
+  sample = default_sample if sample is None else sample
+  if serializers is None:
+    serializers = available_serializers()
+
+  timings = []
+  for serializer in serializers:
+    try:
+      if serializer.loads(serializer.dumps(sample)) != sample:
+        continue
+    except Exception:
+      continue
+
+    def round_trip():
+      serializer.loads(serializer.dumps(sample))
+
+    timings.append((min(timeit.repeat(round_trip, number=number, repeat=3)),
+        serializers.index(serializer)))
+
+  if not timings:
+    raise ValueError('no serializer round-trips %r.' % (sample,))
+  return serializers[min(timings)[1]]
+
+
+
+
+def loads_many(serializer, values):
+  '''Returns the list of `values` deserialized by `serializer`, with its
+  ``loads_many`` if it has one.'''
+  if hasattr(serializer, 'loads_many'):
+    return serializer.loads_many(values)
+  return [serializer.loads(value) for value in values]
+
+
+def supports_fields(serializer):
+  '''Returns whether `serializer` deserializes single fields (with
+  ``loads_fields``), rather than whole values only.'''
+  if isinstance(serializer, Stack):
+    return len(serializer) > 0 and supports_fields(serializer[0])
+  return hasattr(serializer, 'loads_fields') and callable(serializer.loads_fields)
+
+def query_fields(query):
+  '''Returns the set of fields the filters and orders of `query` look at, or
+  None if they extract them with a custom `object_getattr`.'''
+  fields = set()
+  for criterion in query.filters + query.orders:
+    if criterion.object_getattr is not Query.object_getattr:
+      return None
+    fields.add(criterion.field)
+  return fields
+
+
+
+def _module_loads(name):
+  return _Loads(importlib.import_module(name))
+
+def _stack_loads(loads):
+  return _Loads(Stack(l.serializer for l in loads))
+
+class _Loads(object):
+  '''Picklable ``serializer.loads``, to send to process pools. Modules are
+  pickled by name (within Stacks too), other serializers as they are.'''
+
+  def __init__(self, serializer):
+    self.serializer = serializer
+
+  def __call__(self, value):
+    return self.serializer.loads(value)
+
+  def __reduce__(self):
+    if isinstance(self.serializer, types.ModuleType):
+      return (_module_loads, (self.serializer.__name__,))
+    if isinstance(self.serializer, Stack):
+      return (_stack_loads, (map(_Loads, self.serializer),))
+    return (_Loads, (self.serializer,))
+
+
 
 def deserialized_gen(serializer, iterable):
   '''Generator that yields deserialized objects from `iterable`.'''
   for item in iterable:
     yield serializer.loads(item)
 
+def chunked_deserialized_gen(serializer, iterable, chunk_size=256, pool=None):
+  '''Generator that yields deserialized objects from `iterable`, read and
+  deserialized `chunk_size` at a time: with ``loads_many`` (see loads_many),
+  or in parallel on `pool` (a multiprocessing pool). A pool deserializes the
+  next chunk while the current one is consumed. With a process pool, the
+  serializer must be picklable (modules and top-level classes are).'''
+  iterator = iter(iterable)
+  loads = _Loads(serializer)
+  pending = None
+  while True:
+    chunk = list(itertools.islice(iterator, chunk_size))
+    if pool is None:
+      if not chunk:
+        break
+      for value in loads_many(serializer, chunk):
+        yield value
+      continue
+
+    submitted = pool.map_async(loads, chunk) if chunk else None
+    if pending is not None:
+      for value in pending.get():
+        yield value
+    if submitted is None:
+      break
+    pending = submitted
+
+def projected_gen(serializer, iterable, fields):
+  '''Generator that yields the objects in `iterable` with only `fields`
+  deserialized (see supports_fields), as LazyValues. Values that are not
+  mappings are deserialized in full.'''
+  for item in iterable:
+    try:
+      projection = serializer.loads_fields(item, fields)
+    except ValueError:
+      yield serializer.loads(item)
+      continue
+    yield _Projection(item, serializer, fields, projection)
+
+def lazy_gen(serializer, iterable):
+  '''Generator that yields LazyValues of the objects in `iterable`.'''
+  for item in iterable:
+    yield LazyValue(item, serializer)
+
 def serialized_gen(serializer, iterable):
   '''Generator that yields serialized objects from `iterable`.'''
   for item in iterable:
@@ -109,6 +436,218 @@ def serialized_gen(serializer, iterable):
 
 
 
+validation_sample = { 'value': 'serializer validation' }
+'''Value that serializers are validated (round-tripped) with.'''
+
+_validated = set()
+
+
+def validation_key(serializer):
+  '''Returns the key that validations of `serializer` are cached under: the
+  serializer itself for modules and classes, the class of other instances,
+  and the keys of their serializers for Stacks.'''
+  if isinstance(serializer, list):
+    return tuple(map(validation_key, serializer))
+  if isinstance(serializer, (type, types.ModuleType, types.ClassType)):
+    return serializer
+  return serializer.__class__
+
+
+def validation_serializer(serializer):
+  '''Returns the serializer validations of `serializer` round-trip through:
+  the result of its ``validation_copy`` method, for serializers with side
+  effects (e.g. SchemaSerializer persisting schemas), or `serializer`.'''
+  if isinstance(serializer, list):
+    return Stack(map(validation_serializer, serializer))
+  make_copy = getattr(serializer, 'validation_copy', None)
+  return make_copy() if make_copy is not None else serializer
+
+
+def validate_serializer(serializer, cache=True):
+  '''Ensures `serializer` round-trips a value, or raises AssertionError.
+  Successes are cached per serializer (see validation_key), unless `cache` is
+  False.'''
+  key = validation_key(serializer) if cache else None
+  if key is not None and key in _validated:
+    return
+
+  test = validation_sample
+  errstr = 'Serializer error: serialized value does not match original'
+  serializer = validation_serializer(serializer)
+  assert serializer.loads(serializer.dumps(test)) == test, errstr
+
+  if key is not None:
+    _validated.add(key)
+
+
+
+class LazyValue(object):
+  '''Proxy of a serialized value, deserialized when first used.
+
+  Query results only looked at by a filter that rejects most of them need
+  not all be deserialized in full: LazyValues defer the cost to whoever
+  uses the value. Items, containment, iteration, length, comparisons and
+  attributes go to the deserialized value. Use `resolve` to get it.
+  '''
+
+  __slots__ = ('_serialized', '_serializer', '_value', '_loaded')
+
+  def __init__(self, serialized, serializer):
+    self._serialized = serialized
+    self._serializer = serializer
+    self._value = None
+    self._loaded = False
+
+  def _lazy_load(self):
+    if not self._loaded:
+      self._value = self._serializer.loads(self._serialized)
+      self._serialized = None
+      self._loaded = True
+    return self._value
+
+  def __getattr__(self, name):
+    return getattr(self._lazy_load(), name)
+
+  def __getitem__(self, key):
+    return self._lazy_load()[key]
+
+  def __contains__(self, key):
+    return key in self._lazy_load()
+
+  def __iter__(self):
+    return iter(self._lazy_load())
+
+  def __len__(self):
+    return len(self._lazy_load())
+
+  def __eq__(self, other):
+    return self._lazy_load() == resolve(other)
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __lt__(self, other):
+    return self._lazy_load() < resolve(other)
+
+  def __repr__(self):
+    return 'LazyValue(%r)' % (self._lazy_load(),)
+
+
+class _Projection(LazyValue):
+  '''LazyValue of a mapping, some `fields` of which are already deserialized
+  (`projection`). Those are served without deserializing the rest.'''
+
+  __slots__ = ('_fields', '_projection')
+
+  def __init__(self, serialized, serializer, fields, projection):
+    super(_Projection, self).__init__(serialized, serializer)
+    self._fields = fields
+    self._projection = projection
+
+  def __getattr__(self, name):
+    # fields are items of mappings, not attributes.
+    if name in self._fields:
+      raise AttributeError(name)
+    return super(_Projection, self).__getattr__(name)
+
+  def __getitem__(self, key):
+    if key in self._fields and not self._loaded:
+      return self._projection[key]
+    return super(_Projection, self).__getitem__(key)
+
+  def __contains__(self, key):
+    if key in self._fields and not self._loaded:
+      return key in self._projection
+    return super(_Projection, self).__contains__(key)
+
+
+def resolve(value):
+  '''Returns the deserialized value of LazyValue `value`, or `value`.'''
+  if isinstance(value, LazyValue):
+    return value._lazy_load()
+  return value
+
+
+
+class ObjectCache(object):
+  '''LRU cache of deserialized objects, by key. Bounded by the number of
+  objects (`max_items`) and/or the total size of their serialized forms
+  (`max_bytes`); 0 leaves a bound off.
+
+  In 'copy' mode, each read returns a deep copy of the cached object, so
+  callers may modify what they get. In 'immutable' mode, the cached object
+  itself is returned, without copying: callers must not modify it.
+  '''
+
+  modes = ('copy', 'immutable')
+
+  def __init__(self, max_items=1024, max_bytes=0, mode='copy'):
+    if mode not in self.modes:
+      raise ValueError('cache mode must be one of %s.' % (self.modes,))
+    self.max_items = max_items
+    self.max_bytes = max_bytes
+    self.mode = mode
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    self.generation = 0 # incremented by invalidations.
+    self._objects = collections.OrderedDict() # key -> (object, size)
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    '''Returns the object cached for `key` (or a copy), or None.'''
+    with self._lock:
+      entry = self._objects.pop(key, None)
+      if entry is None:
+        self.misses += 1
+        return None
+      self._objects[key] = entry # most recently used.
+      self.hits += 1
+    return self.read(entry[0])
+
+  def read(self, obj):
+    '''Returns `obj` as readers get it: a copy, in 'copy' mode.'''
+    return copy.deepcopy(obj) if self.mode == 'copy' else obj
+
+  def put(self, key, obj, size, generation=None):
+    '''Caches `obj` for `key`, its serialized form being `size` bytes long.
+    Not cached if invalidations happened since `generation` (read before
+    the object was).'''
+    if self.max_bytes and size > self.max_bytes:
+      return
+    with self._lock:
+      if generation is not None and generation != self.generation:
+        return
+      old = self._objects.pop(key, None)
+      if old is not None:
+        self.size -= old[1]
+      self._objects[key] = (obj, size)
+      self.size += size
+      while (self.max_items and len(self._objects) > self.max_items) \
+          or (self.max_bytes and self.size > self.max_bytes):
+        _, (_, evicted) = self._objects.popitem(last=False)
+        self.size -= evicted
+
+  def invalidate(self, key):
+    '''Drops the object cached for `key`, if any.'''
+    with self._lock:
+      self.generation += 1
+      entry = self._objects.pop(key, None)
+      if entry is not None:
+        self.size -= entry[1]
+
+  def clear(self):
+    '''Drops every cached object.'''
+    with self._lock:
+      self.generation += 1
+      self._objects.clear()
+      self.size = 0
+
+  def __len__(self):
+    return len(self._objects)
+
+
+
 def monkey_patch_bson(bson=None):
   '''Patch bson in pymongo to use loads and dumps interface.'''
   if not bson:
@@ -141,23 +680,57 @@ class SerializerShimDatastore(ShimDatastore):
   # instance basis. If you plan to store mostly strings, use NonSerializer.
   serializer = default_serializer
 
-  def __init__(self, datastore, serializer=None):
+  def __init__(self, datastore, serializer=None, validate=None,
+               deserialize_chunk=0, deserialize_pool=None, lazy=False,
+               cache_items=0, cache_bytes=0, cache_mode='copy'):
     '''Initializes internals and tests the serializer.
 
     Args:
       datastore: a child datastore for the ShimDatastore superclass.
 
       serializer: a serializer object (responds to loads and dumps).
+
+      validate: whether to ensure the serializer round-trips a value: True
+        always does, False never does, and None (the default) does once per
+        serializer (see validate_serializer).
+
+      deserialize_chunk: number of query results to deserialize at a time
+        (see chunked_deserialized_gen). 0 deserializes them one by one.
+
+      deserialize_pool: a multiprocessing pool to deserialize query results
+        on, `deserialize_chunk` (or 256) at a time.
+
+      lazy: whether query results are LazyValues, deserialized on use.
+        Filters and orders read fields of every value they look at, so
+        those of filtered or ordered queries are deserialized in full as
+        they are listed (and returned as they are) unless the serializer
+        deserializes single fields (see supports_fields).
+
+      cache_items: number of objects ``get`` keeps deserialized (in an
+        ObjectCache), so getting them again skips the child and the
+        serializer. 0 (with `cache_bytes` 0) caches nothing.
+
+      cache_bytes: total serialized size of the objects ``get`` keeps
+        deserialized. 0 leaves the cache unbounded by size.
+
+      cache_mode: 'copy' to return copies of cached objects, 'immutable' to
+        return them as they are (see ObjectCache).
     '''
     super(SerializerShimDatastore, self).__init__(datastore)
+    self.deserialize_chunk = deserialize_chunk
+    self.deserialize_pool = deserialize_pool
+    self.lazy = lazy
+
+    self.cache = None
+    if cache_items or cache_bytes:
+      self.cache = ObjectCache(cache_items, cache_bytes, cache_mode)
 
     if serializer:
       self.serializer = serializer
 
     # ensure serializer works
-    test = { 'value': repr(self) }
-    errstr = 'Serializer error: serialized value does not match original'
-    assert self.serializer.loads(self.serializer.dumps(test)) == test, errstr
+    if validate is not False:
+      validate_serializer(self.serializer, cache=validate is None)
 
 
   def serializedValue(self, value):
@@ -182,8 +755,21 @@ class SerializerShimDatastore(ShimDatastore):
     '''
 
     ''''''
-    value = self.child_datastore.get(key)
-    return self.deserializedValue(value)
+    if self.cache is None:
+      value = self.child_datastore.get(key)
+      return self.deserializedValue(value)
+
+    value = self.cache.get(key)
+    if value is not None:
+      return value
+
+    generation = self.cache.generation
+    serialized = self.child_datastore.get(key)
+    if serialized is None:
+      return None
+    value = self.serializer.loads(serialized)
+    self.cache.put(key, value, len(serialized), generation)
+    return self.cache.read(value)
 
   def put(self, key, value):
     '''Stores the object `value` named by `key`.
@@ -197,6 +783,19 @@ class SerializerShimDatastore(ShimDatastore):
 
     value = self.serializedValue(value)
     self.child_datastore.put(key, value)
+    if self.cache is not None:
+      self.cache.invalidate(key)
+
+  def delete(self, key):
+    '''Removes the object named by `key`, from the ``child_datastore`` (and
+    from the cache of deserialized objects).
+
+    Args:
+      key: Key naming the object to remove.
+    '''
+    self.child_datastore.delete(key)
+    if self.cache is not None:
+      self.cache.invalidate(key)
 
   def query(self, query):
     '''Returns an iterable of objects matching criteria expressed in `query`
@@ -205,6 +804,14 @@ class SerializerShimDatastore(ShimDatastore):
     iteration over results does not finish (subject to order generator
     constraint).
 
+    The child datastore cannot filter or order serialized values, so queries
+    with filters or orders are applied here instead: the child only lists
+    the collection. With serializers that support it (see supports_fields),
+    only the fields the query looks at are deserialized until a value passes
+    the filters, and values are deserialized in full as they are returned
+    (or on use, if `lazy`). Otherwise, every value listed is deserialized in
+    full, `lazy` or not.
+
     Args:
       query: Query object describing the objects to return.
 
@@ -212,13 +819,70 @@ class SerializerShimDatastore(ShimDatastore):
       iterable cursor with all objects matching criteria
     '''
 
-    # run the query on the child datastore
-    cursor = self.child_datastore.query(query)
+    if not query.filters and not query.orders:
+      # run the query on the child datastore
+      cursor = self.child_datastore.query(query)
+
+      # chain the deserializing generator to the cursor's result set iterable
+      cursor._iterable = self._deserialized_gen(cursor._iterable)
+      return cursor
+
+    values = self.child_datastore.query(Query(query.key))
+    fields = query_fields(query)
+    if fields is not None and supports_fields(self.serializer):
+      values = projected_gen(self.serializer, values, fields)
+    else:
+      # filters read fields from whole values: there is nothing to defer.
+      values = self._deserialized_gen(values, lazy=False)
+
+    cursor = query(values)
+    if not self.lazy:
+      cursor._iterable = itertools.imap(resolve, cursor._iterable)
+    return cursor
 
-    # chain the deserializing generator to the cursor's result set iterable
-    cursor._iterable = deserialized_gen(self.serializer, cursor._iterable)
+  def _deserialized_gen(self, iterable, lazy=True):
+    '''Returns the generator deserializing query results from `iterable`, as
+    LazyValues if `lazy` (and this datastore is).'''
+    if lazy and self.lazy:
+      return lazy_gen(self.serializer, iterable)
+    if self.deserialize_pool is not None or self.deserialize_chunk:
+      return chunked_deserialized_gen(self.serializer, iterable,
+          self.deserialize_chunk or 256, self.deserialize_pool)
+    return deserialized_gen(self.serializer, iterable)
 
-    return cursor
+  def get_stream(self, key):
+    '''Returns a file-like object reading the object named by `key`, or None.
+
+    Streams carry values as serialized by serializers that do not stream
+    (e.g. json text), and chunk-wise through those that do (e.g. compression
+    at the end of a Stack). Without streaming serializers, the child's stream
+    is returned as is.
+
+    Args:
+      key: Key naming the object to retrieve.
+
+    Returns:
+      file-like object or None
+    '''
+    stream = self.child_datastore.get_stream(key)
+    if stream is None \
+        or not Serializer.implements_stream_interface(self.serializer):
+      return stream
+    return ChunkStream(self.serializer.loads_stream(iter_chunks(stream)))
+
+  def put_stream(self, key, stream):
+    '''Stores the object read from `stream`, named by `key`, serializing it
+    chunk-wise with streaming serializers (see get_stream).
+
+    Args:
+      key: Key naming the object.
+      stream: a file-like object, or an iterable of string chunks.
+    '''
+    if Serializer.implements_stream_interface(self.serializer):
+      stream = ChunkStream(self.serializer.dumps_stream(iter_chunks(stream)))
+    self.child_datastore.put_stream(key, stream)
+    if self.cache is not None:
+      self.cache.invalidate(key)
 
 
 
@@ -233,6 +897,25 @@ def shim(datastore, serializer=None):
   '''
   return SerializerShimDatastore(datastore, serializer=serializer)
 
+
+def shim_factory(serializer=None, **kwargs):
+  '''Return a function wrapping datastores with SerializerShimDatastores that
+  share `serializer`, validated once, here (and any other SerializerShim-
+  Datastore arguments). Cheap enough to build shims per request or per
+  tenant::
+
+      make_shim = datastore.serialize.shim_factory(json)
+      tenant_store = make_shim(tenant_child_store)
+
+  '''
+  serializer = serializer or SerializerShimDatastore.serializer
+  validate_serializer(serializer)
+
+  def factory(datastore):
+    return SerializerShimDatastore(datastore, serializer, validate=False,
+        **kwargs)
+  return factory
+
 '''
 Hello World:
 
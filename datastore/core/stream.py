@@ -0,0 +1,102 @@
+
+chunk_size = 64 * 1024
+'''Size of the chunks read from file-like objects while streaming.'''
+
+
+
+def chunk_bytes(chunk):
+  '''Returns `chunk` (a string, buffer, memoryview or bytearray) as a string.'''
+  if isinstance(chunk, str):
+    return chunk
+  if isinstance(chunk, memoryview):
+    return chunk.tobytes()
+  return str(chunk)
+
+
+def iter_chunks(stream, size=chunk_size):
+  '''Generator over the chunks of `stream`, which is a file-like object (read
+  `size` bytes at a time), a string or buffer (one chunk), or an iterable of
+  chunks. Chunks come out as they went in: they are not copied.'''
+  if hasattr(stream, 'read'):
+    while True:
+      chunk = stream.read(size)
+      if not chunk:
+        break
+      yield chunk
+
+  elif isinstance(stream, (basestring, buffer, memoryview, bytearray)):
+    if len(stream):
+      yield stream
+
+  else:
+    for chunk in stream:
+      if len(chunk):
+        yield chunk
+
+
+def read_all(stream):
+  '''Returns the whole contents of `stream` (see iter_chunks) as a string.'''
+  if isinstance(stream, str):
+    return stream
+  return ''.join(chunk_bytes(chunk) for chunk in iter_chunks(stream))
+
+
+
+class ChunkStream(object):
+  '''Read-only file-like object over an iterable of chunks.
+
+  Lets chunk generators (e.g. from streaming serializers) be passed wherever a
+  file-like object is expected. Iterating over it yields the remaining chunks
+  as they are, without re-chunking them.
+
+      >>> stream = ChunkStream(['abc', 'def'])
+      >>> stream.read(4)
+      'abcd'
+      >>> stream.read()
+      'ef'
+
+  '''
+
+  def __init__(self, chunks):
+    self._chunks = iter_chunks(chunks)
+    self._buffer = ''
+    self.closed = False
+
+  def read(self, size=-1):
+    '''Reads up to `size` bytes (or everything left, if `size` is negative).'''
+    if size is None or size < 0:
+      data = self._buffer + ''.join(map(chunk_bytes, self._chunks))
+      self._buffer = ''
+      return data
+
+    parts = [self._buffer]
+    have = len(self._buffer)
+    while have < size:
+      chunk = next(self._chunks, None)
+      if chunk is None:
+        break
+      parts.append(chunk_bytes(chunk))
+      have += len(chunk)
+
+    data = ''.join(parts)
+    self._buffer = data[size:]
+    return data[:size]
+
+  def __iter__(self):
+    if self._buffer:
+      buffered, self._buffer = self._buffer, ''
+      yield buffered
+    for chunk in self._chunks:
+      yield chunk
+
+  def close(self):
+    '''Closes the stream (and the generator of chunks beneath it).'''
+    self._chunks.close()
+    self._buffer = ''
+    self.closed = True
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
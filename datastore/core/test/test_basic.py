@@ -1,8 +1,10 @@
 
 import unittest
 import logging
+import threading
 
 from ..basic import DictDatastore
+from ..basic import ConcurrentDictDatastore
 from ..key import Key
 from ..query import Query
 
@@ -143,6 +145,60 @@ class TestDictionaryDatastore(TestDatastore):
 
 
 
+class TestConcurrentDictDatastore(TestDatastore):
+
+  def test_simple(self):
+    self.subtest_simple([ConcurrentDictDatastore(),
+        ConcurrentDictDatastore(stripes=1)])
+
+  def test_atomic_operations(self):
+    ds = ConcurrentDictDatastore()
+    key = Key('/a/b:c')
+
+    self.assertTrue(ds.put_if_absent(key, 1))
+    self.assertFalse(ds.put_if_absent(key, 2))
+    self.assertEqual(ds.get(key), 1)
+
+    self.assertFalse(ds.compare_and_swap(key, 2, 3))
+    self.assertTrue(ds.compare_and_swap(key, 1, 3))
+    self.assertEqual(ds.get(key), 3)
+    self.assertTrue(ds.compare_and_swap(key, 3, None))
+    self.assertFalse(ds.contains(key))
+    self.assertEqual(ds._items, {}) # empty collections are dropped.
+    self.assertTrue(ds.compare_and_swap(key, None, 4))
+    self.assertEqual(ds.get(key), 4)
+
+  def test_threads(self):
+    ds = ConcurrentDictDatastore(stripes=4)
+    counter = Key('/counter')
+
+    def work(n):
+      for i in range(0, 200):
+        while True:
+          value = ds.get(counter) or 0
+          if ds.compare_and_swap(counter, value or None, value + 1):
+            break
+        ds.put(Key('/t%d/item:%d' % (n, i)), i)
+        ds.delete(Key('/t%d/item:%d' % (n, i - 1)))
+
+    threads = [threading.Thread(target=work, args=(n,)) for n in range(0, 8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual(ds.get(counter), 1600)
+    for n in range(0, 8):
+      results = list(ds.query(Query(Key('/t%d/item' % n))))
+      self.assertEqual(results, [199])
+
+    # queries see a snapshot of their collection.
+    cursor = ds.query(Query(Key('/t0/item')))
+    ds.put(Key('/t0/item:x'), 'later')
+    self.assertEqual(list(cursor), [199])
+
+
+
 class TestCacheShimDatastore(TestDatastore):
 
   def test_simple(self):
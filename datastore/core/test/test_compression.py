@@ -0,0 +1,120 @@
+
+import unittest
+
+from ..key import Key
+from ..basic import DictDatastore
+from ..serialize import SerializerShimDatastore, Stack
+from ..stream import read_all
+from ..compression import *
+from test_basic import TestDatastore
+
+import json
+import pickle
+import threading
+
+
+
+class TestCompression(TestDatastore):
+
+  def installed(self):
+    return [cls for cls in compressors.values() if cls.available]
+
+  def test_round_trips(self):
+    small = 'small'
+    large = json.dumps([{'value': i, 'name': 'value %d' % i}
+        for i in range(0, 200)])
+
+    for cls in self.installed():
+      compressor = cls(threshold=64)
+      self.assertEqual(compressor.dumps(small), raw_header + small)
+      self.assertEqual(compressor.loads(compressor.dumps(small)), small)
+
+      compressed = compressor.dumps(large)
+      self.assertEqual(compressed[:1], cls.header)
+      self.assertTrue(len(compressed) < len(large) / 3)
+      self.assertEqual(compressor.loads(compressed), large)
+
+      chunks = list(compressor.dumps_stream([large[:1000], large[1000:]]))
+      self.assertEqual(''.join(compressor.loads_stream(chunks)), large)
+      self.assertEqual(compressor.loads(''.join(chunks)), large)
+      self.assertEqual(''.join(compressor.loads_stream([raw_header + small])),
+          small)
+      self.assertEqual(''.join(compressor.loads_stream(['', ''] + chunks)),
+          large)
+
+  def test_mixed_codecs(self):
+    value = 'mixed ' * 100
+    installed = [cls() for cls in self.installed()]
+    for writer in installed:
+      for reader in installed:
+        self.assertEqual(reader.loads(writer.dumps(value)), value)
+
+    self.assertRaises(ValueError, zlib_compressor().loads, '?garbage')
+
+  def test_shim(self):
+    for cls in self.installed():
+      stack = Stack([json, cls(threshold=16)])
+      self.subtest_simple([SerializerShimDatastore(DictDatastore(), stack)])
+
+      ds = SerializerShimDatastore(DictDatastore(), stack)
+      ds.put_stream(Key('/a'), ['[1, ', '2, 3]'])
+      self.assertEqual(ds.get(Key('/a')), [1, 2, 3])
+      self.assertEqual(ds.child_datastore.get(Key('/a'))[:1], cls.header)
+      ds.put(Key('/b'), range(0, 100))
+      self.assertEqual(json.loads(read_all(ds.get_stream(Key('/b')))),
+          range(0, 100))
+
+  def test_zstd_dictionary(self):
+    if not zstd_compressor.available:
+      return
+
+    samples = [json.dumps({'name': 'user%d' % i, 'email': 'user%d@host' % i,
+        'active': i % 2 == 0, 'groups': ['staff', 'users']})
+        for i in range(0, 1000)]
+    dictionary = zstd_compressor.train_dictionary(samples, size=4096)
+
+    plain = zstd_compressor(threshold=0)
+    trained = zstd_compressor(threshold=0, dictionary=dictionary)
+    total = lambda c: sum(len(c.dumps(s)) for s in samples[:100])
+    self.assertTrue(total(trained) < total(plain) / 2)
+
+    restored = zstd_compressor(dictionary=dictionary.as_bytes())
+    for sample in samples[:100]:
+      self.assertEqual(restored.loads(trained.dumps(sample)), sample)
+
+    # other compressors decode with the dictionary once given it.
+    value = trained.dumps(samples[0])
+    self.assertRaises(ValueError, plain.loads, value)
+    self.assertRaises(ValueError, zlib_compressor().loads, value)
+    reader = zlib_compressor().add_decoder(restored)
+    self.assertEqual(reader.loads(value), samples[0])
+    self.assertEqual(restored.loads(plain.dumps(samples[0])), samples[0])
+
+  def test_zstd_threads(self):
+    if not zstd_compressor.available:
+      return
+
+    compressor = zstd_compressor(threshold=0)
+    values = [json.dumps(range(i, i + 200)) for i in range(0, 8)]
+    codecs, errors = [], []
+    def run(value):
+      try:
+        codecs.append(compressor._codec())
+        for _ in range(0, 200):
+          assert compressor.loads(compressor.dumps(value)) == value
+      except Exception, e:
+        errors.append(e)
+    threads = [threading.Thread(target=run, args=(v,)) for v in values]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual(errors, [])
+    self.assertEqual(len(set(id(c[0]) for c in codecs)), len(values))
+    restored = pickle.loads(pickle.dumps(compressor))
+    self.assertEqual(restored.loads(compressor.dumps(values[0])), values[0])
+
+
+if __name__ == '__main__':
+  unittest.main()
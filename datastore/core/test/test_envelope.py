@@ -0,0 +1,177 @@
+
+import unittest
+
+from ..key import Key
+from ..basic import DictDatastore, ConcurrentDictDatastore
+from ..serialize import pickle_serializer, msgpack_serializer, Stack
+from ..compression import zlib_compressor
+from ..schema import SchemaSerializer
+from ..envelope import *
+from test_basic import TestDatastore
+
+import json
+import time
+import threading
+
+
+
+class TestEnvelope(TestDatastore):
+
+  def envelope(self, current=('pickle', 1)):
+    return Envelope({('json', 1): json, ('pickle', 1): pickle_serializer},
+        current=current, legacy=json)
+
+  def test_envelope(self):
+    envelope = self.envelope()
+    value = {'a': [1, 2]}
+
+    serialized = envelope.dumps(value)
+    self.assertEqual(envelope.codec(serialized), ('pickle', 1))
+    self.assertTrue(envelope.is_current(serialized))
+    self.assertEqual(envelope.loads(serialized), value)
+
+    old = self.envelope(current=('json', 1)).dumps(value)
+    self.assertEqual(envelope.codec(old), ('json', 1))
+    self.assertFalse(envelope.is_current(old))
+    self.assertEqual(envelope.loads(old), value)
+
+    legacy = json.dumps(value)
+    self.assertEqual(envelope.codec(legacy), None)
+    self.assertEqual(envelope.loads(legacy), value)
+
+    envelope.register('json', 2, json)
+    self.assertEqual(envelope.codec(envelope.header(('json', 2)) + '[]'),
+        ('json', 2))
+    self.assertRaises(ValueError, Envelope({('json', 1): json},
+        ('json', 1)).loads, legacy)
+    self.assertRaises(ValueError, envelope.loads,
+        Envelope({('x', 1): json}, ('x', 1)).dumps(value))
+    self.assertRaises(ValueError, Envelope, {}, ('json', 1))
+    self.assertRaises(ValueError, Envelope, {('json', 1): json}, ('json', 1),
+        legacy=msgpack_serializer)
+    self.assertEqual(envelope.codec('\xfe'), None)
+
+    # legacy serializers are told by what their values may start with.
+    for legacy in [pickle_serializer, Stack([json]),
+        Stack([msgpack_serializer, zlib_compressor()])]:
+      Envelope({('json', 1): json}, ('json', 1), legacy=legacy)
+    for legacy in [Stack([json, msgpack_serializer]), SchemaSerializer(),
+        Stack([SchemaSerializer()]), Stack(), object()]:
+      self.assertRaises(ValueError, Envelope, {('json', 1): json},
+          ('json', 1), legacy=legacy)
+    self.assertEqual(envelope.codec(envelope_magic + '\x00\x01\x08js'), None)
+
+  def test_shim(self):
+    self.subtest_simple([EnvelopeShimDatastore(DictDatastore(),
+        self.envelope())])
+
+    child = DictDatastore()
+    key = Key('/a')
+    child.put(key, json.dumps({'a': 1}))
+
+    ds = EnvelopeShimDatastore(child, self.envelope())
+    self.assertEqual(ds.get(key), {'a': 1})
+    self.assertEqual(child.get(key), json.dumps({'a': 1}))
+
+    ds.reencode = True
+    self.assertEqual(ds.get(key), {'a': 1})
+    self.assertTrue(ds.serializer.is_current(child.get(key)))
+    self.assertEqual(ds.get(key), {'a': 1})
+    self.assertEqual(ds.reencoded, 1)
+
+  def test_rewrite_races(self):
+    for child in [DictDatastore(), ConcurrentDictDatastore()]:
+      key = Key('/a')
+      child.put(key, json.dumps({'a': 1}))
+      ds = EnvelopeShimDatastore(child, self.envelope(), reencode=True)
+
+      # a value written since it was read is not rewritten.
+      self.assertFalse(ds._rewrite(key, json.dumps({'a': 0}), {'a': 0}))
+      self.assertEqual(child.get(key), json.dumps({'a': 1}))
+      self.assertTrue(ds._rewrite(key, json.dumps({'a': 1}), {'a': 1}))
+      self.assertTrue(ds.serializer.is_current(child.get(key)))
+      self.assertFalse(ds.migrate(key))
+
+  def test_write_lock(self):
+    child = DictDatastore()
+    keys = [Key('/a/%d' % i) for i in range(0, 10)]
+    for key in keys:
+      child.put(key, json.dumps({'a': 1}))
+
+    # writes are not locked while no rewrite can race them.
+    ds = EnvelopeShimDatastore(ConcurrentDictDatastore(), self.envelope(),
+        reencode=True)
+    ds.child_datastore.put(keys[0], json.dumps({'a': 1}))
+    self.assertEqual(ds.get(keys[0]), {'a': 1})
+    self.assertEqual(ds.reencoded, 1)
+    self.assertFalse(ds._lock_writes)
+
+    ds = EnvelopeShimDatastore(child, self.envelope())
+    ds.put(keys[0], {'a': 2})
+    ds.delete(keys[0])
+    self.assertEqual(ds.get(keys[1]), {'a': 1})
+    self.assertFalse(ds._lock_writes)
+
+    # the first rewrite waits for writes in progress, then locks writes.
+    writing, written = threading.Event(), threading.Event()
+    put = child.put
+    def slow_put(key, value):
+      if key == keys[2]:
+        writing.set()
+        time.sleep(0.05)
+        written.set()
+      put(key, value)
+    child.put = slow_put
+    writer = threading.Thread(target=ds.put, args=(keys[2], {'a': 2}))
+    writer.start()
+    writing.wait()
+    self.assertTrue(ds.migrate(keys[1]))
+    self.assertTrue(written.is_set())
+    self.assertTrue(ds._lock_writes)
+    writer.join()
+
+    self.assertTrue(ds.migrate(keys[3]))
+    ds.put(keys[4], {'a': 2})
+    self.assertEqual([ds.get(k) for k in keys[1:5]],
+        [{'a': 1}, {'a': 2}, {'a': 1}, {'a': 2}])
+    self.assertEqual(ds._unlocked_writes, set())
+
+  def test_cache(self):
+    child = DictDatastore()
+    key = Key('/a')
+    child.put(key, json.dumps({'a': 1}))
+    ds = EnvelopeShimDatastore(child, self.envelope(), reencode=True,
+        cache_items=10)
+
+    self.assertEqual(ds.get(key), {'a': 1})
+    self.assertEqual(ds.reencoded, 1)
+    self.assertEqual(ds.get(key), {'a': 1})
+    self.assertEqual(ds.cache.hits, 1)
+    ds.put(key, {'a': 2})
+    self.assertEqual(ds.get(key), {'a': 2})
+
+  def test_migrator(self):
+    child = DictDatastore()
+    old = EnvelopeShimDatastore(child, self.envelope(current=('json', 1)))
+    keys = [Key('/a/%d' % i) for i in range(0, 100)]
+    for i, key in enumerate(keys):
+      if i % 2:
+        old.put(key, {'value': i})
+      else:
+        child.put(key, json.dumps({'value': i}))
+
+    ds = EnvelopeShimDatastore(child, self.envelope())
+    migrator = Migrator(ds, keys + [Key('/a/missing')])
+    migrator.start()
+    migrator.join()
+    self.assertEqual(migrator.migrated, 100)
+    self.assertEqual(migrator.scanned, 101)
+    self.assertEqual(Migrator(ds, keys).run(), 0)
+
+    for i, key in enumerate(keys):
+      self.assertTrue(ds.serializer.is_current(child.get(key)))
+      self.assertEqual(ds.get(key), {'value': i})
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -4,6 +4,7 @@ import random
 
 from ..key import Key
 from ..key import Namespace
+from ..key import sort_key, collection_prefix
 
 
 def randomString():
@@ -129,6 +130,15 @@ class KeyTests(unittest.TestCase):
       keys.add(random)
     self.assertEqual(len(keys), 1000)
 
+  def test_sort_key(self):
+    keys = [Key('/a/b:2'), Key('/a/b:1/c:1'), Key('/a/b:1'), Key('/a/c:1')]
+    self.assertEqual(sorted(keys, key=sort_key),
+        [Key('/a/b:1'), Key('/a/b:2'), Key('/a/b:1/c:1'), Key('/a/c:1')])
+    self.assertTrue(sort_key(Key('/a/b:1')).startswith(
+        collection_prefix(Key('/a/b'))))
+    self.assertFalse(sort_key(Key('/a/b:1/c:1')).startswith(
+        collection_prefix(Key('/a/b'))))
+
 
 if __name__ == '__main__':
   unittest.main()
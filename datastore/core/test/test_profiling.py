@@ -0,0 +1,75 @@
+
+import os
+import unittest
+
+from ..key import Key
+from ..basic import DictDatastore
+from ..serialize import SerializerShimDatastore
+from ..profiling import *
+from test_basic import TestDatastore
+
+
+
+class TestProfilingDatastore(TestDatastore):
+
+  def test_simple(self):
+    profiler = Profiler(slowest=5)
+    s1 = ProfilingDatastore(DictDatastore(), profiler=profiler)
+    s2 = ProfilingDatastore(DictDatastore(), profiler=Profiler(enabled=True))
+    self.subtest_simple([s1, s2])
+
+  def test_disabled(self):
+    profiler = Profiler(slowest=5, enabled=False)
+    ds = ProfilingDatastore(DictDatastore(), profiler=profiler)
+    ds.put(Key('/a'), 'a')
+    self.assertEqual(ds.get(Key('/a')), 'a')
+    self.assertEqual(profiler.totals, {})
+    self.assertEqual(profiler.slowest_calls(), [])
+
+  def test_environ(self):
+    os.environ[profile_environ] = '3'
+    try:
+      profiler = Profiler()
+    finally:
+      del os.environ[profile_environ]
+
+    self.assertTrue(profiler.enabled)
+    self.assertEqual(profiler.slowest, 3)
+    self.assertFalse(Profiler().enabled)
+
+  def test_slowest(self):
+    profiler = Profiler(slowest=3)
+    dict_ds = DictDatastore()
+    ds = ProfilingDatastore(SerializerShimDatastore(
+        ProfilingDatastore(dict_ds, profiler=profiler)), profiler=profiler)
+
+    with profiler.active():
+      for i in range(0, 20):
+        ds.put(Key('/%d' % i), {'value': i})
+        self.assertEqual(ds.get(Key('/%d' % i)), {'value': i})
+    self.assertFalse(profiler.enabled)
+
+    # outer and inner calls are attributed to their own datastore classes.
+    self.assertEqual(profiler.totals[('SerializerShimDatastore', 'put')][0], 20)
+    self.assertEqual(profiler.totals[('SerializerShimDatastore', 'get')][0], 20)
+    self.assertEqual(profiler.totals[('DictDatastore', 'put')][0], 20)
+    self.assertEqual(profiler.totals[('DictDatastore', 'get')][0], 20)
+
+    # only outermost calls are sampled, and only the slowest are kept.
+    calls = profiler.slowest_calls()
+    self.assertEqual(len(calls), 3)
+    self.assertEqual(calls, sorted(calls, key=lambda c: -c.duration))
+    for call in calls:
+      self.assertEqual(call.datastore, 'SerializerShimDatastore')
+
+    report = profiler.report()
+    self.assertTrue('SerializerShimDatastore.put' in report)
+    self.assertTrue('DictDatastore.get' in report)
+    self.assertTrue('hot spots' in report)
+
+    profiler.reset()
+    self.assertEqual(profiler.slowest_calls(), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
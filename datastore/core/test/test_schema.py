@@ -0,0 +1,110 @@
+
+import unittest
+
+from ..key import Key
+from ..basic import DictDatastore
+from ..query import Query
+from ..serialize import SerializerShimDatastore, Stack, supports_fields
+from ..schema import *
+from test_basic import TestDatastore
+
+import json
+import collections
+
+
+
+class TestSchema(TestDatastore):
+
+  def users(self, count=100):
+    return [{'name': 'user%d' % i, 'email': 'user%d@host' % i,
+        'active': i % 2 == 0, 'groups': ['staff']} for i in range(0, count)]
+
+  def test_round_trips(self):
+    serializer = SchemaSerializer()
+    for value in self.users() + [[1, 2], 'text', 3, {1: 'a'}, {}]:
+      self.assertEqual(serializer.loads(serializer.dumps(value)), value)
+
+    users = self.users()
+    fields = ('active', 'email', 'groups', 'name')
+    self.assertEqual(serializer.fields(schema_id(fields)), fields)
+    self.assertEqual(len(serializer._schemas), 2) # users, and {}.
+
+    # field names are stored once, not in every value.
+    schema_size = sum(len(serializer.dumps(v)) for v in users)
+    json_size = sum(len(json.dumps(v)) for v in users)
+    self.assertTrue(schema_size < json_size * 0.6)
+
+    # schemas evolve as fields are added.
+    value = dict(users[0], age=42)
+    self.assertEqual(serializer.loads(serializer.dumps(value)), value)
+    self.assertEqual(len(serializer._schemas), 3)
+
+    unknown = schema_header.pack(123) + serializer.dumps([1])[4:]
+    self.assertRaises(ValueError, serializer.loads, unknown)
+
+  def test_persisted_schemas(self):
+    schemas = DictDatastore()
+    writer = SchemaSerializer(schemas)
+    serialized = [writer.dumps(v) for v in self.users()]
+    self.assertEqual(len(list(schemas.query(Query(Key('/schemas'))))), 1)
+
+    reader = SchemaSerializer(schemas)
+    self.assertEqual([reader.loads(v) for v in serialized], self.users())
+    self.assertRaises(ValueError, SchemaSerializer().loads, serialized[0])
+
+    # validating a shim persists no schema.
+    schemas = DictDatastore()
+    SerializerShimDatastore(DictDatastore(), SchemaSerializer(schemas),
+        validate=True)
+    SerializerShimDatastore(DictDatastore(),
+        Stack([SchemaSerializer(schemas)]), validate=True)
+    self.assertEqual(len(list(schemas.query(Query(Key('/schemas'))))), 0)
+
+  def test_persisted_collisions(self):
+    schemas = DictDatastore()
+    fields = ('active', 'email', 'groups', 'name')
+    key = SchemaSerializer(schemas).schema_key(schema_id(fields))
+
+    # a schema persisted by another process is reused, not overwritten.
+    serializer = SchemaSerializer(schemas)
+    self.assertEqual(serializer.register(fields), schema_id(fields))
+    self.assertEqual(serializer.register(reversed(fields)), schema_id(fields))
+
+    # a colliding schema persisted elsewhere is detected.
+    schemas.put(key, json.dumps(['other']))
+    serializer = SchemaSerializer(schemas)
+    self.assertRaises(ValueError, serializer.register, fields)
+    self.assertRaises(ValueError, serializer.dumps, self.users(1)[0])
+    self.assertEqual(json.loads(schemas.get(key)), ['other'])
+
+  def test_orders_cache(self):
+    serializer = SchemaSerializer()
+    serializer.max_orders = 4
+    fields = ['f%d' % i for i in range(0, 8)]
+    for i in range(0, len(fields)):
+      order = fields[i:] + fields[:i] # same fields, in another order.
+      value = collections.OrderedDict((f, f) for f in order)
+      self.assertEqual(serializer.loads(serializer.dumps(value)), value)
+      self.assertTrue(len(serializer._orders) <= 4)
+    self.assertEqual(len(serializer._schemas), 1)
+
+  def test_shim(self):
+    serializer = SchemaSerializer(DictDatastore())
+    self.assertTrue(supports_fields(serializer))
+    self.subtest_simple([SerializerShimDatastore(DictDatastore(), serializer)])
+
+    ds = SerializerShimDatastore(DictDatastore(), serializer)
+    for i, user in enumerate(self.users()):
+      ds.put(Key('/User:%d' % i), user)
+
+    value = serializer.dumps(self.users()[4])
+    self.assertEqual(serializer.loads_fields(value, set(['name', 'x'])),
+        {'name': 'user4'})
+
+    query = Query(Key('/User')).filter('name', '>', 'user95').order('-name')
+    self.assertEqual([u['name'] for u in ds.query(query)],
+        ['user99', 'user98', 'user97', 'user96'])
+
+
+if __name__ == '__main__':
+  unittest.main()
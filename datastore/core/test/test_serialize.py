@@ -3,11 +3,13 @@ import unittest
 
 from ..key import Key
 from ..basic import DictDatastore
+from ..query import Query
 from ..serialize import *
 from test_basic import TestDatastore
 
 import pickle
 import bson
+import multiprocessing
 
 monkey_patch_bson(bson)
 
@@ -104,6 +106,317 @@ class TestSerialize(TestDatastore):
     self.subtest_serializer_shim(Stack([json, map_serializer, bson]))
     self.subtest_serializer_shim(Stack([json, map_serializer, bson, pickle]))
 
+    self.subtest_serializer_shim(fastjson)
+    self.subtest_serializer_shim(pickle_serializer)
+    if msgpack_serializer.available:
+      self.subtest_serializer_shim(msgpack_serializer)
+
+
+  def test_fast_serializers(self):
+    value = {'bytes': '\xff\x00', 'tuple': (1, 2), 'set': set([3])}
+    self.assertEqual(pickle_serializer.loads(pickle_serializer.dumps(value)),
+        value)
+
+    if msgpack_serializer.available:
+      value = {'bytes': '\xff\x00', u'text': u'\u2603', 'list': [1, 2.5]}
+      packed = msgpack_serializer.loads(msgpack_serializer.dumps(value))
+      self.assertEqual(packed, value)
+      self.assertTrue(isinstance(packed['bytes'], str))
+      self.assertTrue(isinstance(packed[u'text'], unicode))
+
+    value = {'a': [1, 2.5, None, True], 'b': u'\u2603'}
+    self.assertEqual(fastjson.loads(fastjson.dumps(value)), value)
+    self.assertTrue(isinstance(fastjson.dumps(value), str))
+
+    self.assertTrue(pickle_serializer not in available_serializers())
+    self.assertTrue(pickle_serializer in available_serializers(trusted=True))
+
+
+  def test_fastest_serializer(self):
+    serializer = fastest_serializer(number=10)
+    self.assertTrue(serializer in available_serializers())
+
+    # only serializers that round-trip the sample qualify.
+    sample = {'tuple': (1, 2)}
+    serializer = fastest_serializer(sample, number=10,
+        serializers=available_serializers(trusted=True))
+    self.assertEqual(serializer, pickle_serializer)
+
+    self.assertRaises(ValueError, fastest_serializer, sample, [json])
+
+
+  def test_validation(self):
+    class broken(Serializer):
+      calls = 0
+
+      @classmethod
+      def loads(cls, value):
+        cls.calls += 1
+        return {}
+
+      @classmethod
+      def dumps(cls, value):
+        return ''
+
+    self.assertRaises(AssertionError, SerializerShimDatastore,
+        DictDatastore(), broken)
+    SerializerShimDatastore(DictDatastore(), broken, validate=False)
+    self.assertEqual(broken.calls, 1)
+
+    class counting(NonSerializer):
+      calls = 0
+
+      @classmethod
+      def loads(cls, value):
+        cls.calls += 1
+        return value
+
+    # validated once per serializer, unless asked to validate every time.
+    for _ in range(0, 3):
+      SerializerShimDatastore(DictDatastore(), Stack([counting, counting]))
+    self.assertEqual(counting.calls, 2)
+    SerializerShimDatastore(DictDatastore(), counting, validate=True)
+    self.assertEqual(counting.calls, 3)
+
+    self.assertEqual(validation_key(json), json)
+    self.assertEqual(validation_key(Stack([json, counting])), (json, counting))
+    self.assertEqual(validation_key(Stack([json])), validation_key([json]))
+
+    make_shim = shim_factory(Stack([counting]))
+    self.assertEqual(counting.calls, 4)
+    shims = [make_shim(DictDatastore()) for _ in range(0, 3)]
+    self.assertEqual(counting.calls, 4)
+    self.assertTrue(shims[0].serializer is shims[2].serializer)
+    self.subtest_simple(shims)
+    self.assertRaises(AssertionError, shim_factory, broken)
+
+
+  def test_batched_deserialization(self):
+    values = [{'value': i, 'name': 'value %d' % i} for i in range(0, 1000)]
+    serialized = map(json.dumps, values)
+
+    self.assertEqual(loads_many(json, serialized), values)
+    self.assertEqual(loads_many(Stack([json]), serialized), values)
+    self.assertEqual(list(chunked_deserialized_gen(json, serialized, 64)),
+        values)
+
+    if msgpack_serializer.available:
+      packed = map(msgpack_serializer.dumps, values)
+      self.assertEqual(msgpack_serializer.loads_many(packed), values)
+      self.assertRaises(ValueError, msgpack_serializer.loads_many,
+          [packed[0] + packed[1]])
+
+    pool = multiprocessing.Pool(2)
+    try:
+      for serializer in [json, pickle_serializer, Stack([json])]:
+        chunks = [serializer.dumps(v) for v in values]
+        self.assertEqual(list(chunked_deserialized_gen(serializer, chunks, 100,
+            pool)), values)
+      self.assertEqual(list(chunked_deserialized_gen(json, [], 100, pool)), [])
+    finally:
+      pool.terminate()
+
+    # deserialized in chunks, counted as returned when consumed.
+    child = DictDatastore()
+    for ds in [SerializerShimDatastore(child, json, deserialize_chunk=16),
+               SerializerShimDatastore(child, json, lazy=True)]:
+      for value in values:
+        ds.put(Key('/v/%d' % value['value']), value)
+
+      cursor = ds.query(Query(Key('/v'), limit=100, offset=10))
+      results = [resolve(v) for v in cursor]
+      self.assertEqual(len(results), 100)
+      self.assertEqual(cursor.returned, 100)
+      self.assertEqual(cursor.skipped, 10)
+      self.assertTrue(all(v in values for v in results))
+
+  def test_lazy_value(self):
+    class counting(object):
+      calls = 0
+
+      @classmethod
+      def loads(cls, value):
+        cls.calls += 1
+        return json.loads(value)
+
+    value = {'value': 1, 'names': ['a', 'b']}
+    lazy = LazyValue(json.dumps(value), counting)
+    self.assertEqual(counting.calls, 0)
+    self.assertEqual(lazy['value'], 1)
+    self.assertTrue('names' in lazy)
+    self.assertEqual(len(lazy), 2)
+    self.assertEqual(sorted(lazy), ['names', 'value'])
+    self.assertEqual(lazy.get('names'), ['a', 'b'])
+    self.assertEqual(lazy, value)
+    self.assertEqual(resolve(lazy), value)
+    self.assertEqual(resolve(value), value)
+    self.assertEqual(counting.calls, 1)
+
+    # filters and orders see through LazyValues.
+    lazies = [LazyValue(json.dumps({'value': i}), json) for i in range(0, 10)]
+    query = Query(Key('/')).filter('value', '>=', 5).order('-value')
+    self.assertEqual([v['value'] for v in query(lazies)], range(9, 4, -1))
+
+
+  def test_query_fields(self):
+    values = [{'value': i, 'name': 'value %d' % i, 'tags': ['a'] * 20}
+        for i in range(0, 100)]
+
+    query = Query(Key('/v'), limit=5, offset=2).filter('value', '>=', 50)
+    query.order('-value')
+    self.assertEqual(query_fields(query), set(['value']))
+    self.assertEqual(query_fields(Query(Key('/v'))), set())
+    custom = Query(Key('/v'), object_getattr=lambda obj, field: obj[field])
+    self.assertEqual(query_fields(custom.filter('value', '>', 1)), None)
+
+    self.assertFalse(supports_fields(json))
+    self.assertFalse(supports_fields(Stack([json, NonSerializer])))
+
+    serializers = [json, Stack([json]), pickle_serializer]
+    if msgpack_serializer.available:
+      self.assertTrue(supports_fields(msgpack_serializer))
+      self.assertTrue(supports_fields(Stack([msgpack_serializer,
+          NonSerializer])))
+      self.assertEqual(msgpack_serializer.loads_fields(
+          msgpack_serializer.dumps(values[3]), set(['value', 'other'])),
+          {'value': 3})
+      serializers.append(msgpack_serializer)
+
+    for serializer in serializers:
+      for lazy in [False, True]:
+        ds = SerializerShimDatastore(DictDatastore(), serializer, lazy=lazy)
+        for value in values:
+          ds.put(Key('/v/%d' % value['value']), value)
+
+        cursor = ds.query(query)
+        results = list(cursor)
+        self.assertEqual(results, values[97:92:-1])
+        self.assertEqual(cursor.returned, 5)
+        self.assertEqual(cursor.skipped, 2)
+
+  def test_query_partial_decode(self):
+    if not msgpack_serializer.available:
+      return
+
+    class counting(msgpack_serializer):
+      calls = 0
+
+      @classmethod
+      def loads(cls, value):
+        cls.calls += 1
+        return msgpack_serializer.loads(value)
+
+    ds = SerializerShimDatastore(DictDatastore(), counting, validate=False)
+    for i in range(0, 100):
+      ds.put(Key('/v/%d' % i), {'value': i, 'payload': 'x' * 100})
+
+    query = Query(Key('/v')).filter('value', '<', 10)
+    results = list(ds.query(query))
+    self.assertEqual(sorted(r['value'] for r in results), range(0, 10))
+    self.assertEqual(counting.calls, 10) # only survivors are decoded in full.
+
+    # lazily, filtered results are decoded on use only.
+    ds.lazy = True
+    counting.calls = 0
+    results = list(ds.query(query))
+    self.assertTrue(all(isinstance(r, LazyValue) for r in results))
+    self.assertEqual(counting.calls, 0)
+    self.assertEqual(sorted(r['payload'] for r in results), ['x' * 100] * 10)
+    self.assertEqual(counting.calls, 10)
+
+    # without field support, filters decode every value: none are deferred.
+    class counting_json(object):
+      calls = 0
+
+      @classmethod
+      def loads(cls, value):
+        cls.calls += 1
+        return json.loads(value)
+
+      @classmethod
+      def dumps(cls, value):
+        return json.dumps(value)
+
+    ds = SerializerShimDatastore(DictDatastore(), counting_json,
+        validate=False, lazy=True)
+    for i in range(0, 100):
+      ds.put(Key('/v/%d' % i), {'value': i, 'payload': 'x' * 100})
+    results = list(ds.query(query.order('value')))
+    self.assertEqual([r['value'] for r in results], range(0, 10))
+    self.assertFalse(any(isinstance(r, LazyValue) for r in results))
+    self.assertEqual(counting_json.calls, 100)
+
+    # values that are not mappings are decoded in full.
+    items = list(projected_gen(counting, [counting.dumps([1, 2])], ['value']))
+    self.assertEqual(items, [[1, 2]])
+    self.assertEqual(counting.calls, 11)
+
+
+  def test_object_cache(self):
+    cache = ObjectCache(max_items=2)
+    cache.put(Key('/a'), {'a': 1}, 10)
+    cache.put(Key('/b'), {'b': 1}, 10)
+    self.assertEqual(cache.get(Key('/a')), {'a': 1})
+    cache.put(Key('/c'), {'c': 1}, 10) # evicts /b, least recently used.
+    self.assertEqual(cache.get(Key('/b')), None)
+    self.assertEqual(len(cache), 2)
+    self.assertEqual(cache.size, 20)
+
+    cache = ObjectCache(max_items=0, max_bytes=25)
+    cache.put(Key('/a'), 'a', 10)
+    cache.put(Key('/b'), 'b', 10)
+    cache.put(Key('/c'), 'c', 10)
+    cache.put(Key('/d'), 'd', 100) # larger than the cache.
+    self.assertEqual([cache.get(Key(k)) for k in '/a', '/b', '/c', '/d'],
+        [None, 'b', 'c', None])
+
+    generation = cache.generation
+    cache.invalidate(Key('/b'))
+    cache.put(Key('/b'), 'stale', 1, generation)
+    self.assertEqual(cache.get(Key('/b')), None)
+    self.assertRaises(ValueError, ObjectCache, mode='frozen')
+
+  def test_serializer_shim_cache(self):
+    class counting(object):
+      calls = 0
+
+      @classmethod
+      def loads(cls, value):
+        cls.calls += 1
+        return json.loads(value)
+
+      @classmethod
+      def dumps(cls, value):
+        return json.dumps(value)
+
+    key = Key('/a')
+    ds = SerializerShimDatastore(DictDatastore(), counting, validate=False,
+        cache_items=10)
+    self.subtest_simple([SerializerShimDatastore(DictDatastore(), json,
+        cache_items=10)])
+
+    ds.put(key, {'a': [1]})
+    for _ in range(0, 5):
+      value = ds.get(key)
+      self.assertEqual(value, {'a': [1]})
+      value['a'].append(2) # copies: the cached object is unchanged.
+    self.assertEqual(counting.calls, 1)
+    self.assertEqual(ds.cache.hits, 4)
+
+    ds.put(key, {'a': [3]})
+    self.assertEqual(ds.get(key), {'a': [3]})
+    self.assertEqual(counting.calls, 2)
+    ds.put_stream(key, '{"a": [4]}')
+    self.assertEqual(ds.get(key), {'a': [4]})
+    ds.delete(key)
+    self.assertEqual(ds.get(key), None)
+    self.assertEqual(ds.cache.size, 0)
+
+    ds = SerializerShimDatastore(DictDatastore(), json, cache_items=10,
+        cache_mode='immutable')
+    ds.put(key, {'a': [1]})
+    self.assertTrue(ds.get(key) is ds.get(key))
+
 
   def test_has_interface_check(self):
     self.assertTrue(hasattr(Serializer, 'implements_serializer_interface'))
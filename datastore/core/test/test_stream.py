@@ -0,0 +1,113 @@
+
+import zlib
+import unittest
+import StringIO
+
+from ..key import Key
+from ..basic import DictDatastore, ShimDatastore, KeyTransformDatastore
+from ..basic import TieredDatastore, ShardedDatastore, SymlinkDatastore
+from ..serialize import SerializerShimDatastore, Stack, NonSerializer
+from ..stream import *
+from test_basic import TestDatastore
+
+import json
+
+
+
+class zlib_stream(object):
+  '''Streaming-only serializer for tests.'''
+
+  @classmethod
+  def loads(cls, value):
+    return zlib.decompress(value)
+
+  @classmethod
+  def dumps(cls, value):
+    return zlib.compress(value)
+
+  @classmethod
+  def loads_stream(cls, chunks):
+    decompressor = zlib.decompressobj()
+    for chunk in chunks:
+      yield decompressor.decompress(chunk)
+    yield decompressor.flush()
+
+  @classmethod
+  def dumps_stream(cls, chunks):
+    compressor = zlib.compressobj()
+    for chunk in chunks:
+      yield compressor.compress(chunk)
+    yield compressor.flush()
+
+
+
+class TestStream(TestDatastore):
+
+  def test_chunks(self):
+    self.assertEqual(list(iter_chunks('abc')), ['abc'])
+    self.assertEqual(list(iter_chunks('')), [])
+    self.assertEqual(list(iter_chunks(['ab', '', 'c'])), ['ab', 'c'])
+    self.assertEqual(list(iter_chunks(StringIO.StringIO('abcde'), 2)),
+        ['ab', 'cd', 'e'])
+    self.assertEqual(read_all([buffer('ab'), memoryview('cd'), 'e']), 'abcde')
+
+    stream = ChunkStream(['abc', 'def', 'g'])
+    self.assertEqual(stream.read(2), 'ab')
+    self.assertEqual(stream.read(3), 'cde')
+    self.assertEqual(list(stream), ['f', 'g'])
+    self.assertEqual(stream.read(), '')
+
+    with ChunkStream(iter(['abc', 'def'])) as stream:
+      self.assertEqual(stream.read(), 'abcdef')
+    self.assertTrue(stream.closed)
+
+  def subtest_streams(self, ds, value='x' * 100000):
+    key = Key('/a/b:c')
+    self.assertEqual(ds.get_stream(key), None)
+
+    ds.put_stream(key, StringIO.StringIO(value))
+    self.assertEqual(read_all(ds.get_stream(key)), value)
+    ds.put_stream(key, ['chunk1', 'chunk2'])
+    self.assertEqual(ds.get_stream(key).read(), 'chunk1chunk2')
+
+    ds.delete(key)
+    self.assertEqual(ds.get_stream(key), None)
+
+  def test_datastores(self):
+    self.subtest_streams(DictDatastore())
+    self.subtest_streams(ShimDatastore(DictDatastore()))
+    self.subtest_streams(KeyTransformDatastore(DictDatastore(),
+        keytransform=lambda key: key.reverse))
+    self.subtest_streams(SymlinkDatastore(DictDatastore()))
+    self.subtest_streams(TieredDatastore([DictDatastore(), DictDatastore()]))
+    self.subtest_streams(ShardedDatastore([DictDatastore(), DictDatastore()]))
+
+  def test_serializer_shim(self):
+    child = DictDatastore()
+    key = Key('/a')
+
+    # without streaming serializers, streams carry the serialized value.
+    ds = SerializerShimDatastore(child, serializer=json)
+    ds.put_stream(key, ['{"a": ', '[1, 2]}'])
+    self.assertEqual(ds.get(key), {'a': [1, 2]})
+    ds.put(key, {'b': 1})
+    self.assertEqual(json.loads(read_all(ds.get_stream(key))), {'b': 1})
+
+    # streaming serializers apply chunk-wise.
+    stack = Stack([json, zlib_stream])
+    self.assertEqual(stack.stream_serializers(), [zlib_stream])
+    self.assertEqual(Stack([zlib_stream, json]).stream_serializers(), [])
+    self.assertEqual(Stack([NonSerializer, zlib_stream]).stream_serializers(),
+        [NonSerializer, zlib_stream])
+
+    ds = SerializerShimDatastore(child, serializer=stack)
+    self.subtest_streams(ds, value=json.dumps(range(0, 10000)))
+    ds.put_stream(key, ['{"a": ', '[1, 2]}'])
+    self.assertEqual(ds.get(key), {'a': [1, 2]})
+    self.assertEqual(zlib.decompress(child.get(key)), '{"a": [1, 2]}')
+    ds.put(key, {'b': 1})
+    self.assertEqual(ds.get_stream(key).read(), '{"b": 1}')
+
+
+if __name__ == '__main__':
+  unittest.main()
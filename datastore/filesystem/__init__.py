@@ -10,7 +10,26 @@ Tested with:
 '''
 
 import os
+import mmap
+import stat
+import zlib
+import errno
+import struct
+import thread
+import collections
+import threading
+import multiprocessing.pool
 import datastore.core
+from datastore.core.util import fasthash
+from datastore.core.stream import ChunkStream, iter_chunks
+
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir # backport, for python < 3.5
+  except ImportError:
+    scandir = None
 
 
 def ensure_directory_exists(directory):
@@ -18,11 +37,218 @@ def ensure_directory_exists(directory):
   Raises RuntimeError if `directory` is a file.
   '''
   if not os.path.exists(directory):
-    os.makedirs(directory)
+    try:
+      os.makedirs(directory)
+    except OSError, e:
+      if e.errno != errno.EEXIST or not os.path.isdir(directory):
+        raise # made by someone else meanwhile is fine.
   elif os.path.isfile(directory):
     raise RuntimeError('Path %s is a file, not a directory.' % directory)
 
 
+def fsync_path(path):
+  '''fsyncs the file or directory at `path`.'''
+  fd = os.open(path, os.O_RDONLY)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+
+def write_all(fd, value):
+  '''Writes all of string (or buffer) `value` to file descriptor `fd`.'''
+  view = value if isinstance(value, memoryview) else buffer(value)
+  while len(view):
+    view = view[os.write(fd, view):]
+
+
+def write_file(path, value, sync=False, chunk_size=1024 * 1024):
+  '''Writes `value` to a new file at `path`, optionally fsyncing it. `value`
+  is a string, a buffer, an iterable of chunks, or a file-like object to copy
+  `chunk_size` bytes at a time.'''
+  fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+  try:
+    for chunk in iter_chunks(value, chunk_size):
+      write_all(fd, chunk)
+    if sync:
+      os.fsync(fd)
+  finally:
+    os.close(fd)
+
+
+def read_file(path, mmap_threshold=None):
+  '''Reads the whole file at `path` with raw os.open/os.read calls, sizing the
+  read from fstat. Returns None if there is no file at `path`, and raises
+  RuntimeError if it is a directory.
+
+  Files of at least `mmap_threshold` bytes are not read at all, but mapped:
+  a read-only mmap of the file is returned instead of a string. It holds a
+  file descriptor until it is closed, so close it when done.
+  '''
+  try:
+    fd = os.open(path, os.O_RDONLY)
+  except OSError, e:
+    if e.errno in (errno.ENOENT, errno.ENOTDIR):
+      return None
+    raise
+
+  try:
+    info = os.fstat(fd)
+    if stat.S_ISDIR(info.st_mode):
+      raise RuntimeError('%s is a directory, not a file.' % path)
+
+    if mmap_threshold is not None and info.st_size >= max(mmap_threshold, 1):
+      return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+
+    # read in as few calls as possible, without assuming the size is exact.
+    chunks = []
+    size = max(info.st_size, 4096)
+    while True:
+      chunk = os.read(fd, size)
+      if not chunk:
+        break
+      chunks.append(chunk)
+  finally:
+    os.close(fd)
+
+  return chunks[0] if len(chunks) == 1 else ''.join(chunks)
+
+
+pack_header = struct.Struct('>IHi')
+'''Header of pack records: crc32 of name and value, name size, and value size
+(-1 for deletions).'''
+
+
+
+class _Pack(object):
+  '''A pack file holding the small objects of one directory, and its index.
+
+  Pack files are logs of (name, value) records, appended to by puts and
+  deletes. The index maps names to the offsets of their latest values, and is
+  rebuilt by scanning the file when the pack is first used. Reads share one
+  file descriptor, opened on the first one and reopened after compactions.
+  Callers hold `lock` while using a pack, and drop packs once `removed`.
+  '''
+
+  def __init__(self, path):
+    self.path = path
+    self.index = {} # name -> (value offset, value size, record size)
+    self.size = 0
+    self.dead = 0   # bytes of records superseded or deleted.
+    self.removed = False # whether the pack file was removed (pack dropped).
+    self.lock = threading.RLock()
+    self._fd = None # read descriptor, see get.
+    self._load()
+
+  def _load(self):
+    try:
+      with open(self.path, 'rb') as f:
+        data = f.read()
+    except IOError, e:
+      if e.errno in (errno.ENOENT, errno.ENOTDIR):
+        return
+      raise
+
+    offset = 0
+    while offset + pack_header.size <= len(data):
+      crc, name_size, value_size = pack_header.unpack_from(data, offset)
+      start = offset + pack_header.size
+      end = start + name_size + max(value_size, 0)
+      if end > len(data) or zlib.crc32(data[start:end]) & 0xffffffff != crc:
+        break
+      name = data[start:start + name_size]
+      self._apply(name, start + name_size, value_size, end - offset)
+      offset = end
+
+    if offset < len(data): # torn tail, from a crash mid-append.
+      with open(self.path, 'r+b') as f:
+        f.truncate(offset)
+    self.size = offset
+
+  def _apply(self, name, offset, value_size, record_size):
+    old = self.index.pop(name, None)
+    if old:
+      self.dead += old[2]
+    if value_size < 0:
+      self.dead += record_size
+    else:
+      self.index[name] = (offset, value_size, record_size)
+
+  def dead_ratio(self):
+    return float(self.dead) / self.size if self.size else 0.0
+
+  def get(self, name):
+    entry = self.index.get(name)
+    if entry is None:
+      return None
+
+    offset, size, _ = entry
+    if self._fd is None:
+      self._fd = os.open(self.path, os.O_RDONLY)
+    os.lseek(self._fd, offset, os.SEEK_SET)
+    chunks = []
+    while size > 0:
+      chunk = os.read(self._fd, size)
+      if not chunk:
+        raise IOError('pack %s is truncated.' % self.path)
+      chunks.append(chunk)
+      size -= len(chunk)
+    return ''.join(chunks)
+
+  def close(self):
+    '''Closes the read descriptor, if open (the next get reopens it).'''
+    if self._fd is not None:
+      os.close(self._fd)
+      self._fd = None
+
+  def append(self, name, value, sync=False):
+    '''Appends a record of `value` (None to delete) named `name`.'''
+    value_size = -1 if value is None else len(value)
+    value = value or ''
+    data = name + value
+    record = pack_header.pack(zlib.crc32(data) & 0xffffffff, len(name),
+        value_size) + data
+
+    fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0666)
+    try:
+      view = buffer(record)
+      while view:
+        view = view[os.write(fd, view):]
+      if sync:
+        os.fsync(fd)
+    finally:
+      os.close(fd)
+
+    self._apply(name, self.size + pack_header.size + len(name), value_size,
+        len(record))
+    self.size += len(record)
+
+  def compact(self, sync=False):
+    '''Rewrites the pack with only its live records.'''
+    with open(self.path, 'rb') as f:
+      data = f.read()
+
+    records = []
+    for name in sorted(self.index):
+      offset, size, _ = self.index[name]
+      value = data[offset:offset + size]
+      records.append(pack_header.pack(zlib.crc32(name + value) & 0xffffffff,
+          len(name), size) + name + value)
+
+    tmp = '%s.%d.%d.tmp' % (self.path, os.getpid(), thread.get_ident())
+    write_file(tmp, ''.join(records), sync)
+    os.rename(tmp, self.path)
+    self.close() # reads the old file, otherwise.
+
+    self.index, self.size, self.dead = {}, 0, 0
+    for record in records:
+      _, name_size, size = pack_header.unpack_from(record)
+      name = record[pack_header.size:pack_header.size + name_size]
+      self._apply(name, self.size + pack_header.size + name_size, size,
+          len(record))
+      self.size += len(record)
+
+
 
 class FileSystemDatastore(datastore.Datastore):
   '''Simple flat-file datastore.
@@ -66,6 +292,61 @@ class FileSystemDatastore(datastore.Datastore):
       /data/Comedy/MontyPython/Sketch/CheeseShop.obj
       /data/Comedy/MontyPython/Sketch/CheeseShop/
 
+    Objects are written to a temporary file next to their final path, which is
+    then renamed over it. Renames are atomic, so readers only ever see whole
+    objects. How much survives a power loss depends on the `durability` mode:
+
+      * 'none': nothing is fsynced; the OS flushes writes when it sees fit.
+        A crash may leave recent objects empty or torn.
+      * 'file': every put fsyncs its file and directory before returning.
+      * 'group': every put fsyncs its file before the rename, so a crash
+        leaves either the old or the new object whole. Renames (directories)
+        are fsynced together, `group_size` puts at a time (and on `flush` or
+        `close`). Puts since the last group may be lost.
+
+    Directories known to exist are cached, so puts do not stat them again.
+    Reads open objects directly, without checking for them first.
+
+    With `recursive_queries`, a query returns every object under
+    `path(query.key)`, in nested directories too, rather than only those
+    directly within it. The tree is listed by `walk_threads` threads at once,
+    and objects stream out as their directories are listed: in no particular
+    order, or -- with `sorted_walk` -- depth-first, sorted by path.
+
+    With `prefetch`, queries keep that many object reads in flight on a pool
+    of threads, ahead of the consumer, while still returning objects in order.
+
+    With `pack_threshold`, objects smaller than that many bytes are not stored
+    in their own files, but appended to a pack file in their directory
+    (`.pack`), saving a block and an inode each. Directories keep the same
+    layout, and larger objects still get `.obj` files. Pack indexes are
+    cached in memory, so packing assumes no other process writes to the same
+    tree. Packs are compacted once over `pack_compaction_ratio` of them is
+    superseded or deleted records (or by `compact_packs`).
+
+    With `fanout` levels, objects are spread over `fanout_width` bucket
+    directories per level, picked by a hash of their name, so no directory
+    grows without bound. For example, with `fanout=2`::
+
+      /data/Comedy/MontyPython/Actor/3f.fan/a2.fan/JohnCleese.obj
+
+    Only object files move into buckets: collection directories (and so
+    queries, which walk the buckets) are unchanged. The layout of a tree is
+    fixed once written: open it with the same `fanout` and `fanout_width`.
+
+    `get_buffer` returns objects of at least `mmap_threshold` bytes as
+    read-only memory maps of their file, rather than strings, so they are
+    neither copied nor held in memory twice (`get` and queries always return
+    strings). Objects are replaced by rename, so a map keeps seeing the value
+    it was read with. Each map holds a file descriptor: close it when done.
+    Large objects can also be read and written as streams, with `get_stream`
+    and `put_stream`, without ever being held in memory as a string.
+
+    Directories left empty by deletes are removed (up to the root) when
+    `prune_directories` is 'inline', right after each delete, or 'deferred',
+    in batches of `prune_batch` on a background thread (and on `prune` or
+    `close`). `sweep_directories` removes every empty directory in a tree.
+
 
   Hello World:
 
@@ -86,13 +367,56 @@ class FileSystemDatastore(datastore.Datastore):
   '''
 
   object_extension = '.obj'
+  temporary_extension = '.tmp'
+  pack_name = '.pack'
+  bucket_extension = '.fan'
+  prune_modes = (None, 'inline', 'deferred')
+  prune_batch = 1024
+  pack_compaction_ratio = 0.5
   ignore_list = list()
-
-  def __init__(self, root, case_sensitive=True):
+  durability_modes = ('none', 'file', 'group')
+  key_lock_stripes = 64
+  max_pack_misses = 4096
+
+  def __init__(self, root, case_sensitive=True, durability='none',
+               group_size=128, fast_reads=False, recursive_queries=False,
+               sorted_walk=False, walk_threads=8, prefetch=0,
+               pack_threshold=None, fanout=0, fanout_width=256,
+               prune_directories=None, mmap_threshold=None):
     '''Initialize the datastore with given root directory `root`.
 
     Args:
       root: A path at which to mount this filesystem datastore.
+
+      durability: one of 'none', 'file' or 'group' (see class docs).
+
+      group_size: number of puts fsynced together with 'group' durability.
+
+      fast_reads: whether to read objects with raw os.open/os.read calls
+          rather than python file objects.
+
+      recursive_queries: whether queries include objects in subdirectories.
+
+      sorted_walk: whether recursive queries return objects sorted by path.
+
+      walk_threads: number of threads listing directories in recursive
+          queries.
+
+      prefetch: number of object reads queries keep in flight (0 to read
+          each object only when it is reached).
+
+      pack_threshold: size in bytes under which objects are stored in pack
+          files rather than their own (None to never pack).
+
+      fanout: number of levels of hashed bucket directories objects are
+          spread over (0 for none).
+
+      fanout_width: number of buckets per fanout level.
+
+      prune_directories: None, 'inline' or 'deferred' (see class docs).
+
+      mmap_threshold: size in bytes from which `get_buffer` maps objects
+          into memory (None never maps them).
     '''
     root = os.path.normpath(root)
 
@@ -100,10 +424,51 @@ class FileSystemDatastore(datastore.Datastore):
       errstr = 'root path must not be empty (\'.\' for current directory)'
       raise ValueError(errstr)
 
+    if durability not in self.durability_modes:
+      errstr = 'durability must be one of %s, not %r.'
+      raise ValueError(errstr % (', '.join(self.durability_modes), durability))
+
+    if prune_directories not in self.prune_modes:
+      errstr = 'prune_directories must be one of %s, not %r.'
+      raise ValueError(errstr % (self.prune_modes, prune_directories))
+
     ensure_directory_exists(root)
 
     self.root_path = root
     self.case_sensitive = bool(case_sensitive)
+    self.durability = durability
+    self.group_size = group_size
+    self.fast_reads = bool(fast_reads)
+    self.recursive_queries = bool(recursive_queries)
+    self.sorted_walk = bool(sorted_walk)
+    self.walk_threads = walk_threads
+    self.prefetch = prefetch
+    self.pack_threshold = pack_threshold
+    self.fanout = fanout
+    self.fanout_width = fanout_width
+    self.prune_directories = prune_directories
+    self.mmap_threshold = mmap_threshold
+
+    self._packs = {} # directory -> _Pack, for packs on disk.
+    self._pack_misses = set() # directories known to have no pack.
+    self._pack_lock = threading.Lock() # guards _packs; packs have their own.
+    self._key_locks = [threading.Lock() for _ in range(self.key_lock_stripes)]
+
+    self._prune_pending = set() # directories to prune ('deferred' mode).
+    self._prune_lock = threading.Lock()
+    self._prune_run_lock = threading.Lock() # one prune at a time.
+    self._pruning = False
+
+    self._pools = {} # (name, size) -> ThreadPool, shared by queries.
+    self._pools_lock = threading.Lock()
+
+    self._known_directories = set([root])
+    # 'group' mode: files written but not yet fsynced, directories renamed
+    # into but not yet fsynced, and the number of writes since the last flush.
+    self._pending = []
+    self._pending_directories = set()
+    self._pending_writes = 0
+    self._pending_lock = threading.Lock()
 
 
   # object pathing
@@ -123,7 +488,21 @@ class FileSystemDatastore(datastore.Datastore):
 
   def relative_object_path(self, key):
     '''Returns the relative path for object pointed by `key`.'''
-    return self.relative_path(key) + self.object_extension
+    path = self.relative_path(key)
+    if self.fanout:
+      directory, name = os.path.split(path)
+      path = os.path.join(directory, *(self.buckets(name) + [name]))
+    return path + self.object_extension
+
+  def buckets(self, name):
+    '''Returns the fanout bucket directory names for object `name`.'''
+    digits = len('%x' % (self.fanout_width - 1))
+    value = fasthash.hash(name) & 0xffffffffffffffff
+    buckets = []
+    for _ in range(0, self.fanout):
+      value, bucket = divmod(value, self.fanout_width)
+      buckets.append('%0*x%s' % (digits, bucket, self.bucket_extension))
+    return buckets
 
   def object_path(self, key):
     '''return the object path for `key`.'''
@@ -132,31 +511,519 @@ class FileSystemDatastore(datastore.Datastore):
 
   # object IO
 
-  def _write_object(self, path, value):
-    '''write out `object` to file at `path`'''
-    ensure_directory_exists(os.path.dirname(path))
+  def _ensure_directory(self, directory):
+    '''Ensures `directory` exists, unless it is already known to.'''
+    if directory not in self._known_directories:
+      ensure_directory_exists(directory)
+      self._known_directories.add(directory)
 
-    with open(path, 'w') as f:
-      f.write(value)
+  def _write_object(self, path, value):
+    '''write out `object` to file at `path`, atomically.'''
+    directory = os.path.dirname(path)
+
+    # unique per writing thread, so concurrent puts do not share a temp file.
+    tmp = '%s.%d.%d%s' % (path, os.getpid(), thread.get_ident(),
+        self.temporary_extension)
+    sync = self.durability != 'none' # whole before the rename.
+
+    try:
+      try:
+        self._ensure_directory(directory)
+        write_file(tmp, value, sync)
+      except OSError, e:
+        if e.errno != errno.ENOENT:
+          raise
+        # the directory (or a parent) was removed behind our back, e.g. by a
+        # prune racing with its creation.
+        self._known_directories.discard(directory)
+        self._ensure_directory(directory)
+        write_file(tmp, value, sync)
+
+      os.rename(tmp, path)
+    except Exception:
+      self._remove_object(tmp) # e.g. out of space: leave no partial file.
+      raise
+
+    self._persist(path)
+
+  def _persist(self, path, renamed=True, synced=True):
+    '''Applies the durability mode to the file at `path`, just written.
+    `renamed` is whether its directory changed, too, and `synced` whether the
+    file was fsynced already (always, with 'file' durability).'''
+    if self.durability == 'file':
+      if renamed:
+        try:
+          fsync_path(os.path.dirname(path))
+        except OSError, e:
+          if e.errno != errno.ENOENT: # pruned since; nothing to persist.
+            raise
+    elif self.durability == 'group':
+      with self._pending_lock:
+        if not synced:
+          self._pending.append(path)
+        if renamed:
+          self._pending_directories.add(os.path.dirname(path))
+        self._pending_writes += 1
+        full = self._pending_writes >= self.group_size
+      if full:
+        self.flush()
+
+  def flush(self):
+    '''fsyncs the pack files written, and the directories objects were
+    renamed into, since the last flush. Only needed with 'group' durability
+    (which fsyncs object files before renaming them).'''
+    with self._pending_lock:
+      pending, self._pending = self._pending, []
+      directories, self._pending_directories = self._pending_directories, set()
+      self._pending_writes = 0
+
+    for path in sorted(set(pending)) + sorted(directories):
+      try:
+        fsync_path(path)
+      except OSError, e:
+        if e.errno != errno.ENOENT: # deleted since; nothing to persist.
+          raise
+
+  def close(self):
+    '''Flushes any objects not yet fsynced, prunes any directories left
+    empty by deletes, and stops the query thread pools.'''
+    self.flush()
+    self.prune()
+
+    with self._pools_lock:
+      pools, self._pools = self._pools.values(), {}
+    for pool in pools:
+      pool.terminate()
+      pool.join()
+
+    with self._pack_lock:
+      packs = self._packs.values()
+    for pack in packs:
+      with pack.lock:
+        pack.close()
+
+
+  # empty directories
+
+  def _prune_directory(self, directory):
+    '''Removes `directory` and then its parents, up to (but excluding) the
+    root, for as long as they are empty.'''
+    root = self.root_path + os.sep
+    while directory.startswith(root):
+      self._known_directories.discard(directory)
+      try:
+        os.rmdir(directory)
+      except OSError, e:
+        if e.errno != errno.ENOENT: # not empty, or otherwise not removable.
+          return
+      directory = os.path.dirname(directory)
+
+  def _deleted_from(self, directory):
+    '''Notes that an object was deleted from `directory`.'''
+    if self.prune_directories == 'inline':
+      self._prune_directory(directory)
+
+    elif self.prune_directories == 'deferred':
+      with self._prune_lock:
+        self._prune_pending.add(directory)
+        start = not self._pruning and \
+            len(self._prune_pending) >= self.prune_batch
+        if start:
+          self._pruning = True
+
+      if start:
+        pruner = threading.Thread(target=self._prune_in_background)
+        pruner.daemon = True
+        pruner.start()
+
+  def _prune_in_background(self):
+    try:
+      self.prune()
+    finally:
+      with self._prune_lock:
+        self._pruning = False
+
+  def prune(self):
+    '''Prunes the directories left empty by deletes not yet pruned (with
+    'deferred' pruning), once any prune in progress (e.g. in the background)
+    is done.'''
+    with self._prune_run_lock:
+      with self._prune_lock:
+        pending, self._prune_pending = self._prune_pending, set()
+
+      # deepest first, so parents are emptied before they are tried.
+      for directory in sorted(pending, reverse=True):
+        self._prune_directory(directory)
+
+  def sweep_directories(self):
+    '''Removes every empty directory under the root (e.g. left by deletes
+    without pruning). Returns the number of directories removed.'''
+    removed = 0
+    for directory, _, _ in os.walk(self.root_path, topdown=False):
+      if directory == self.root_path:
+        continue
+      try:
+        os.rmdir(directory)
+      except OSError, e:
+        if e.errno not in (errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT):
+          raise
+        continue
+      self._known_directories.discard(directory)
+      removed += 1
+    return removed
+
+
+  def _remove_object(self, path):
+    '''removes the object file at `path`, if any. Returns whether it did.'''
+    try:
+      os.remove(path)
+      return True
+    except OSError, e:
+      if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+        raise
+      return False
 
   def _read_object(self, path):
     '''read in object from file at `path`'''
-    if not os.path.exists(path):
+    if self.fast_reads:
+      return read_file(path)
+
+    try:
+      f = open(path, 'rb')
+    except IOError, e:
+      if e.errno in (errno.ENOENT, errno.ENOTDIR):
+        return None
+      if e.errno == errno.EISDIR:
+        raise RuntimeError('%s is a directory, not a file.' % path)
+      raise
+
+    with f:
+      return f.read()
+
+  def _packed_objects(self, directory):
+    '''Returns the names of the objects packed in `directory`, and a reference
+    to read each with.'''
+    if self.pack_threshold is None:
+      return {}
+
+    pack = self._pack(directory)
+    if pack is None:
+      return {}
+    with pack.lock:
+      return dict((name, (pack, name)) for name in pack.index)
+
+  def _object_paths(self, directory):
+    '''Generator over the paths of objects directly within `directory`,
+    listed lazily (with scandir, when available). Packed objects come first,
+    as (pack, name) references rather than paths. Fanout buckets are listed
+    in turn.'''
+    extension = self.object_extension
+    buckets = self.bucket_extension if self.fanout else None
+    ignore = set(self.ignore_list)
+
+    packed = self._packed_objects(directory)
+    for name in sorted(packed):
+      yield packed[name]
+    ignore.update(name + extension for name in packed)
+
+    try:
+      if scandir is None:
+        entries = None
+        names = os.listdir(directory)
+      else:
+        entries = scandir(directory)
+    except OSError, e:
+      if e.errno in (errno.ENOENT, errno.ENOTDIR):
+        return
+      raise
+
+    if entries is None:
+      for name in names:
+        if buckets and name.endswith(buckets):
+          for path in self._object_paths(os.path.join(directory, name)):
+            yield path
+        elif name.endswith(extension) and name not in ignore:
+          yield os.path.join(directory, name)
+      return
+
+    for entry in entries:
+      name = entry.name
+      if buckets and name.endswith(buckets) and entry.is_dir():
+        for path in self._object_paths(entry.path):
+          yield path
+      elif name.endswith(extension) and name not in ignore and entry.is_file():
+        yield entry.path
+
+  def _list_directory(self, directory, cancelled=None):
+    '''Returns the objects and subdirectories directly within `directory`, as
+    a list of (name, is_directory, path) tuples sorted by name. Object names
+    lack the extension, so each object sorts just before its own directory.
+    Packed objects have a (pack, name) reference instead of a path. Objects
+    in fanout buckets are listed as if they were in `directory` itself.
+    Returns an empty list without listing if `cancelled` (an Event) is set.
+    '''
+    if cancelled is not None and cancelled.is_set():
+      return []
+    extension = self.object_extension
+    buckets = self.bucket_extension if self.fanout else None
+    ignore = set(self.ignore_list)
+    entries = []
+
+    packed = self._packed_objects(directory)
+    entries.extend((name, False, ref) for name, ref in packed.items())
+    ignore.update(name + extension for name in packed)
+
+    try:
+      if scandir is None:
+        listing = [(name, os.path.join(directory, name), None)
+            for name in os.listdir(directory)]
+      else:
+        listing = [(entry.name, entry.path, entry)
+            for entry in scandir(directory)]
+    except OSError, e:
+      if e.errno in (errno.ENOENT, errno.ENOTDIR): # removed while walking.
+        return entries
+      raise
+
+    for name, path, entry in listing:
+      if name in ignore:
+        continue
+      is_directory = entry.is_dir() if entry else os.path.isdir(path)
+      if is_directory and buckets and name.endswith(buckets):
+        entries.extend(self._list_directory(path))
+      elif is_directory:
+        entries.append((name, True, path))
+      elif name.endswith(extension):
+        entries.append((name[:-len(extension)], False, path))
+
+    entries.sort()
+    return entries
+
+  def _pool(self, name, size):
+    '''Returns thread pool `name` of `size` threads, started on first use
+    and shared by later queries (until ``close``).'''
+    with self._pools_lock:
+      pool = self._pools.get((name, size))
+      if pool is None:
+        pool = multiprocessing.pool.ThreadPool(size)
+        self._pools[(name, size)] = pool
+      return pool
+
+  def _walk_object_paths(self, directory):
+    '''Generator over the paths of all objects under `directory`. Directories
+    are listed in parallel, by a pool of `walk_threads` threads. Listings
+    already started when a walk is closed early still finish.'''
+    pool = self._pool('walk', self.walk_threads)
+    if self.sorted_walk:
+      for path in self._sorted_walk(pool, directory):
+        yield path
+      return
+
+    level = [directory]
+    while level:
+      subdirectories = []
+      for entries in pool.imap_unordered(self._list_directory, level):
+        for name, is_directory, path in entries:
+          if is_directory:
+            subdirectories.append(path)
+          else:
+            yield path
+      level = subdirectories
+
+  def _sorted_walk(self, pool, directory):
+    '''Generator over the paths of objects under `directory` depth-first,
+    sorted by path. About `walk_threads` subdirectories are listed ahead, in
+    walk order. If closed early, listings not yet started are dropped.'''
+    cancelled = threading.Event()
+    ahead = [0] # listings requested, and not yet walked.
+
+    def list_ahead(directories, listings):
+      while directories and (not listings or ahead[0] < self.walk_threads):
+        ahead[0] += 1
+        listings.append(pool.apply_async(self._list_directory,
+            (directories.popleft(), cancelled)))
+
+    def walk(listing):
+      entries = listing.get()
+      ahead[0] -= 1
+      directories = collections.deque(path
+          for name, is_directory, path in entries if is_directory)
+      listings = collections.deque()
+      list_ahead(directories, listings)
+
+      for name, is_directory, path in entries:
+        if not is_directory:
+          yield path
+          continue
+
+        list_ahead(directories, listings)
+        for subpath in walk(listings.popleft()):
+          yield subpath
+
+    try:
+      listings = collections.deque()
+      list_ahead(collections.deque([directory]), listings)
+      for path in walk(listings.popleft()):
+        yield path
+    finally:
+      cancelled.set()
+
+  def _read_reference(self, reference, cancelled=None):
+    '''Reads the object at a path, or a (pack, name) reference. Returns None
+    without reading if `cancelled` (an Event) is set.'''
+    if cancelled is not None and cancelled.is_set():
       return None
-
-    if os.path.isdir(path):
-      raise RuntimeError('%s is a directory, not a file.' % path)
-
-    with open(path) as f:
-      file_contents = f.read()
-
-    return file_contents
+    if isinstance(reference, tuple):
+      pack, name = reference
+      with pack.lock:
+        return pack.get(name)
+    return self._read_object(reference)
 
   def _read_object_gen(self, iterable):
     '''Generator that reads objects in from filenames in `iterable`.'''
+    if self.prefetch > 0:
+      for value in self._prefetch_object_gen(iterable):
+        yield value
+      return
+
     for filename in iterable:
-      yield self._read_object(filename)
+      yield self._read_reference(filename)
 
+  def _prefetch_object_gen(self, iterable):
+    '''Generator that reads objects in from filenames in `iterable`, keeping
+    `prefetch` reads in flight on a thread pool (shared by queries). Objects
+    come out in order. If closed early, reads not yet started are dropped.
+    '''
+    pool = self._pool('prefetch', self.prefetch)
+    pending = collections.deque()
+    cancelled = threading.Event()
+    try:
+      for filename in iterable:
+        pending.append(pool.apply_async(self._read_reference,
+            (filename, cancelled)))
+        if len(pending) >= self.prefetch:
+          yield pending.popleft().get()
+
+      while pending:
+        yield pending.popleft().get()
+    finally:
+      cancelled.set()
+
+
+  # object packs
+
+  def _pack(self, directory, create=False):
+    '''Returns the pack of `directory`, loading its index if needed, or None
+    if it has no pack file (unless `create`). Only packs on disk are cached,
+    as are (up to `max_pack_misses`) directories without one, until a put
+    creates it. Callers hold the pack's lock while using it.'''
+    pack = self._packs.get(directory)
+    if pack is None:
+      path = os.path.join(directory, self.pack_name)
+      if not create:
+        if directory in self._pack_misses:
+          return None
+        if not os.path.exists(path):
+          with self._pack_lock:
+            if len(self._pack_misses) >= self.max_pack_misses:
+              self._pack_misses.clear()
+            if directory not in self._packs:
+              self._pack_misses.add(directory)
+          return None
+
+      pack = _Pack(path) # loaded outside the lock; the first one cached wins.
+      with self._pack_lock:
+        self._pack_misses.discard(directory)
+        pack = self._packs.setdefault(directory, pack)
+    return pack
+
+  def _drop_pack(self, directory, pack):
+    '''Drops `pack` (removed from disk) from the cache. Its lock is held.'''
+    pack.removed = True
+    pack.index = {} # for readers still holding it.
+    pack.close()
+    with self._pack_lock:
+      if self._packs.get(directory) is pack:
+        del self._packs[directory]
+
+  def _key_lock(self, path):
+    '''Returns the lock held while the object at `path` moves between its
+    pack and its own file.'''
+    return self._key_locks[hash(path) % len(self._key_locks)]
+
+  def _pack_location(self, path):
+    '''Returns the (directory, name) of the object at `path` within packs.'''
+    directory, filename = os.path.split(path)
+    return directory, filename[:-len(self.object_extension)]
+
+  def _read_packed(self, path):
+    '''Returns the object at `path` from its directory pack, or None.'''
+    directory, name = self._pack_location(path)
+    pack = self._pack(directory)
+    if pack is None:
+      return None
+    with pack.lock:
+      return pack.get(name)
+
+  def _write_packed(self, path, value):
+    '''Appends object `value` (or its deletion, if None) to the pack of the
+    directory of `path`. Returns whether the pack changed.'''
+    directory, name = self._pack_location(path)
+    sync = self.durability == 'file'
+
+    while True:
+      pack = self._pack(directory, create=value is not None)
+      if pack is None:
+        return False
+
+      with pack.lock:
+        if pack.removed:
+          continue # dropped meanwhile: get the new one.
+
+        if value is None and name not in pack.index:
+          return False
+
+        if value is None and len(pack.index) == 1:
+          # deleting the last object: the pack goes altogether.
+          self._remove_object(pack.path)
+          self._drop_pack(directory, pack)
+          return True
+
+        try:
+          self._ensure_directory(directory)
+          created = pack.size == 0
+          pack.append(name, value, sync)
+        except OSError, e:
+          if e.errno != errno.ENOENT:
+            raise
+          # the directory was removed behind our back, pack and all.
+          self._known_directories.discard(directory)
+          self._drop_pack(directory, pack)
+          continue
+
+        compacted = pack.dead_ratio() > self.pack_compaction_ratio
+        if compacted:
+          pack.compact(self.durability != 'none')
+        break
+
+    # compaction fsyncs the pack (but for 'none' durability).
+    self._persist(pack.path, created or compacted, sync or compacted)
+    return True
+
+  def compact_packs(self):
+    '''Compacts every pack under the root with superseded or deleted
+    records.'''
+    for directory, _, filenames in os.walk(self.root_path):
+      if self.pack_name not in filenames:
+        continue
+
+      pack = self._pack(directory)
+      if pack is None:
+        continue
+      with pack.lock:
+        if pack.dead and not pack.removed:
+          pack.compact(self.durability != 'none')
+          self._persist(pack.path)
 
   # Datastore implementation
 
@@ -170,6 +1037,10 @@ class FileSystemDatastore(datastore.Datastore):
       object or None
     '''
     path = self.object_path(key)
+    if self.pack_threshold is not None:
+      value = self._read_packed(path)
+      if value is not None:
+        return value
     return self._read_object(path)
 
 
@@ -181,7 +1052,84 @@ class FileSystemDatastore(datastore.Datastore):
       value: the object to store.
     '''
     path = self.object_path(key)
-    self._write_object(path, value)
+    if self.pack_threshold is None:
+      self._write_object(path, value)
+      return
+
+    # one lock across the move, so racing puts cannot remove both copies.
+    with self._key_lock(path):
+      if len(value) < self.pack_threshold:
+        self._write_packed(path, value)
+        self._remove_object(path)
+      else:
+        self._write_object(path, value)
+        self._write_packed(path, None)
+
+  def get_buffer(self, key):
+    '''Returns the object named by `key` as a read-only mmap of its file, or
+    None if it does not exist. Objects smaller than `mmap_threshold` (any,
+    if it is None), and packed objects, are returned as strings instead.
+    Close maps when done::
+
+        >>> with contextlib.closing(ds.get_buffer(key)) as value:
+        ...   header = value[:16]
+
+    Args:
+      key: Key naming the object to retrieve.
+
+    Returns:
+      mmap, string or None
+    '''
+    path = self.object_path(key)
+    if self.pack_threshold is not None:
+      value = self._read_packed(path)
+      if value is not None:
+        return value
+    return read_file(path, self.mmap_threshold)
+
+  def get_stream(self, key):
+    '''Returns the file of the object named by `key`, opened for reading, or
+    None if it does not exist.
+
+    Args:
+      key: Key naming the object to retrieve.
+
+    Returns:
+      file-like object or None
+    '''
+    path = self.object_path(key)
+    if self.pack_threshold is not None:
+      value = self._read_packed(path)
+      if value is not None:
+        return ChunkStream([value])
+
+    try:
+      return open(path, 'rb')
+    except IOError, e:
+      if e.errno in (errno.ENOENT, errno.ENOTDIR):
+        return None
+      if e.errno == errno.EISDIR:
+        raise RuntimeError('%s is a directory, not a file.' % path)
+      raise
+
+  def put_stream(self, key, stream):
+    '''Stores the object read from `stream` named by `key`. The object is
+    copied to its file in chunks, rather than read into memory, and is never
+    packed.
+
+    Args:
+      key: Key naming the object.
+      stream: a file-like object, a string or buffer, or an iterable of
+          chunks.
+    '''
+    path = self.object_path(key)
+    if self.pack_threshold is None:
+      self._write_object(path, stream)
+      return
+
+    with self._key_lock(path):
+      self._write_object(path, stream)
+      self._write_packed(path, None)
 
   def delete(self, key):
     '''Removes the object named by `key`.
@@ -190,15 +1138,22 @@ class FileSystemDatastore(datastore.Datastore):
       key: Key naming the object to remove.
     '''
     path = self.object_path(key)
-    if os.path.exists(path):
-      os.remove(path)
+    if self.pack_threshold is None:
+      deleted = self._remove_object(path)
+    else:
+      with self._key_lock(path):
+        deleted = self._write_packed(path, None)
+        deleted = self._remove_object(path) or deleted
 
-    #TODO: delete dirs if empty?
+    if deleted and self.prune_directories:
+      self._deleted_from(os.path.dirname(path))
 
   def query(self, query):
     '''Returns an iterable of objects matching criteria expressed in `query`
     FSDatastore.query queries all the `.obj` files within the directory
-    specified by the query.key.
+    specified by the query.key. The directory is listed lazily, so objects
+    stream out as it is scanned. With `recursive_queries`, it queries all the
+    `.obj` files under that directory instead.
 
     Args:
       query: Query object describing the objects to return.
@@ -207,20 +1162,16 @@ class FileSystemDatastore(datastore.Datastore):
       Cursor with all objects matching criteria
     '''
     path = self.path(query.key)
-
-    if os.path.exists(path):
-      filenames = os.listdir(path)
-      filenames = list(set(filenames) - set(self.ignore_list))
-      filenames = map(lambda f: os.path.join(path, f), filenames)
-      iterable = self._read_object_gen(filenames)
+    if self.recursive_queries:
+      paths = self._walk_object_paths(path)
     else:
-      iterable = list()
-
+      paths = self._object_paths(path)
+    iterable = self._read_object_gen(paths)
     return query(iterable) # must apply filters, etc naively.
 
   def contains(self, key):
     '''Returns whether the object named by `key` exists.
-    Optimized to only check whether the file object exists.
+    Optimized to only check whether the file object exists (one stat).
 
     Args:
       key: Key naming the object to check.
@@ -229,4 +1180,11 @@ class FileSystemDatastore(datastore.Datastore):
       boalean whether the object exists
     '''
     path = self.object_path(key)
-    return os.path.exists(path) and os.path.isfile(path)
+    if self.pack_threshold is not None:
+      directory, name = self._pack_location(path)
+      pack = self._pack(directory)
+      if pack is not None:
+        with pack.lock:
+          if name in pack.index:
+            return True
+    return os.path.isfile(path)
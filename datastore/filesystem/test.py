@@ -1,11 +1,22 @@
 
 import os
+import sys
+import time
+import json
+import errno
+import mmap
 import shutil
+import contextlib
 import unittest
+import threading
+import StringIO
 
 from datastore import serialize
+from datastore.core.key import Key
+from datastore.core.query import Query
 from datastore.core.test.test_basic import TestDatastore
 
+import datastore.filesystem
 from . import FileSystemDatastore
 
 
@@ -18,15 +29,465 @@ class TestFileSystemDatastore(TestDatastore):
       shutil.rmtree(self.tmp)
 
   def tearDown(self):
-    shutil.rmtree(self.tmp)
+    if os.path.exists(self.tmp):
+      shutil.rmtree(self.tmp)
 
   def test_datastore(self):
     dirs = map(str, range(0, 4))
     dirs = map(lambda d: os.path.join(self.tmp, d), dirs)
-    fses = map(FileSystemDatastore, dirs)
+    fses = map(FileSystemDatastore, dirs[:2])
+    fses += [FileSystemDatastore(dirs[2], fast_reads=True),
+             FileSystemDatastore(dirs[3], fast_reads=True, prefetch=16)]
     dses = map(serialize.shim, fses)
     self.subtest_simple(dses, numelems=500)
 
+  def test_reads(self):
+    for fast_reads in [False, True]:
+      fs = FileSystemDatastore(self.tmp, fast_reads=fast_reads)
+      fs.put(Key('/a:b'), 'ab')
+      fs.put(Key('/big'), 'x' * 100000)
+      self.assertEqual(fs.get(Key('/a:b')), 'ab')
+      self.assertEqual(fs.get(Key('/big')), 'x' * 100000)
+      self.assertEqual(fs.get(Key('/a:c')), None)
+      self.assertEqual(fs.get(Key('/a:b/c')), None)
+      self.assertEqual(fs.get(Key('/missing/a:b')), None)
+      self.assertTrue(fs.contains(Key('/a:b')))
+      self.assertFalse(fs.contains(Key('/a:c')))
+
+      os.mkdir(fs.object_path(Key('/dir')))
+      self.assertRaises(RuntimeError, fs.get, Key('/dir'))
+      self.assertFalse(fs.contains(Key('/dir')))
+      shutil.rmtree(self.tmp)
+
+  def test_durability(self):
+    dirs = map(lambda d: os.path.join(self.tmp, d), ['file', 'group'])
+    fses = [FileSystemDatastore(dirs[0], durability='file'),
+            FileSystemDatastore(dirs[1], durability='group', group_size=7)]
+    dses = map(serialize.shim, fses)
+    self.subtest_simple(dses, numelems=100)
+
+    packed = FileSystemDatastore(os.path.join(self.tmp, 'packed'),
+        durability='group', group_size=7, pack_threshold=64)
+    self.subtest_simple([serialize.shim(packed)], numelems=100)
+    fses.append(packed)
+
+    for fs in fses:
+      fs.close()
+      self.assertEqual(fs._pending, [])
+
+    self.assertRaises(ValueError, FileSystemDatastore, self.tmp,
+        durability='always')
+
+    # 'group' fsyncs each object once (before its rename), and each
+    # directory once per group.
+    fs = FileSystemDatastore(os.path.join(self.tmp, 'count'),
+        durability='group', group_size=100)
+    fsyncs = []
+    fsync = os.fsync
+    os.fsync = lambda fd: fsyncs.append(fd) or fsync(fd)
+    try:
+      for i in range(0, 10):
+        fs.put(Key('/a:%d' % i), 'value')
+      fs.close()
+    finally:
+      os.fsync = fsync
+    self.assertEqual(len(fsyncs), 11)
+
+  def test_atomic_writes(self):
+    fs = FileSystemDatastore(self.tmp)
+    key = Key('/a/b:c')
+    fs.put(key, 'first')
+    fs.put(key, 'second')
+    self.assertEqual(fs.get(key), 'second')
+    self.assertEqual(os.listdir(os.path.dirname(fs.object_path(key))),
+        ['c.obj']) # no temporary files left behind.
+
+    # directories removed behind the datastore's back are recreated.
+    shutil.rmtree(os.path.join(self.tmp, 'a'))
+    fs.put(key, 'third')
+    self.assertEqual(fs.get(key), 'third')
+
+    # so are directories removed while being made (e.g. by a racing prune).
+    ensure = datastore.filesystem.ensure_directory_exists
+    def racing(directory):
+      datastore.filesystem.ensure_directory_exists = ensure
+      raise OSError(errno.ENOENT, 'No such file or directory')
+    datastore.filesystem.ensure_directory_exists = racing
+    try:
+      fs.put(Key('/x/y:z'), 'raced')
+    finally:
+      datastore.filesystem.ensure_directory_exists = ensure
+    self.assertEqual(fs.get(Key('/x/y:z')), 'raced')
+
+    # a write failing midway leaves no temporary file behind.
+    def failing():
+      yield 'partial'
+      raise IOError(errno.ENOSPC, 'No space left on device')
+    self.assertRaises(IOError, fs.put_stream, key, failing())
+    self.assertEqual(fs.get(key), 'third')
+    self.assertEqual(os.listdir(os.path.dirname(fs.object_path(key))),
+        ['c.obj'])
+
+  def test_query(self):
+    fs = FileSystemDatastore(self.tmp)
+    for i in range(0, 20):
+      fs.put(Key('/a:%d' % i), str(i))
+    fs.put(Key('/a:1/b:c'), 'nested') # makes directory a/1 next to a/1.obj
+    open(os.path.join(self.tmp, 'a', 'stray.tmp'), 'w').write('stray')
+    open(os.path.join(self.tmp, 'a', 'ignored.obj'), 'w').write('ignored')
+
+    fs.ignore_list = ['ignored.obj']
+    scandir = datastore.filesystem.scandir
+    try:
+      for listing in [scandir, None]:
+        datastore.filesystem.scandir = listing
+        results = sorted(fs.query(Query(Key('/a'))), key=int)
+        self.assertEqual(results, map(str, range(0, 20)))
+        self.assertEqual(list(fs.query(Query(Key('/missing')))), [])
+        self.assertEqual(list(fs.query(Query(Key('/a:0')))), [])
+    finally:
+      datastore.filesystem.scandir = scandir
+
+  def test_recursive_query(self):
+    keys = ['/a:%d' % i for i in range(0, 12)]
+    keys += ['/a:%d/b:%d' % (i, j) for i in range(0, 12, 3) for j in range(3)]
+    keys += ['/a:3/b:1/c:x', '/a:3/b:1/c:y/d', '/a:11:deep']
+    keys += ['/other:1', '/ab:1']
+    expected = sorted(k for k in keys if k.startswith('/a:'))
+
+    fs = FileSystemDatastore(self.tmp, recursive_queries=True, walk_threads=3)
+    for key in keys:
+      fs.put(Key(key), key)
+
+    self.assertEqual(sorted(fs.query(Query(Key('/a')))), expected)
+    self.assertEqual(sorted(fs.query(Query(Key('/a:3/b:1')))),
+        ['/a:3/b:1/c:x', '/a:3/b:1/c:y/d'])
+    self.assertEqual(list(fs.query(Query(Key('/missing')))), [])
+
+    # sorted walks come out depth-first, sorted by path.
+    fs.sorted_walk = True
+    paths = [fs.relative_object_path(Key(k)) for k in expected]
+    results = list(fs.query(Query(Key('/a'))))
+    self.assertEqual(sorted(results), expected)
+    self.assertEqual([fs.relative_object_path(Key(k)) for k in results],
+        sorted(paths, key=lambda p: [c.replace('.obj', '') for c in
+            p.split('/')]))
+
+    # stopping early is fine.
+    self.assertEqual(len(list(fs.query(Query(Key('/a'), limit=4)))), 4)
+    fs.sorted_walk = False
+    self.assertEqual(len(list(fs.query(Query(Key('/a'), limit=4)))), 4)
+
+    # queries share one pool, until closed.
+    self.assertEqual(len(fs._pools), 1)
+    fs.close()
+    self.assertEqual(fs._pools, {})
+    self.assertEqual(sorted(fs.query(Query(Key('/a')))), expected)
+
+  def test_sorted_walk_ahead(self):
+    fs = FileSystemDatastore(self.tmp, recursive_queries=True,
+        sorted_walk=True, walk_threads=3)
+    for i in range(0, 40):
+      fs.put(Key('/d:%02d/e' % i), '%02d' % i)
+
+    # only about `walk_threads` directories are listed ahead, and listings
+    # not started when the walk is closed are dropped.
+    listed = []
+    list_directory = fs._list_directory
+    def slow_list(directory, cancelled=None):
+      if cancelled is None or not cancelled.is_set():
+        listed.append(directory)
+        time.sleep(0.02)
+      return list_directory(directory, cancelled)
+    fs._list_directory = slow_list
+
+    paths = fs._walk_object_paths(fs.path(Key('/d')))
+    self.assertEqual(fs._read_object(paths.next()), '00')
+    paths.close()
+    time.sleep(0.2)
+    self.assertTrue(len(listed) <= 6) # not 41.
+    self.assertEqual(list(fs.query(Query(Key('/d')))),
+        ['%02d' % i for i in range(0, 40)])
+    fs.close()
+    fs.close()
+
+  def test_prefetch(self):
+    fs = FileSystemDatastore(self.tmp, prefetch=4)
+    for i in range(0, 50):
+      fs.put(Key('/a:%02d' % i), '%02d' % i)
+
+    results = list(fs.query(Query(Key('/a'))))
+    self.assertEqual(sorted(results), ['%02d' % i for i in range(0, 50)])
+
+    # objects come out in listing order.
+    paths = list(fs._object_paths(fs.path(Key('/a'))))
+    self.assertEqual(list(fs._read_object_gen(paths)),
+        [os.path.basename(p)[:2] for p in paths])
+
+    # stopping early is fine, and queries share one pool, until closed.
+    values = fs._read_object_gen(paths)
+    self.assertEqual(len([v for v, _ in zip(values, range(0, 3))]), 3)
+    values.close()
+    self.assertEqual(len(list(fs.query(Query(Key('/a'), limit=3)))), 3)
+    self.assertEqual(fs._pools.keys(), [('prefetch', 4)])
+    fs.close()
+    self.assertEqual(fs._pools, {})
+
+    # reads not yet started when a query stops are dropped: with one free
+    # thread, and slow reads, at most the first two are read.
+    reads = []
+    read_object = fs._read_object
+    def slow_read(path):
+      reads.append(path)
+      time.sleep(0.05)
+      return read_object(path)
+    fs._read_object = slow_read
+
+    pool = fs._pool('prefetch', 4)
+    gate = threading.Event()
+    for _ in range(0, 3):
+      pool.apply_async(gate.wait)
+    values = fs._read_object_gen(paths)
+    self.assertEqual(values.next(), os.path.basename(paths[0])[:2])
+    values.close()
+    gate.set()
+    time.sleep(0.3)
+    self.assertTrue(len(reads) <= 2) # not 4.
+    fs.close()
+
+  def test_packing(self):
+    fs = FileSystemDatastore(self.tmp, pack_threshold=16)
+    small, large = Key('/a:small'), Key('/a:large')
+    fs.put(small, 'small')
+    fs.put(large, 'x' * 100)
+    self.assertEqual(fs.get(small), 'small')
+    self.assertEqual(fs.get(large), 'x' * 100)
+    self.assertTrue(fs.contains(small))
+    self.assertFalse(os.path.exists(fs.object_path(small)))
+    self.assertTrue(os.path.exists(fs.object_path(large)))
+
+    # objects move between packs and files as their size changes.
+    fs.put(small, 'y' * 100)
+    fs.put(large, 'large')
+    self.assertTrue(os.path.exists(fs.object_path(small)))
+    self.assertFalse(os.path.exists(fs.object_path(large)))
+    self.assertEqual(fs.get(small), 'y' * 100)
+    self.assertEqual(fs.get(large), 'large')
+
+    for i in range(0, 20):
+      fs.put(Key('/a:%02d' % i), '%02d' % i)
+      fs.put(Key('/a:%02d/b:c' % i), 'nested')
+    self.assertEqual(sorted(fs.query(Query(Key('/a')))),
+        sorted(['%02d' % i for i in range(0, 20)] + ['y' * 100, 'large']))
+
+    fs.recursive_queries = fs.sorted_walk = True
+    results = list(fs.query(Query(Key('/a'))))
+    self.assertEqual(results[:4], ['00', 'nested', '01', 'nested'])
+    self.assertEqual(len(results), 42)
+
+    # overwrites and deletes trigger compaction.
+    pack = os.path.join(self.tmp, 'a', fs.pack_name)
+    for i in range(0, 20):
+      fs.put(Key('/a:%02d' % i), 'v%02d' % i)
+    size = os.path.getsize(pack)
+    for i in range(0, 10):
+      fs.delete(Key('/a:%02d' % i))
+    self.assertTrue(os.path.getsize(pack) < size)
+
+    # a new datastore loads the packs (ignoring a torn tail).
+    with open(pack, 'ab') as f:
+      f.write('torn')
+    fs = FileSystemDatastore(self.tmp, pack_threshold=16)
+    self.assertEqual(fs.get(Key('/a:05')), None)
+    self.assertEqual(fs.get(Key('/a:15')), 'v15')
+    self.assertEqual(fs.get(large), 'large')
+    self.assertEqual(len(list(fs.query(Query(Key('/a'))))), 12)
+
+    fs.delete(Key('/a:15'))
+    fs.compact_packs()
+    fs = FileSystemDatastore(self.tmp, pack_threshold=16)
+    self.assertEqual(len(list(fs.query(Query(Key('/a'))))), 11)
+    self.assertEqual(fs._pack(os.path.join(self.tmp, 'a')).dead, 0)
+
+    # only packs on disk are cached.
+    self.assertEqual(fs.get(Key('/missing/b:c')), None)
+    self.assertFalse(fs.contains(Key('/a/b:c')))
+    self.assertEqual(fs._packs.keys(), [os.path.join(self.tmp, 'a')])
+
+    # directories without packs are remembered, until a put creates one.
+    directory = os.path.join(self.tmp, 'b')
+    fs.put(Key('/b:large'), 'x' * 100)
+    self.assertEqual(fs.get(Key('/b:missing')), None)
+    self.assertTrue(directory in fs._pack_misses)
+    fs.put(Key('/b:small'), 'small')
+    self.assertFalse(directory in fs._pack_misses)
+    self.assertEqual(fs.get(Key('/b:small')), 'small')
+
+    # packs read through one descriptor, reopened after compactions.
+    pack = fs._pack(directory)
+    fd = pack._fd
+    self.assertEqual(fs.get(Key('/b:small')), 'small')
+    self.assertEqual(pack._fd, fd)
+    for i in range(0, 4):
+      fs.put(Key('/b:small'), 'small%d' % i)
+    self.assertEqual(fs.get(Key('/b:small')), 'small3')
+    fs.close()
+    self.assertEqual(pack._fd, None)
+    self.assertEqual(fs.get(Key('/b:small')), 'small3')
+    fs.delete(Key('/b:small'))
+    self.assertEqual(pack._fd, None)
+    self.assertEqual(fs.get(Key('/b:small')), None)
+
+  def test_packing_races(self):
+    fs = FileSystemDatastore(self.tmp, pack_threshold=16)
+    interval = sys.getcheckinterval()
+    sys.setcheckinterval(1) # switch threads often, to interleave puts.
+    try:
+      for i in range(0, 50):
+        key = Key('/a:%d' % i)
+        threads = [threading.Thread(target=fs.put, args=(key, value))
+            for value in ['small', 'x' * 100]]
+        for thread in threads:
+          thread.start()
+        for thread in threads:
+          thread.join()
+        self.assertTrue(fs.get(key) in ('small', 'x' * 100))
+    finally:
+      sys.setcheckinterval(interval)
+
+  def test_fanout(self):
+    dirs = map(lambda d: os.path.join(self.tmp, d), ['fan', 'packed'])
+    fses = [FileSystemDatastore(dirs[0], fanout=2, fanout_width=16),
+            FileSystemDatastore(dirs[1], fanout=1, pack_threshold=8,
+                prune_directories='inline')]
+    self.subtest_simple(map(serialize.shim, fses), numelems=200)
+    self.assertEqual(os.listdir(dirs[1]), [])
+
+    fs = FileSystemDatastore(self.tmp, fanout=2)
+    key = Key('/Comedy/MontyPython/Actor:JohnCleese')
+    path = fs.relative_object_path(key)
+    self.assertEqual(path.split('/')[:3], ['Comedy', 'MontyPython', 'Actor'])
+    self.assertTrue(path.split('/')[3].endswith(fs.bucket_extension))
+    self.assertTrue(path.split('/')[4].endswith(fs.bucket_extension))
+    self.assertEqual(path.split('/')[5], 'JohnCleese.obj')
+    self.assertEqual(fs.path(key), os.path.join(self.tmp,
+        'Comedy/MontyPython/Actor/JohnCleese'))
+
+    for i in range(0, 100):
+      fs.put(Key('/a:%d' % i), str(i))
+      fs.put(Key('/a:%d/b:c' % i), 'nested')
+    self.assertTrue(len(os.listdir(os.path.join(self.tmp, 'a'))) < 200)
+
+    expected = map(str, range(0, 100))
+    self.assertEqual(sorted(fs.query(Query(Key('/a'))), key=int), expected)
+    self.assertEqual(list(fs.query(Query(Key('/a:5/b')))), ['nested'])
+
+    fs.recursive_queries = fs.sorted_walk = True
+    results = list(fs.query(Query(Key('/a'))))
+    self.assertEqual(results[:4], ['0', 'nested', '1', 'nested'])
+    self.assertEqual(len(results), 200)
+
+  def test_pruning(self):
+    def put_tree(fs):
+      for i in range(0, 10):
+        fs.put(Key('/a/b:%d/c:d' % i), 'value')
+      fs.put(Key('/a/keep'), 'keep')
+
+    def delete_tree(fs):
+      for i in range(0, 10):
+        fs.delete(Key('/a/b:%d/c:d' % i))
+
+    def tree(fs):
+      return sorted(d for d, _, _ in os.walk(self.tmp))
+
+    fs = FileSystemDatastore(self.tmp, prune_directories='inline')
+    put_tree(fs)
+    delete_tree(fs)
+    self.assertEqual(tree(fs), [self.tmp, os.path.join(self.tmp, 'a')])
+
+    # puts recreate pruned directories.
+    put_tree(fs)
+    self.assertEqual(fs.get(Key('/a/b:3/c:d')), 'value')
+    fs.delete(Key('/a/keep'))
+    delete_tree(fs)
+    self.assertEqual(tree(fs), [self.tmp])
+
+    fs = FileSystemDatastore(self.tmp, prune_directories='deferred')
+    fs.prune_batch = 4
+    put_tree(fs)
+    delete_tree(fs)
+    fs.close()
+    self.assertEqual(tree(fs), [self.tmp, os.path.join(self.tmp, 'a')])
+
+    fs = FileSystemDatastore(self.tmp)
+    put_tree(fs)
+    delete_tree(fs)
+    self.assertEqual(len(tree(fs)), 2 + 1 + 20)
+    self.assertEqual(fs.sweep_directories(), 21)
+    self.assertEqual(tree(fs), [self.tmp, os.path.join(self.tmp, 'a')])
+    self.assertTrue(fs.contains(Key('/a/keep')))
+
+    self.assertRaises(ValueError, FileSystemDatastore, self.tmp,
+        prune_directories='always')
+
+  def test_mmap_reads(self):
+    fs = FileSystemDatastore(self.tmp, mmap_threshold=1024, pack_threshold=64)
+    small, large = Key('/a:small'), Key('/a:large')
+    fs.put(small, 'small')
+    fs.put(large, 'x' * 4096)
+    self.assertEqual(fs.get(small), 'small')
+    self.assertEqual(fs.get_buffer(small), 'small')
+    self.assertEqual(fs.get(large), 'x' * 4096)
+    self.assertTrue(isinstance(fs.get_buffer(large), mmap.mmap))
+
+    # maps keep seeing the value they were read with.
+    buf = fs.get_buffer(large)
+    fs.put(large, 'y' * 4096)
+    self.assertEqual(buf[:], 'x' * 4096)
+    buf.close()
+    with contextlib.closing(fs.get_buffer(large)) as buf:
+      self.assertEqual(buf[:], 'y' * 4096)
+
+    fs.put(large, '')
+    self.assertEqual(fs.get(large), '')
+    self.assertEqual(fs.get_buffer(large), '')
+    self.assertEqual(fs.get_buffer(Key('/a:missing')), None)
+
+    # without a threshold, nothing is mapped.
+    fs = FileSystemDatastore(self.tmp, pack_threshold=64)
+    fs.put(large, 'x' * 4096)
+    self.assertEqual(fs.get_buffer(large), 'x' * 4096)
+    self.assertFalse(isinstance(fs.get_buffer(large), mmap.mmap))
+
+    # get returns strings, which serializer shims can deserialize.
+    ds = serialize.SerializerShimDatastore(FileSystemDatastore(self.tmp,
+        mmap_threshold=100), serializer=json)
+    value = {'value': 'x' * 1000}
+    ds.put(Key('/b:large'), value)
+    self.assertEqual(ds.get(Key('/b:large')), value)
+    self.assertEqual(list(ds.query(Query(Key('/b')))), [value])
+
+  def test_put_stream(self):
+    fs = FileSystemDatastore(self.tmp, pack_threshold=64)
+    key = Key('/a/b:c')
+    fs.put(key, 'packed')
+    fs.put_stream(key, StringIO.StringIO('streamed ' * 1000))
+    self.assertEqual(fs.get(key), 'streamed ' * 1000)
+    self.assertTrue(os.path.exists(fs.object_path(key)))
+
+    fs.put_stream(key, buffer('a buffer'))
+    self.assertEqual(fs.get(key), 'a buffer')
+    fs.put_stream(key, memoryview('a memoryview'))
+    self.assertEqual(fs.get(key), 'a memoryview')
+    fs.put_stream(key, iter(['chunk1', 'chunk2']))
+    self.assertEqual(fs.get_stream(key).read(), 'chunk1chunk2')
+    fs.put(key, 'packed')
+    self.assertEqual(fs.get_stream(key).read(), 'packed')
+
+    fs.delete(key)
+    self.assertEqual(fs.get(key), None)
+    self.assertEqual(fs.get_stream(key), None)
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,342 @@
+from __future__ import absolute_import
+
+__version__ = '1.0'
+__doc__ = '''
+memory-mapped key-value datastore implementation.
+
+Uses LMDB (the `lmdb` package) when installed, and falls back to the standard
+library `anydbm` otherwise. See LMDBDatastore.
+
+'''
+
+import os
+import threading
+import contextlib
+
+import datastore.core
+from datastore.core.key import sort_key, collection_prefix
+
+try:
+  import lmdb
+except ImportError:
+  lmdb = None
+
+
+
+class _LMDBBackend(object):
+  '''Stores records in an LMDB environment (a memory-mapped B+tree).'''
+
+  def __init__(self, path, map_size, max_readers, sync):
+    self.env = lmdb.open(path, map_size=map_size, max_readers=max_readers,
+        sync=sync)
+
+  @contextlib.contextmanager
+  def reader(self):
+    with self.env.begin(buffers=True) as txn:
+      yield txn
+
+  @contextlib.contextmanager
+  def writer(self):
+    with self.env.begin(write=True) as txn:
+      yield txn
+
+  def get(self, key):
+    with self.env.begin() as txn:
+      return txn.get(key)
+
+  def put_many(self, items):
+    with self.env.begin(write=True) as txn:
+      for key, value in items:
+        if value is None:
+          txn.delete(key)
+        else:
+          txn.put(key, value)
+
+  def scan(self, prefix):
+    '''Generator over the values of keys starting with `prefix`, in order,
+    as of a single read snapshot.'''
+    with self.env.begin() as txn:
+      cursor = txn.cursor()
+      if not cursor.set_range(prefix):
+        return
+      for key, value in cursor:
+        if not key.startswith(prefix):
+          break
+        yield value
+
+  def __len__(self):
+    return self.env.stat()['entries']
+
+  def close(self):
+    self.env.close()
+
+
+
+class _DBMTransaction(object):
+  '''Transaction-like view of a dbm. Writes are buffered (and seen by reads
+  through the transaction) until ``commit`` applies them.'''
+
+  def __init__(self, db):
+    self._db = db
+    self._writes = {} # key -> value, or None if deleted.
+
+  def get(self, key, default=None):
+    if key in self._writes:
+      value = self._writes[key]
+      return default if value is None else value
+    return self._db.get(key, default)
+
+  def put(self, key, value):
+    self._writes[key] = value
+    return True
+
+  def delete(self, key):
+    existed = self.get(key) is not None
+    self._writes[key] = None
+    return existed
+
+  def commit(self):
+    '''Applies the buffered writes to the dbm.'''
+    for key, value in self._writes.iteritems():
+      if value is not None:
+        self._db[key] = value
+      elif key in self._db:
+        del self._db[key]
+    self._writes = {}
+
+
+
+class _DBMBackend(object):
+  '''Stores records in a standard library dbm. Serialized by one lock.
+
+  Writers buffer their writes and apply them at the end of the block, so
+  other users never see part of a write transaction, and one that raises
+  applies nothing. dbm has no transactions of its own, though: a crash while
+  the writes are applied may leave only some of them on disk.
+  '''
+
+  def __init__(self, path, sync):
+    import anydbm
+    self.db = anydbm.open(os.path.join(path, 'data'), 'c')
+    self.sync = sync
+    self.lock = threading.RLock()
+
+  def _sync(self):
+    if self.sync and hasattr(self.db, 'sync'):
+      self.db.sync()
+
+  @contextlib.contextmanager
+  def reader(self):
+    with self.lock:
+      yield _DBMTransaction(self.db)
+
+  @contextlib.contextmanager
+  def writer(self):
+    with self.lock:
+      txn = _DBMTransaction(self.db)
+      yield txn
+      txn.commit()
+      self._sync()
+
+  def get(self, key):
+    with self.lock:
+      return self.db.get(key)
+
+  def put_many(self, items):
+    with self.writer() as txn:
+      for key, value in items:
+        if value is None:
+          txn.delete(key)
+        else:
+          txn.put(key, value)
+
+  def scan(self, prefix):
+    '''Generator over the values of keys starting with `prefix`, in order.
+    dbm is unordered, so this lists (and sorts) every key.'''
+    with self.lock:
+      keys = sorted(k for k in self.db.keys() if k.startswith(prefix))
+    for key in keys:
+      value = self.get(key)
+      if value is not None:
+        yield value
+
+  def __len__(self):
+    with self.lock:
+      return len(self.db)
+
+  def close(self):
+    with self.lock:
+      self.db.close()
+
+
+
+class LMDBDatastore(datastore.Datastore):
+  '''Datastore over a memory-mapped B+tree (LMDB), or a dbm fallback.
+
+  With the `lmdb` package installed, objects are stored in an LMDB
+  environment under `root`. Reads are served straight from the memory map,
+  at close to in-memory speed, and the environment can be shared by several
+  processes: any number of readers run concurrently with a single writer,
+  each seeing a consistent snapshot.
+
+  Records are keyed by collection (``key.path``) and then key, so a query on
+  ``query.key`` is a prefix cursor over one contiguous range of the B+tree,
+  iterated within a single read transaction. Results come out sorted by key.
+
+  Without `lmdb`, the standard library ``anydbm`` is used instead. It is
+  neither memory-mapped nor safe to share between processes, a query has to
+  list every key, and write transactions are not atomic on disk (a crash may
+  apply part of one), but the datastore keeps working.
+
+  Values must be strings (wrap with a SerializerShimDatastore otherwise).
+
+  Zero-copy reads and multi-operation transactions are available through the
+  ``reader`` and ``writer`` context managers::
+
+      >>> with ds.reader() as txn:
+      ...   buf = ds.get_buffer(txn, key)  # buffer into the map, valid here.
+      ...
+      >>> with ds.writer() as txn:
+      ...   ds.put_in(txn, key1, 'value1')
+      ...   ds.put_in(txn, key2, 'value2')  # committed together.
+      ...
+
+  Hello World:
+
+      >>> import datastore.lmdb
+      >>>
+      >>> ds = datastore.lmdb.LMDBDatastore('/tmp/.test_lmdb')
+      >>>
+      >>> hello = datastore.Key('hello')
+      >>> ds.put(hello, 'world')
+      >>> ds.contains(hello)
+      True
+      >>> ds.get(hello)
+      'world'
+      >>> ds.delete(hello)
+      >>> ds.get(hello)
+      None
+
+  '''
+
+  def __init__(self, root, map_size=1024 ** 3, max_readers=126, sync=True,
+               use_lmdb=None):
+    '''Initialize the datastore with given root directory `root`.
+
+    Args:
+      root: A path at which to store the database.
+
+      map_size: maximum size of the LMDB memory map (and database), in bytes.
+
+      max_readers: maximum number of concurrent LMDB read transactions.
+
+      sync: whether to flush to disk on every commit.
+
+      use_lmdb: whether to use LMDB. Defaults to whether it is installed.
+    '''
+    root = os.path.normpath(root)
+    if not os.path.isdir(root):
+      os.makedirs(root)
+
+    if use_lmdb is None:
+      use_lmdb = lmdb is not None
+
+    if use_lmdb:
+      if lmdb is None:
+        raise RuntimeError('the lmdb package is not installed.')
+      self._backend = _LMDBBackend(root, map_size, max_readers, sync)
+    else:
+      self._backend = _DBMBackend(root, sync)
+
+    self.root_path = root
+    self.uses_lmdb = bool(use_lmdb)
+
+
+  # transactions
+
+  def reader(self):
+    '''Returns a context manager around a read transaction.
+
+    Within it, ``get_buffer`` returns zero-copy buffers into the memory map.
+    '''
+    return self._backend.reader()
+
+  def writer(self):
+    '''Returns a context manager around a write transaction, committed at the
+    end of the block (or aborted, if it raises).'''
+    return self._backend.writer()
+
+  def get_buffer(self, txn, key):
+    '''Return a read-only buffer of the object named by `key`, or None.
+
+    The buffer points into the memory map (with LMDB), and is only valid
+    until transaction `txn` (from ``reader``) ends.
+    '''
+    return txn.get(sort_key(key))
+
+  def put_in(self, txn, key, value):
+    '''Stores the object `value` named by `key` within transaction `txn`
+    (from ``writer``).'''
+    if value is None:
+      txn.delete(sort_key(key))
+    else:
+      txn.put(sort_key(key), value)
+
+
+  # Datastore implementation
+
+  def get(self, key):
+    '''Return the object named by key or None if it does not exist.
+
+    Args:
+      key: Key naming the object to retrieve
+
+    Returns:
+      object or None
+    '''
+    return self._backend.get(sort_key(key))
+
+  def put(self, key, value):
+    '''Stores the object `value` named by `key`.
+
+    Args:
+      key: Key naming `value`
+      value: the object to store (a string).
+    '''
+    self._backend.put_many([(sort_key(key), value)])
+
+  def put_many(self, items):
+    '''Stores every (key, value) pair in `items`, in a single transaction.
+
+    Args:
+      items: iterable of (Key, string) pairs. None values delete.
+    '''
+    self._backend.put_many((sort_key(k), v) for k, v in items)
+
+  def delete(self, key):
+    '''Removes the object named by `key`.
+
+    Args:
+      key: Key naming the object to remove.
+    '''
+    self._backend.put_many([(sort_key(key), None)])
+
+  def query(self, query):
+    '''Returns an iterable of objects matching criteria expressed in `query`
+    Iterates a prefix cursor over the collection ``query.key``, in key order.
+
+    Args:
+      query: Query object describing the objects to return.
+
+    Raturns:
+      Cursor with all objects matching criteria
+    '''
+    values = self._backend.scan(collection_prefix(query.key))
+    return query(values) # filters, orders, etc are still applied naively.
+
+  def __len__(self):
+    return len(self._backend)
+
+  def close(self):
+    '''Closes the underlying database.'''
+    self._backend.close()
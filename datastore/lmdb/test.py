@@ -0,0 +1,75 @@
+
+import os
+import shutil
+import unittest
+
+from datastore import serialize
+from datastore.core.key import Key
+from datastore.core.query import Query
+from datastore.core.test.test_basic import TestDatastore
+
+from . import LMDBDatastore, lmdb
+
+
+class TestLMDBDatastore(TestDatastore):
+
+  tmp = os.path.normpath('/tmp/datastore.test.lmdb')
+
+  def setUp(self):
+    if os.path.exists(self.tmp):
+      shutil.rmtree(self.tmp)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def backends(self):
+    return [True, False] if lmdb else [False]
+
+  def test_datastore(self):
+    stores = [LMDBDatastore(os.path.join(self.tmp, str(use_lmdb)),
+        map_size=1024 ** 2 * 10, use_lmdb=use_lmdb)
+        for use_lmdb in self.backends()]
+    dses = map(serialize.shim, stores)
+    self.subtest_simple(dses, numelems=500)
+
+  def test_transactions_and_queries(self):
+    for use_lmdb in self.backends():
+      ds = LMDBDatastore(os.path.join(self.tmp, str(use_lmdb)),
+          map_size=1024 ** 2 * 10, use_lmdb=use_lmdb)
+      self.assertEqual(ds.uses_lmdb, use_lmdb)
+
+      ds.put_many((Key('/a/b:%02d' % i), 'b%02d' % i)
+          for i in reversed(range(0, 50)))
+      ds.put(Key('/a/c:00'), 'c')
+      ds.put(Key('/a/b:00/child'), 'child')
+
+      expected = ['b%02d' % i for i in range(0, 50)]
+      self.assertEqual(list(ds.query(Query(Key('/a/b')))), expected)
+      self.assertEqual(list(ds.query(Query(Key('/a/c')))), ['c'])
+
+      with ds.writer() as txn:
+        ds.put_in(txn, Key('/a/b:00'), None)
+        ds.put_in(txn, Key('/a/b:01'), 'changed')
+
+      with ds.reader() as txn:
+        self.assertEqual(ds.get_buffer(txn, Key('/a/b:00')), None)
+        self.assertEqual(str(ds.get_buffer(txn, Key('/a/b:01'))), 'changed')
+
+      try:
+        with ds.writer() as txn:
+          ds.put_in(txn, Key('/a/b:02'), 'aborted')
+          ds.put_in(txn, Key('/a/b:03'), None)
+          self.assertEqual(str(ds.get_buffer(txn, Key('/a/b:02'))), 'aborted')
+          self.assertEqual(ds.get_buffer(txn, Key('/a/b:03')), None)
+          raise ValueError
+      except ValueError:
+        pass
+      self.assertEqual(ds.get(Key('/a/b:02')), 'b02')
+      self.assertEqual(ds.get(Key('/a/b:03')), 'b03')
+
+      self.assertEqual(len(ds), 51)
+      ds.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
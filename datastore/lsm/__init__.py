@@ -0,0 +1,539 @@
+
+__version__ = '1.0'
+__doc__ = '''
+log-structured merge-tree (LSM) datastore implementation.
+
+Objects are kept sorted by key, so queries are ordered range scans. See
+LSMDatastore.
+
+'''
+
+import os
+import mmap
+import zlib
+import heapq
+import bisect
+import struct
+import threading
+
+import datastore.core
+from datastore.core.key import sort_key, collection_prefix
+
+
+record_header = struct.Struct('>Ii')
+'''SSTable record header: key size, value size.'''
+
+wal_header = struct.Struct('>IIi')
+'''Write-ahead log record header: crc32, key size, value size.
+The crc32 covers the key and value sizes, the key, and the value.'''
+
+index_header = struct.Struct('>IQ')
+'''Sparse index entry header: key size, record offset.'''
+
+footer = struct.Struct('>QQQII8s')
+'''SSTable footer: index offset, bloom offset, record count, bloom bits,
+bloom hashes, magic.'''
+
+magic = 'DSLSMv01'
+
+tombstone = -1
+'''Value size marking a deleted key.'''
+
+
+
+class BloomFilter(object):
+  '''Simple bloom filter over strings, using double hashing.'''
+
+  def __init__(self, bits, hashes=7, data=None):
+    self.bits = max(int(bits), 8)
+    self.hashes = int(hashes)
+    self.data = bytearray(data or (self.bits + 7) // 8)
+
+  @classmethod
+  def for_count(cls, count, bits_per_key=10):
+    '''Returns an empty filter sized for `count` keys.'''
+    return cls(count * bits_per_key)
+
+  def _positions(self, key):
+    h1 = zlib.crc32(key) & 0xffffffff
+    h2 = (zlib.adler32(key) & 0xffffffff) | 1
+    return ((h1 + i * h2) % self.bits for i in xrange(self.hashes))
+
+  def add(self, key):
+    for position in self._positions(key):
+      self.data[position >> 3] |= 1 << (position & 7)
+
+  def __contains__(self, key):
+    data = self.data
+    for position in self._positions(key):
+      if not data[position >> 3] & (1 << (position & 7)):
+        return False
+    return True
+
+
+
+def write_sstable(path, items, index_interval=16, count=None):
+  '''Writes sorted `items` (key, value or None) to SSTable file `path`.
+
+  The file is written to a temporary path, fsynced, and renamed into place.
+  Given `count`, an upper bound on the number of items (to size the bloom
+  filter), items are streamed to the file rather than listed first.
+
+  Returns:
+    the number of records written.
+  '''
+  if count is None:
+    items = list(items)
+    count = len(items)
+  bloom = BloomFilter.for_count(count)
+  index = []
+  offset = 0
+  written = 0
+
+  with open(path + '.tmp', 'wb', 1024 * 1024) as f:
+    for n, (key, value) in enumerate(items):
+      written += 1
+      if n % index_interval == 0:
+        index.append((key, offset))
+      bloom.add(key)
+
+      value_size = tombstone if value is None else len(value)
+      f.write(record_header.pack(len(key), value_size))
+      f.write(key)
+      f.write(value or '')
+      offset += record_header.size + len(key) + len(value or '')
+
+    index_offset = offset
+    for key, record_offset in index:
+      f.write(index_header.pack(len(key), record_offset))
+      f.write(key)
+      offset += index_header.size + len(key)
+
+    f.write(str(bloom.data))
+    f.write(footer.pack(index_offset, offset, written, bloom.bits,
+        bloom.hashes, magic))
+    f.flush()
+    os.fsync(f.fileno())
+
+  os.rename(path + '.tmp', path)
+  return written
+
+
+
+class SSTable(object):
+  '''Immutable, sorted table of records, read through a memory map.'''
+
+  def __init__(self, path, table_id=0, level=0):
+    self.path = path
+    self.table_id = table_id
+    self.level = level
+    with open(path, 'rb') as f:
+      self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    self.size = len(self.data)
+
+    index_offset, bloom_offset, self.count, bits, hashes, file_magic = \
+      footer.unpack_from(self.data, len(self.data) - footer.size)
+    if file_magic != magic:
+      raise ValueError('%s is not an SSTable.' % path)
+
+    self.data_size = index_offset
+    self.bloom = BloomFilter(bits, hashes,
+        self.data[bloom_offset:len(self.data) - footer.size])
+
+    self.index_keys = []
+    self.index_offsets = []
+    offset = index_offset
+    while offset < bloom_offset:
+      key_size, record_offset = index_header.unpack_from(self.data, offset)
+      offset += index_header.size
+      self.index_keys.append(self.data[offset:offset + key_size])
+      self.index_offsets.append(record_offset)
+      offset += key_size
+
+  def _records(self, offset):
+    '''Generator over (key, value or None) from record at `offset` onwards.'''
+    data = self.data
+    while offset < self.data_size:
+      key_size, value_size = record_header.unpack_from(data, offset)
+      offset += record_header.size
+      key = data[offset:offset + key_size]
+      offset += key_size
+      if value_size == tombstone:
+        yield key, None
+      else:
+        yield key, data[offset:offset + value_size]
+        offset += value_size
+
+  def _seek(self, key):
+    '''Returns the offset of the indexed record at or before `key`.'''
+    position = bisect.bisect_right(self.index_keys, key) - 1
+    return self.index_offsets[max(position, 0)] if self.index_offsets else 0
+
+  def get(self, key):
+    '''Returns (found, value) for `key`. value is None for tombstones.'''
+    if key not in self.bloom:
+      return False, None
+
+    for record_key, value in self._records(self._seek(key)):
+      if record_key == key:
+        return True, value
+      if record_key > key:
+        break
+    return False, None
+
+  def scan(self, prefix):
+    '''Generator over (key, value or None) of the records starting with
+    `prefix`, in order.'''
+    for key, value in self._records(self._seek(prefix)):
+      if key < prefix:
+        continue
+      if not key.startswith(prefix):
+        break
+      yield key, value
+
+  def items(self):
+    '''Generator over all (key, value or None) records, in order.'''
+    return self._records(0)
+
+
+
+def merge_gen(sources):
+  '''Generator merging sorted (key, value) iterables into one sorted iterable.
+
+  `sources` are ordered newest first: for keys present in several sources,
+  only the value in the newest one is yielded. Tombstones (None) are yielded
+  too, so that callers can tell deletions apart.
+  '''
+  def tagged(n, source):
+    for key, value in source:
+      yield key, n, value
+
+  merged = heapq.merge(*[tagged(n, s) for n, s in enumerate(sources)])
+  last = None
+  for key, n, value in merged:
+    if key != last:
+      last = key
+      yield key, value
+
+
+
+class LSMDatastore(datastore.Datastore):
+  '''Log-structured merge-tree datastore.
+
+  LSMDatastore keeps recent writes in an in-memory table (the memtable),
+  logged to a write-ahead log for durability. When the memtable grows past
+  `memtable_size`, it is written out as an immutable sorted table file (an
+  SSTable) and the log is restarted. Reads check the memtable, then each
+  SSTable from newest to oldest. Each SSTable carries a sparse index (one
+  entry every `index_interval` records) and a bloom filter, so a lookup in a
+  table that lacks the key rarely touches the disk.
+
+  Records are sorted by collection (``key.path``) and then by key. A query on
+  ``query.key`` therefore seeks to the start of that collection in every
+  table, and merges the ordered scans into the Cursor: results come out
+  sorted by key, and reading stops as soon as a limit is reached.
+
+  Compaction is size-tiered: once `compaction_threshold` adjacent SSTables
+  (in age order) are of similar size -- none over `tier_ratio` times the
+  size of another -- they are merged into one, dropping overwritten values.
+  Merged tables grow by tiers, so each record is rewritten about once per
+  tier, rather than on every compaction. Tombstones are only dropped by
+  merges that include the oldest table, as they have nothing left to shadow.
+  ``compact`` merges every table at once.
+
+  A merged table is named after the newest table it merges, one level up
+  (``000000000007-1.sst``), so it keeps its place in the age order. The
+  tables merged are then removed oldest first: should a crash interrupt
+  that, the tables left are the newest of them, whose tombstones still
+  shadow what they deleted.
+
+  Values must be strings (wrap with a SerializerShimDatastore otherwise)::
+
+      /data/wal.log
+      /data/000000000001.sst
+      /data/000000000002.sst
+
+  Hello World:
+
+      >>> import datastore.lsm
+      >>>
+      >>> ds = datastore.lsm.LSMDatastore('/tmp/.test_lsm')
+      >>>
+      >>> hello = datastore.Key('hello')
+      >>> ds.put(hello, 'world')
+      >>> ds.contains(hello)
+      True
+      >>> ds.get(hello)
+      'world'
+      >>> ds.delete(hello)
+      >>> ds.get(hello)
+      None
+
+  '''
+
+  table_extension = '.sst'
+  wal_name = 'wal.log'
+
+  def __init__(self, root, memtable_size=4 * 1024 * 1024, sync=False,
+               index_interval=16, compaction_threshold=4, tier_ratio=2):
+    '''Initialize the datastore with given root directory `root`.
+
+    Args:
+      root: A path at which to store the log and table files.
+
+      memtable_size: bytes of keys and values to buffer before flushing the
+          memtable to a new SSTable.
+
+      sync: whether to fsync the write-ahead log after every write.
+
+      index_interval: number of records per sparse index entry.
+
+      compaction_threshold: number of SSTables of similar size that triggers
+          their compaction. None disables automatic compaction.
+
+      tier_ratio: how many times larger than each other SSTables may be, to
+          count as of similar size.
+    '''
+    root = os.path.normpath(root)
+    if not os.path.isdir(root):
+      os.makedirs(root)
+
+    self.root_path = root
+    self.memtable_size = int(memtable_size)
+    self.sync = bool(sync)
+    self.index_interval = int(index_interval)
+    self.compaction_threshold = compaction_threshold
+    self.tier_ratio = tier_ratio
+
+    self._lock = threading.RLock()
+    self._memtable = {}
+    self._memtable_bytes = 0
+    self._tables = [] # newest first
+
+    for name in os.listdir(root):
+      if name.endswith('.tmp'):
+        os.remove(os.path.join(root, name))
+
+    for table, level in sorted(self._table_ids(), reverse=True):
+      self._tables.append(SSTable(self.table_path(table, level), table, level))
+
+    self._replay_wal()
+    self._wal = open(self.wal_path(), 'ab', 0)
+
+
+  # pathing
+
+  def table_path(self, table, level=0):
+    '''Returns the path of SSTable number `table`, merged `level` times.'''
+    name = '%012d' % table if not level else '%012d-%d' % (table, level)
+    return os.path.join(self.root_path, name + self.table_extension)
+
+  def wal_path(self):
+    '''Returns the path of the write-ahead log.'''
+    return os.path.join(self.root_path, self.wal_name)
+
+  def _table_ids(self):
+    '''Returns the (number, level) of every SSTable on disk.'''
+    extension = self.table_extension
+    ids = []
+    for name in os.listdir(self.root_path):
+      if name.endswith(extension):
+        table, _, level = name[:-len(extension)].partition('-')
+        ids.append((int(table), int(level or 0)))
+    return ids
+
+  def _next_table_id(self):
+    return max([t for t, _ in self._table_ids()] or [0]) + 1
+
+
+  # write-ahead log
+
+  def _replay_wal(self):
+    '''Loads the memtable from the write-ahead log, dropping any torn tail.'''
+    path = self.wal_path()
+    if not os.path.exists(path):
+      return
+
+    with open(path, 'rb') as f:
+      data = f.read()
+
+    offset = 0
+    while offset + wal_header.size <= len(data):
+      crc, key_size, value_size = wal_header.unpack_from(data, offset)
+      key_offset = offset + wal_header.size
+      end = key_offset + key_size + max(value_size, 0)
+      if end > len(data):
+        break
+      if zlib.crc32(data[offset + 4:end]) & 0xffffffff != crc:
+        break
+
+      key = data[key_offset:key_offset + key_size]
+      value = None if value_size == tombstone else \
+        data[key_offset + key_size:end]
+      self._memtable_set(key, value)
+      offset = end
+
+    if offset < len(data):
+      with open(path, 'r+b') as f:
+        f.truncate(offset)
+
+  def _log(self, key, value):
+    '''Appends a put (or delete, if `value` is None) to the log.'''
+    value_size = tombstone if value is None else len(value)
+    body = struct.pack('>Ii', len(key), value_size) + key + (value or '')
+    self._wal.write(struct.pack('>I', zlib.crc32(body) & 0xffffffff) + body)
+    if self.sync:
+      os.fsync(self._wal.fileno())
+
+
+  # memtable
+
+  def _memtable_set(self, key, value):
+    self._memtable[key] = value
+    self._memtable_bytes += len(key) + len(value or '')
+
+  def flush(self):
+    '''Writes the memtable out as a new SSTable, and restarts the log.'''
+    with self._lock:
+      if not self._memtable:
+        return
+
+      table = self._next_table_id()
+      path = self.table_path(table)
+      write_sstable(path, sorted(self._memtable.iteritems()),
+          self.index_interval)
+      self._tables.insert(0, SSTable(path, table))
+
+      self._wal.close()
+      self._wal = open(self.wal_path(), 'wb', 0)
+      os.fsync(self._wal.fileno())
+      self._memtable = {}
+      self._memtable_bytes = 0
+
+      if self.compaction_threshold is not None:
+        self.compact_tiers()
+
+  def _tier(self):
+    '''Returns the (start, end) slice of the newest run of at least
+    `compaction_threshold` adjacent tables of similar size, or None.'''
+    tables = self._tables
+    for start in range(0, len(tables) - self.compaction_threshold + 1):
+      low = high = tables[start].size
+      end = start + 1
+      while end < len(tables):
+        size = tables[end].size
+        if max(high, size) > self.tier_ratio * max(min(low, size), 1):
+          break
+        low, high = min(low, size), max(high, size)
+        end += 1
+      if end - start >= self.compaction_threshold:
+        return start, end
+    return None
+
+  def compact_tiers(self):
+    '''Merges runs of tables of similar size, until none is left.'''
+    with self._lock:
+      tier = self._tier()
+      while tier is not None:
+        self._merge(*tier)
+        tier = self._tier()
+
+  def compact(self):
+    '''Merges all SSTables into one, dropping dead values and tombstones.'''
+    with self._lock:
+      if len(self._tables) > 1:
+        self._merge(0, len(self._tables))
+
+  def _merge(self, start, end):
+    '''Merges the tables in slice [`start`, `end`) of the (newest first)
+    tables into one, which takes their place.'''
+    tables = self._tables[start:end]
+    items = merge_gen([t.items() for t in tables])
+    if end == len(self._tables):
+      # merging the oldest table, so tombstones have nothing left to shadow.
+      items = ((k, v) for k, v in items if v is not None)
+
+    # named after the newest table merged, so it sorts just above it.
+    table = tables[0].table_id
+    level = max(t.level for t in tables) + 1
+    path = self.table_path(table, level)
+    write_sstable(path, items, self.index_interval,
+        count=sum(t.count for t in tables))
+    self._tables[start:end] = [SSTable(path, table, level)]
+
+    # oldest first: should we crash midway, the tables left are the newest
+    # merged, so their tombstones still shadow the values they deleted.
+    for merged in reversed(tables):
+      os.remove(merged.path) # open scans keep their memory maps.
+
+
+  # Datastore implementation
+
+  def get(self, key):
+    '''Return the object named by key or None if it does not exist.
+
+    Args:
+      key: Key naming the object to retrieve
+
+    Returns:
+      object or None
+    '''
+    key = sort_key(key)
+    with self._lock:
+      if key in self._memtable:
+        return self._memtable[key]
+      tables = self._tables
+
+    for table in tables:
+      found, value = table.get(key)
+      if found:
+        return value
+    return None
+
+  def put(self, key, value):
+    '''Stores the object `value` named by `key`.
+
+    Args:
+      key: Key naming `value`
+      value: the object to store (a string).
+    '''
+    key = sort_key(key)
+    with self._lock:
+      self._log(key, value)
+      self._memtable_set(key, value)
+      if self._memtable_bytes >= self.memtable_size:
+        self.flush()
+
+  def delete(self, key):
+    '''Removes the object named by `key`.
+
+    Args:
+      key: Key naming the object to remove.
+    '''
+    self.put(key, None)
+
+  def query(self, query):
+    '''Returns an iterable of objects matching criteria expressed in `query`
+    Seeks to the collection ``query.key`` in the memtable and every SSTable,
+    and merges the (ordered) scans. Objects are returned sorted by key.
+
+    Args:
+      query: Query object describing the objects to return.
+
+    Raturns:
+      Cursor with all objects matching criteria
+    '''
+    prefix = collection_prefix(query.key)
+    with self._lock:
+      memtable = sorted((k, v) for k, v in self._memtable.iteritems()
+          if k.startswith(prefix))
+      sources = [memtable] + [t.scan(prefix) for t in self._tables]
+
+    values = (v for k, v in merge_gen(sources) if v is not None)
+    return query(values) # filters, orders, etc are still applied naively.
+
+  def close(self):
+    '''Flushes the memtable and closes the write-ahead log.'''
+    with self._lock:
+      self.flush()
+      self._wal.close()
@@ -0,0 +1,158 @@
+
+import os
+import shutil
+import unittest
+
+from datastore import serialize
+from datastore.core.key import Key
+from datastore.core.query import Query
+from datastore.core.test.test_basic import TestDatastore
+
+from . import LSMDatastore, BloomFilter
+
+
+class TestLSMDatastore(TestDatastore):
+
+  tmp = os.path.normpath('/tmp/datastore.test.lsm')
+
+  def setUp(self):
+    if os.path.exists(self.tmp):
+      shutil.rmtree(self.tmp)
+
+  def tearDown(self):
+    if os.path.exists(self.tmp):
+      shutil.rmtree(self.tmp)
+
+  def test_datastore(self):
+    dirs = map(str, range(0, 3))
+    dirs = map(lambda d: os.path.join(self.tmp, d), dirs)
+    stores = [LSMDatastore(dirs[0]),
+              LSMDatastore(dirs[1], memtable_size=256, index_interval=4),
+              LSMDatastore(dirs[2], memtable_size=512, sync=True,
+                  compaction_threshold=None)]
+    dses = map(serialize.shim, stores)
+    self.subtest_simple(dses, numelems=500)
+
+  def test_bloom_filter(self):
+    bloom = BloomFilter.for_count(1000)
+    for i in range(0, 1000):
+      bloom.add('key%d' % i)
+
+    for i in range(0, 1000):
+      self.assertTrue('key%d' % i in bloom)
+
+    false_positives = sum(('other%d' % i) in bloom for i in range(0, 1000))
+    self.assertTrue(false_positives < 50)
+
+  def test_ordered_range_queries(self):
+    ds = LSMDatastore(self.tmp, memtable_size=200, compaction_threshold=None)
+    for i in reversed(range(0, 100)):
+      ds.put(Key('/a/b:%03d' % i), 'b%03d' % i)
+      ds.put(Key('/a/c:%03d' % i), 'c%03d' % i)
+      ds.put(Key('/a/b:%03d/child' % i), 'child')
+    for i in range(0, 100, 3):
+      ds.delete(Key('/a/b:%03d' % i))
+    self.assertTrue(len(ds._tables) > 2)
+
+    expected = ['b%03d' % i for i in range(0, 100) if i % 3]
+    self.assertEqual(list(ds.query(Query(Key('/a/b')))), expected)
+    self.assertEqual(list(ds.query(Query(Key('/a/b'), limit=5))), expected[:5])
+    self.assertEqual(len(list(ds.query(Query(Key('/a/c'))))), 100)
+    self.assertEqual(list(ds.query(Query(Key('/a/d')))), [])
+
+    ds.compact()
+    self.assertEqual(len(ds._tables), 1)
+    self.assertEqual(list(ds.query(Query(Key('/a/b')))), expected)
+
+  def test_reopen(self):
+    ds = LSMDatastore(self.tmp, memtable_size=300, compaction_threshold=3)
+    for i in range(0, 100):
+      ds.put(Key('/a:%d' % i), 'value %d' % i)
+    for i in range(0, 100, 2):
+      ds.delete(Key('/a:%d' % i))
+    ds.put(Key('/a:1'), 'changed')
+    wal = ds.wal_path()
+    ds._wal.close() # crash: the memtable is only in the log.
+    self.assertTrue(os.path.getsize(wal) > 0)
+
+    # tear the last log record in half.
+    with open(wal, 'r+b') as f:
+      f.truncate(os.path.getsize(wal) - 1)
+
+    ds = LSMDatastore(self.tmp, memtable_size=300, compaction_threshold=3)
+    self.assertEqual(ds.get(Key('/a:2')), None)
+    self.assertEqual(ds.get(Key('/a:3')), 'value 3')
+    self.assertEqual(len(list(ds.query(Query(Key('/a'))))), 50)
+    ds.close()
+
+    ds = LSMDatastore(self.tmp)
+    self.assertEqual(ds.get(Key('/a:3')), 'value 3')
+    self.assertEqual(len(list(ds.query(Query(Key('/a'))))), 50)
+    ds.close()
+
+  def test_compaction_crash(self):
+    ds = LSMDatastore(self.tmp, compaction_threshold=None)
+    ds.put(Key('/a:1'), 'v')
+    ds.flush()
+    ds.delete(Key('/a:1'))
+    ds.flush()
+
+    # crash right after the first old table is removed.
+    removed = []
+    def remove(path):
+      if removed:
+        raise SystemExit('crash')
+      removed.append(path)
+      os_remove(path)
+
+    os_remove = os.remove
+    os.remove = remove
+    try:
+      self.assertRaises(SystemExit, ds.compact)
+    finally:
+      os.remove = os_remove
+    ds._wal.close()
+
+    ds = LSMDatastore(self.tmp, compaction_threshold=None)
+    self.assertEqual(ds.get(Key('/a:1')), None)
+    ds.compact()
+    self.assertEqual(ds.get(Key('/a:1')), None)
+    self.assertEqual(len(ds._tables), 1)
+    ds.close()
+
+  def test_tiered_compaction(self):
+    ds = LSMDatastore(self.tmp, memtable_size=1000, compaction_threshold=4)
+    merges = []
+    merge = ds._merge
+    def counting_merge(start, end):
+      merges.append(sum(t.size for t in ds._tables[start:end]))
+      merge(start, end)
+    ds._merge = counting_merge
+
+    for i in range(0, 2000):
+      ds.put(Key('/a:%05d' % i), 'value %d' % i)
+    ds.flush()
+
+    # tables form tiers, each a few times larger than the next newer one.
+    sizes = [t.size for t in ds._tables]
+    self.assertTrue(len(sizes) < 12)
+    self.assertEqual(sizes, sorted(sizes))
+    self.assertTrue(sum(merges) < 6 * sum(sizes))
+
+    # merges that leave older tables keep tombstones.
+    ds.delete(Key('/a:00001'))
+    for i in range(0, 200):
+      ds.put(Key('/b:%05d' % i), 'value %d' % i)
+    ds.flush()
+    self.assertEqual(ds.get(Key('/a:00001')), None)
+    self.assertEqual(ds.get(Key('/a:00002')), 'value 2')
+    ds.close()
+
+    ds = LSMDatastore(self.tmp)
+    self.assertEqual(ds.get(Key('/a:00001')), None)
+    self.assertEqual(len(list(ds.query(Query(Key('/a'))))), 1999)
+    ds.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
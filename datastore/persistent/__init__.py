@@ -0,0 +1,453 @@
+
+__version__ = '1.0'
+__doc__ = '''
+persistent in-memory datastore implementation.
+
+A DictDatastore that survives restarts: writes are appended to a journal, and
+the whole dataset is written to a snapshot from time to time. See
+PersistentDictDatastore.
+
+'''
+
+import os
+import mmap
+import zlib
+import time
+import errno
+import struct
+import threading
+
+import datastore.core
+from datastore.core.serialize import pickle_serializer
+from datastore.filesystem import fsync_path
+
+
+record_header = struct.Struct('>Iii')
+'''Journal and snapshot record header: crc32, key size, value size. The
+crc32 covers everything in the record after itself.'''
+
+snapshot_header = struct.Struct('>4sQ')
+'''Snapshot file header: magic, and the generation of the first journal
+whose records the snapshot does not include.'''
+
+snapshot_magic = 'PDS1'
+
+tombstone = -1
+'''Value size marking a deleted key.'''
+
+
+
+def pack_record(key, value):
+  '''Returns the record storing string `value` under string `key` (or
+  deleting `key`, if `value` is None).'''
+  value_size = tombstone if value is None else len(value)
+  body = struct.pack('>ii', len(key), value_size) + key + (value or '')
+  return struct.pack('>I', zlib.crc32(body) & 0xffffffff) + body
+
+
+def scan_records(data, offset=0, size=None):
+  '''Generator over the valid records in `data` (a string or mmap), from
+  `offset`.
+
+  Yields tuples ``(key, value, end_offset)``, with None values for deletes.
+  Iteration stops at the first truncated or corrupt record (bad checksum).
+  '''
+  size = len(data) if size is None else size
+
+  while offset + record_header.size <= size:
+    crc, key_size, value_size = record_header.unpack_from(data, offset)
+    value_offset = offset + record_header.size + key_size
+    end = value_offset + max(value_size, 0)
+
+    if key_size < 0 or end > size:
+      break # truncated record (e.g. crash mid-write)
+
+    if zlib.crc32(buffer(data, offset + 4, end - offset - 4)) & 0xffffffff \
+        != crc:
+      break # corrupt record
+
+    key = data[offset + record_header.size:value_offset]
+    value = data[value_offset:end] if value_size != tombstone else None
+    yield key, value, end
+    offset = end
+
+
+
+class PersistentDictDatastore(datastore.DictDatastore):
+  '''DictDatastore persisted to a snapshot file and an append-only journal.
+
+  Objects live in memory, exactly as in a DictDatastore, and reads never
+  touch the disk. Each ``put`` and ``delete`` is also appended to the
+  journal, as a checksummed record of the key and the serialized object.
+  Journals are fsynced according to `sync`:
+
+  * 'always': after every write. Nothing acknowledged is ever lost.
+  * 'interval': at most `sync_interval` seconds after a write, by the next
+    write or a timer. A crash loses at most the writes of that window.
+  * 'none': never (the OS writes journals back eventually).
+
+  Once the journal outgrows `snapshot_threshold` bytes, a snapshot of the
+  whole dataset is written in the background, and the journals it includes
+  are deleted. By default, a thread writes the collections as they were when
+  the snapshot started: writes copy a collection (shallowly) before they
+  first change it during a snapshot, so starting one only copies the
+  mapping of collections. With `fork`, the snapshot is written by a
+  forked child instead, from a copy-on-write image of memory, so writers are
+  only held up for the fork. Only fork in processes whose other threads
+  cannot hold locks the child needs (e.g. within the serializer, or the
+  allocator of an extension): the child would deadlock on them.
+
+  On startup, the snapshot is mapped into memory and loaded, and the
+  journals written since are replayed. A journal truncated by a crash
+  replays up to its last whole record.
+
+  Objects are serialized with `serializer` (pickle, by default; so only
+  open directories you trust). Keys are not rewritten by snapshots, so keep
+  the objects stored immutable: the datastore holds them, not copies.
+
+  Hello World:
+
+      >>> import datastore.persistent
+      >>>
+      >>> ds = datastore.persistent.PersistentDictDatastore('/tmp/.test_pds')
+      >>>
+      >>> hello = datastore.Key('hello')
+      >>> ds.put(hello, 'world')
+      >>> ds.close()
+      >>>
+      >>> ds = datastore.persistent.PersistentDictDatastore('/tmp/.test_pds')
+      >>> ds.get(hello)
+      'world'
+
+  '''
+
+  journal_prefix = 'journal.'
+  snapshot_name = 'snapshot'
+
+  def __init__(self, root, serializer=pickle_serializer, sync='interval',
+               sync_interval=1.0, snapshot_threshold=64 * 1024 * 1024,
+               fork=False):
+    '''Initialize the datastore, loading it from directory `root`.
+
+    Args:
+      root: A path at which to store the snapshot and journals.
+
+      serializer: a serializer object (responds to loads and dumps).
+
+      sync: when to fsync the journal: 'always', 'interval' or 'none'.
+
+      sync_interval: seconds between fsyncs, with 'interval' sync.
+
+      snapshot_threshold: journal size in bytes past which a snapshot is
+        taken. 0 only takes snapshots when ``snapshot`` is called.
+
+      fork: whether to write snapshots from a forked child (see above).
+    '''
+    super(PersistentDictDatastore, self).__init__()
+    if sync not in ('always', 'interval', 'none'):
+      raise ValueError("sync must be 'always', 'interval' or 'none'.")
+
+    root = os.path.normpath(root)
+    if not os.path.isdir(root):
+      os.makedirs(root)
+
+    self.root_path = root
+    self.serializer = serializer
+    self.sync = sync
+    self.sync_interval = sync_interval
+    self.snapshot_threshold = snapshot_threshold
+    if fork and not hasattr(os, 'fork'):
+      raise ValueError('this OS cannot fork.')
+    self.fork = fork
+
+    self._lock = threading.RLock()
+    self._journal = None
+    self._journal_size = 0
+    self._generation = 0
+    self._synced_at = time.time()
+    self._sync_timer = None # pending fsync, with 'interval' sync.
+    self._snapshot_thread = None
+    self._shared = set() # collections a snapshot in progress still reads.
+
+    self._load()
+
+
+  # files
+
+  def journal_path(self, generation):
+    '''Returns the path of the journal of `generation`.'''
+    return os.path.join(self.root_path,
+        '%s%016d' % (self.journal_prefix, generation))
+
+  def snapshot_path(self):
+    '''Returns the path of the snapshot.'''
+    return os.path.join(self.root_path, self.snapshot_name)
+
+  def _journals(self):
+    '''Returns the sorted generations of the journals on disk.'''
+    generations = []
+    for name in os.listdir(self.root_path):
+      if name.startswith(self.journal_prefix):
+        generations.append(int(name[len(self.journal_prefix):]))
+    return sorted(generations)
+
+  def _map(self, path):
+    '''Returns a read-only mmap of the file at `path`, or None if empty.'''
+    with open(path, 'rb') as f:
+      if os.fstat(f.fileno()).st_size == 0:
+        return None
+      return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+  # collections
+
+  def _collection(self, key):
+    '''Returns the collection for `key`, to read (without creating it).'''
+    return self._items.get(str(key.path), {})
+
+  def _writable(self, key):
+    '''Returns the collection for `key`, to write (the lock is held). It is
+    created if needed, or copied if a snapshot in progress still reads it.'''
+    collection = str(key.path)
+    objects = self._items.get(collection)
+    if objects is None:
+      objects = self._items[collection] = {}
+    elif collection in self._shared:
+      objects = self._items[collection] = dict(objects)
+      self._shared.discard(collection)
+    return objects
+
+  def _remove(self, key):
+    '''Removes `key` from its collection, and empty collections (the lock is
+    held).'''
+    objects = self._writable(key)
+    objects.pop(key, None)
+    if not objects:
+      del self._items[str(key.path)]
+
+
+  # loading
+
+  def _apply(self, key, value):
+    '''Applies record (`key`, `value`) read from disk to the dataset.'''
+    key = datastore.Key(key)
+    if value is None:
+      self._remove(key)
+    else:
+      self._writable(key)[key] = self.serializer.loads(value)
+
+  def _load(self):
+    '''Loads the snapshot, replays the journals after it, and opens a new
+    journal.'''
+    first = 0
+    path = self.snapshot_path()
+    data = self._map(path) if os.path.exists(path) else None
+    if data is not None: # an empty snapshot holds nothing to load.
+      magic, first = snapshot_header.unpack_from(data)
+      if magic != snapshot_magic:
+        raise ValueError('%s is not a snapshot.' % path)
+      for key, value, _ in scan_records(data, snapshot_header.size):
+        self._apply(key, value)
+      data.close()
+
+    generations = self._journals()
+    for generation in generations:
+      if generation < first:
+        os.remove(self.journal_path(generation)) # included in the snapshot.
+        continue
+
+      data = self._map(self.journal_path(generation))
+      if data is not None:
+        for key, value, _ in scan_records(data):
+          self._apply(key, value)
+        data.close()
+
+    generation = max(generations + [first - 1]) + 1
+    self._open_journal(generation)
+
+  def _open_journal(self, generation):
+    '''Starts appending to the journal of `generation`.'''
+    self._generation = generation
+    self._journal = open(self.journal_path(generation), 'ab', 0)
+    self._journal_size = 0
+    fsync_path(self.root_path)
+
+
+  # journaling
+
+  def _append(self, key, value):
+    '''Appends a record to the journal (the lock is held).'''
+    record = pack_record(str(key), value)
+    self._journal.write(record)
+    self._journal_size += len(record)
+
+    if self.sync == 'always' or (self.sync == 'interval'
+        and time.time() - self._synced_at >= self.sync_interval):
+      self._sync_journal()
+    elif self.sync == 'interval' and self._sync_timer is None:
+      self._sync_timer = threading.Timer(self.sync_interval, self._sync_due)
+      self._sync_timer.daemon = True
+      self._sync_timer.start()
+
+  def _sync_journal(self):
+    os.fsync(self._journal.fileno())
+    self._synced_at = time.time()
+    if self._sync_timer is not None:
+      self._sync_timer.cancel()
+      self._sync_timer = None
+
+  def _sync_due(self):
+    '''fsyncs the journal written since the last fsync (on a timer).'''
+    with self._lock:
+      if self._sync_timer is not None and self._journal is not None:
+        self._sync_journal()
+
+  def _maybe_snapshot(self):
+    if self.snapshot_threshold and \
+        self._journal_size >= self.snapshot_threshold and \
+        self._snapshot_thread is None:
+      self.snapshot(background=True)
+
+  def flush(self):
+    '''fsyncs the journal.'''
+    with self._lock:
+      self._sync_journal()
+
+
+  # Datastore implementation
+
+  def put(self, key, value):
+    '''Stores the object `value` named by `key`, in memory and the journal.
+
+    Args:
+      key: Key naming `value`
+      value: the object to store.
+    '''
+    if value is None:
+      self.delete(key)
+      return
+
+    serialized = self.serializer.dumps(value)
+    with self._lock:
+      self._append(key, serialized)
+      self._writable(key)[key] = value
+      self._maybe_snapshot()
+
+  def delete(self, key):
+    '''Removes the object named by `key`, in memory and the journal.
+
+    Args:
+      key: Key naming the object to remove.
+    '''
+    with self._lock:
+      if not self.contains(key):
+        return
+      self._append(key, None)
+      self._remove(key)
+      self._maybe_snapshot()
+
+
+  # snapshots
+
+  def snapshot(self, background=False):
+    '''Writes a snapshot of the dataset, and deletes the journals it
+    includes. Waits for any snapshot in progress first.
+
+    Args:
+      background: whether to return before the snapshot is written (see
+        ``wait_snapshot``).
+    '''
+    while True:
+      self.wait_snapshot() # outside the lock, so writers carry on meanwhile.
+      with self._lock:
+        if self._snapshot_thread is None: # else another started: wait again.
+          self._start_snapshot()
+          break
+
+    if not background:
+      self.wait_snapshot()
+
+  def _start_snapshot(self):
+    '''Starts a new journal, and writing the snapshot of everything before it
+    (the lock is held, and no snapshot is in progress).'''
+    self._sync_journal()
+    self._journal.close()
+    first = self._generation + 1
+    self._open_journal(first)
+
+    if self.fork:
+      pid = os.fork()
+      if pid == 0:
+        self._write_snapshot_child(self._items, first)
+      write = lambda: self._wait_child(pid)
+    else:
+      items = dict(self._items) # collections are copied on write meanwhile.
+      self._shared = set(items)
+      write = lambda: self._write_snapshot(items, first)
+
+    thread = threading.Thread(target=self._finish_snapshot,
+        args=(write, first))
+    thread.daemon = True
+    self._snapshot_thread = thread
+    thread.start()
+
+  def wait_snapshot(self):
+    '''Waits for a snapshot in progress (if any) to be written.'''
+    thread = self._snapshot_thread
+    if thread is not None:
+      thread.join()
+
+  def _finish_snapshot(self, write, first):
+    try:
+      write()
+      for generation in self._journals():
+        if generation < first:
+          os.remove(self.journal_path(generation))
+    finally:
+      self._shared = set()
+      self._snapshot_thread = None
+
+  def _write_snapshot_child(self, items, first):
+    '''Writes the snapshot and exits (in a forked child).'''
+    status = 1
+    try:
+      self._write_snapshot(items, first)
+      status = 0
+    finally:
+      os._exit(status)
+
+  def _wait_child(self, pid):
+    while True:
+      try:
+        _, status = os.waitpid(pid, 0)
+        break
+      except OSError, e:
+        if e.errno != errno.EINTR:
+          raise
+    if status != 0:
+      raise RuntimeError('snapshot child failed with status %d.' % status)
+
+  def _write_snapshot(self, items, first):
+    '''Writes the snapshot of `items` (collections), atomically.'''
+    path = self.snapshot_path()
+    tmp = path + '.tmp'
+    dumps = self.serializer.dumps
+    with open(tmp, 'wb', 1024 * 1024) as f:
+      f.write(snapshot_header.pack(snapshot_magic, first))
+      for objects in items.itervalues():
+        for key, value in objects.iteritems():
+          f.write(pack_record(str(key), dumps(value)))
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(tmp, path)
+    fsync_path(self.root_path)
+
+  def close(self):
+    '''Waits for any snapshot in progress, and fsyncs and closes the
+    journal.'''
+    self.wait_snapshot()
+    with self._lock:
+      if self._journal is not None:
+        self._sync_journal()
+        self._journal.close()
+        self._journal = None
@@ -0,0 +1,188 @@
+
+import os
+import time
+import shutil
+import unittest
+import threading
+
+from datastore.core.key import Key
+from datastore.core.query import Query
+from datastore.core.serialize import msgpack_serializer, pickle_serializer
+from datastore.core.test.test_basic import TestDatastore
+
+from . import PersistentDictDatastore, pack_record, scan_records
+
+
+class TestPersistentDictDatastore(TestDatastore):
+
+  tmp = os.path.normpath('/tmp/datastore.test.persistent')
+
+  def setUp(self):
+    if os.path.exists(self.tmp):
+      shutil.rmtree(self.tmp)
+
+  def tearDown(self):
+    if os.path.exists(self.tmp):
+      shutil.rmtree(self.tmp)
+
+  def test_datastore(self):
+    dirs = map(str, range(0, 3))
+    dirs = map(lambda d: os.path.join(self.tmp, d), dirs)
+    stores = [PersistentDictDatastore(dirs[0]),
+              PersistentDictDatastore(dirs[1], sync='always',
+                  snapshot_threshold=4096),
+              PersistentDictDatastore(dirs[2], sync='none', fork=False,
+                  snapshot_threshold=4096)]
+    self.subtest_simple(stores, numelems=200)
+    for ds in stores:
+      ds.close()
+
+  def test_records(self):
+    data = pack_record('/a', 'value') + pack_record('/b', None)
+    self.assertEqual([r[:2] for r in scan_records(data)],
+        [('/a', 'value'), ('/b', None)])
+    self.assertEqual([r[:2] for r in scan_records(data[:-1])],
+        [('/a', 'value')])
+    corrupt = data[:-2] + 'x' + data[-1:]
+    self.assertEqual(len(list(scan_records(corrupt))), 1)
+
+  def subtest_restart(self, **kwargs):
+    ds = PersistentDictDatastore(self.tmp, **kwargs)
+    for i in range(0, 100):
+      ds.put(Key('/a/b:%d' % i), {'value': i})
+    for i in range(0, 100, 2):
+      ds.delete(Key('/a/b:%d' % i))
+    ds.put(Key('/a/b:1'), {'value': 'changed'})
+    ds.close()
+
+    ds = PersistentDictDatastore(self.tmp, **kwargs)
+    self.assertEqual(len(ds), 50)
+    self.assertEqual(ds.get(Key('/a/b:1')), {'value': 'changed'})
+    self.assertEqual(ds.get(Key('/a/b:2')), None)
+    self.assertEqual(ds.get(Key('/a/b:3')), {'value': 3})
+    self.assertEqual(len(list(ds.query(Query(Key('/a/b'))))), 50)
+    return ds
+
+  def test_journal_replay(self):
+    ds = self.subtest_restart(snapshot_threshold=0)
+    self.assertFalse(os.path.exists(ds.snapshot_path()))
+    ds.close()
+
+    # a record torn by a crash is ignored.
+    ds = PersistentDictDatastore(self.tmp)
+    ds.put(Key('/a/b:3'), {'value': 'torn'})
+    ds.close()
+    path = ds.journal_path(ds._generation)
+    with open(path, 'r+b') as f:
+      f.truncate(os.path.getsize(path) - 1)
+    ds = PersistentDictDatastore(self.tmp)
+    self.assertEqual(ds.get(Key('/a/b:3')), {'value': 3})
+    ds.close()
+
+  def test_snapshots(self):
+    serializer = msgpack_serializer
+    if not msgpack_serializer.available:
+      serializer = pickle_serializer
+
+    for fork in [True, False]:
+      if os.path.exists(self.tmp):
+        shutil.rmtree(self.tmp)
+
+      ds = self.subtest_restart(fork=fork, snapshot_threshold=1024,
+          serializer=serializer)
+      self.assertTrue(os.path.exists(ds.snapshot_path()))
+      self.assertTrue(len(ds._journals()) < 4)
+
+      ds.snapshot()
+      self.assertEqual(ds._journals(), [ds._generation])
+      ds.put(Key('/a/b:5'), {'value': 'after'})
+      ds.close()
+
+      ds = PersistentDictDatastore(self.tmp, serializer=serializer)
+      self.assertEqual(len(ds), 50)
+      self.assertEqual(ds.get(Key('/a/b:5')), {'value': 'after'})
+      ds.close()
+
+    self.assertRaises(ValueError, PersistentDictDatastore, self.tmp,
+        sync='sometimes')
+
+  def test_concurrent_snapshots(self):
+    ds = PersistentDictDatastore(self.tmp, snapshot_threshold=256)
+    def write(n):
+      for i in range(0, 200):
+        ds.put(Key('/a/b:%d' % (i % 50)), {'value': n})
+        if i % 20 == 0:
+          ds.snapshot(background=bool(i % 40))
+    threads = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    ds.close()
+
+    self.assertFalse(os.path.exists(ds.snapshot_path() + '.tmp'))
+    stored = dict((k, ds.get(k)) for k in (Key('/a/b:%d' % i)
+        for i in range(0, 50)))
+    ds = PersistentDictDatastore(self.tmp)
+    self.assertEqual(dict((k, ds.get(k)) for k in stored), stored)
+    ds.close()
+
+  def test_copy_on_write_snapshots(self):
+    ds = PersistentDictDatastore(self.tmp, snapshot_threshold=0)
+    for i in range(0, 10):
+      ds.put(Key('/a/b:%d' % i), i)
+    ds.put(Key('/c/d:0'), 0)
+
+    # writers carry on while a snapshot is written, without changing it.
+    started, release, snapshots = threading.Event(), threading.Event(), []
+    write_snapshot = ds._write_snapshot
+    def blocked(items, first):
+      snapshots.append(dict((c, dict(o)) for c, o in items.items()))
+      started.set()
+      release.wait()
+      snapshots.append(dict((c, dict(o)) for c, o in items.items()))
+      write_snapshot(items, first)
+    ds._write_snapshot = blocked
+
+    ds.snapshot(background=True)
+    started.wait()
+    ds.put(Key('/a/b:0'), 'changed')
+    ds.delete(Key('/c/d:0'))
+    ds.put(Key('/e/f:0'), 'new')
+    self.assertEqual(ds.get(Key('/a/b:0')), 'changed')
+    release.set()
+    ds.wait_snapshot()
+    self.assertEqual(snapshots[0], snapshots[1])
+    self.assertEqual(ds._shared, set())
+    ds.close()
+
+    ds = PersistentDictDatastore(self.tmp)
+    self.assertEqual(ds.get(Key('/a/b:0')), 'changed')
+    self.assertEqual(ds.get(Key('/a/b:9')), 9)
+    self.assertEqual(ds.get(Key('/c/d:0')), None)
+    self.assertEqual(ds.get(Key('/e/f:0')), 'new')
+    ds.close()
+
+  def test_interval_sync(self):
+    ds = PersistentDictDatastore(self.tmp, sync_interval=0.05)
+    ds.put(Key('/a'), 'a')
+    self.assertTrue(ds._sync_timer is not None)
+    synced_at = ds._synced_at
+    time.sleep(0.2) # no further writes: the timer fsyncs.
+    self.assertTrue(ds._synced_at > synced_at)
+    self.assertTrue(ds._sync_timer is None)
+    ds.close()
+
+  def test_empty_snapshot(self):
+    ds = PersistentDictDatastore(self.tmp)
+    ds.put(Key('/a'), 'a')
+    ds.close()
+    open(ds.snapshot_path(), 'wb').close()
+
+    ds = PersistentDictDatastore(self.tmp)
+    self.assertEqual(ds.get(Key('/a')), 'a')
+    ds.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,337 @@
+
+__version__ = '1.0'
+__doc__ = '''
+sqlite datastore implementation, using the standard library sqlite3 module.
+
+Queries are translated into SQL. See SqliteDatastore.
+
+'''
+
+import re
+import json
+import sqlite3
+import threading
+
+import datastore.core
+from datastore.core.query import Cursor, Query
+
+
+identifier = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+'''Pattern of table and field names that are safe to embed in SQL.'''
+
+sql_operators = {
+  '<' : '<',
+  '<=': '<=',
+  '=' : '=',
+  '!=': '!=',
+  '>=': '>=',
+  '>' : '>',
+}
+
+sql_types = {
+  int    : 'integer',
+  long   : 'integer',
+  float  : 'real',
+  str    : 'text',
+  unicode: 'text',
+}
+'''Types of filter values that compare the same in sqlite and python, and the
+sqlite type (as ``typeof`` names it) of the values they compare with.'''
+
+
+
+class SqliteDatastore(datastore.Datastore):
+  '''Datastore backed by a single sqlite database.
+
+  All objects live in one table, with an indexed ``path`` column holding the
+  collection (``key.path``) of each key. Values are stored as JSON, so -- unlike
+  most on-disk datastores -- SqliteDatastore stores objects, not strings, and
+  needs no SerializerShimDatastore on top.
+
+  Queries are pushed down to sqlite rather than applied naively: filters and
+  orders on top-level fields become ``json_extract`` expressions, and limit and
+  offset become ``LIMIT`` and ``OFFSET``. Fields listed in `indexed_fields` get
+  an expression index, so ordering on them does not sort the whole collection.
+  Whatever cannot be translated (custom ``object_getattr`` functions, nested
+  field names, or sqlite builds without JSON support) is applied naively on
+  the results instead.
+
+  Filters convert stored values to the type of the filter value before
+  comparing (see Filter), which sqlite does not. So sqlite only decides for
+  stored values of the matching type; the others are passed through, and
+  every filter is applied again to the rows returned. With filters, limit and
+  offset are then applied to those rows, rather than by sqlite.
+
+  The database runs in WAL mode, so readers do not block the writer.
+
+  Hello World:
+
+      >>> import datastore.sqlite
+      >>>
+      >>> ds = datastore.sqlite.SqliteDatastore('/tmp/.test_sqlite.db')
+      >>>
+      >>> hello = datastore.Key('hello')
+      >>> ds.put(hello, 'world')
+      >>> ds.contains(hello)
+      True
+      >>> ds.get(hello)
+      u'world'
+      >>> ds.delete(hello)
+      >>> ds.get(hello)
+      None
+
+  '''
+
+  fetch_size = 256
+  '''Number of rows fetched from sqlite at a time while iterating a query.'''
+
+  def __init__(self, path, table='datastore', indexed_fields=(),
+               synchronous='NORMAL'):
+    '''Initialize the datastore with the database at `path`.
+
+    Args:
+      path: path of the sqlite database file (or ':memory:').
+
+      table: name of the table to store objects in.
+
+      indexed_fields: names of top-level value fields to index.
+
+      synchronous: the sqlite ``synchronous`` pragma. NORMAL is durable in WAL
+          mode except against power loss; FULL also survives that.
+    '''
+    if not identifier.match(table):
+      raise ValueError('table name %r is not a valid identifier.' % table)
+
+    self.path = path
+    self.table = table
+    self._lock = threading.RLock()
+
+    # autocommit mode: transactions are explicit (see put_many).
+    self._conn = sqlite3.connect(path, isolation_level=None,
+        check_same_thread=False)
+    self._conn.execute('PRAGMA journal_mode=WAL')
+    self._conn.execute('PRAGMA synchronous=%s' % synchronous)
+
+    self._conn.execute('CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, '
+        'path TEXT NOT NULL, value TEXT NOT NULL)' % table)
+    self._conn.execute('CREATE INDEX IF NOT EXISTS %s_path ON %s (path, key)'
+        % (table, table))
+
+    self.supports_json = self._supports_json()
+    for field in indexed_fields:
+      self.create_index(field)
+
+    # constant statements, so sqlite3's statement cache can reuse them.
+    self._sql_get = 'SELECT value FROM %s WHERE key = ?' % table
+    self._sql_put = 'INSERT OR REPLACE INTO %s (key, path, value) ' \
+        'VALUES (?, ?, ?)' % table
+    self._sql_delete = 'DELETE FROM %s WHERE key = ?' % table
+    self._sql_contains = 'SELECT 1 FROM %s WHERE key = ?' % table
+
+  def _supports_json(self):
+    '''Returns whether this sqlite build has the JSON functions.'''
+    try:
+      self._conn.execute('SELECT json_extract(\'{"a": 1}\', \'$.a\')')
+      return True
+    except sqlite3.OperationalError:
+      return False
+
+  def create_index(self, field):
+    '''Creates an index on the top-level value `field` within collections.'''
+    if not self.supports_json:
+      errstr = 'sqlite %s lacks JSON support.'
+      raise RuntimeError(errstr % sqlite3.sqlite_version)
+    if not identifier.match(field):
+      raise ValueError('field name %r is not a valid identifier.' % field)
+
+    with self._lock:
+      self._conn.execute('CREATE INDEX IF NOT EXISTS %s_field_%s ON %s '
+          '(path, %s)' % (self.table, field, self.table, self._extract(field)))
+
+  @staticmethod
+  def _extract(field):
+    '''Returns the SQL expression extracting `field` from values.'''
+    return "json_extract(value, '$.%s')" % field
+
+  def close(self):
+    '''Closes the database connection.'''
+    with self._lock:
+      self._conn.close()
+
+
+  # Datastore implementation
+
+  def get(self, key):
+    '''Return the object named by key or None if it does not exist.
+
+    Args:
+      key: Key naming the object to retrieve
+
+    Returns:
+      object or None
+    '''
+    with self._lock:
+      row = self._conn.execute(self._sql_get, (str(key),)).fetchone()
+    return json.loads(row[0]) if row else None
+
+  def put(self, key, value):
+    '''Stores the object `value` named by `key`.
+
+    Args:
+      key: Key naming `value`
+      value: the object to store (must be JSON serializable).
+    '''
+    if value is None:
+      self.delete(key)
+      return
+
+    row = (str(key), str(key.path), json.dumps(value))
+    with self._lock:
+      self._conn.execute(self._sql_put, row)
+
+  def put_many(self, items):
+    '''Stores every (key, value) pair in `items`, in a single transaction.
+
+    Args:
+      items: iterable of (Key, object) pairs.
+    '''
+    items = list(items)
+    rows = [(str(key), str(key.path), json.dumps(value))
+        for key, value in items if value is not None]
+    deletes = [(str(key),) for key, value in items if value is None]
+
+    with self._lock:
+      self._conn.execute('BEGIN')
+      try:
+        self._conn.executemany(self._sql_put, rows)
+        self._conn.executemany(self._sql_delete, deletes)
+      except:
+        self._conn.execute('ROLLBACK')
+        raise
+      self._conn.execute('COMMIT')
+
+  def delete(self, key):
+    '''Removes the object named by `key`.
+
+    Args:
+      key: Key naming the object to remove.
+    '''
+    with self._lock:
+      self._conn.execute(self._sql_delete, (str(key),))
+
+  def contains(self, key):
+    '''Returns whether the object named by `key` exists.
+
+    Args:
+      key: Key naming the object to check.
+
+    Returns:
+      boalean whether the object exists
+    '''
+    with self._lock:
+      return self._conn.execute(self._sql_contains,
+          (str(key),)).fetchone() is not None
+
+  def __len__(self):
+    with self._lock:
+      return self._conn.execute('SELECT COUNT(*) FROM %s'
+          % self.table).fetchone()[0]
+
+
+  # queries
+
+  def _translatable_filter(self, query, filter):
+    '''Returns whether `filter` of `query` can be translated to SQL.'''
+    return self.supports_json \
+       and query.object_getattr is Query.object_getattr \
+       and identifier.match(filter.field) is not None \
+       and type(filter.value) in sql_types
+
+  def _translatable_order(self, query, order):
+    '''Returns whether `order` of `query` can be translated to SQL.'''
+    return self.supports_json \
+       and query.object_getattr is Query.object_getattr \
+       and identifier.match(order.field) is not None
+
+  def _sql_where(self, query, filters):
+    '''Returns the WHERE clause (and its parameters) for `query`. Rows whose
+    field has another type than the filter value pass (see class docs).'''
+    where = ['path = ?']
+    params = [str(query.key)]
+    for filter in filters:
+      field = self._extract(filter.field)
+      where.append('(typeof(%s) != ? OR %s %s ?)' % (field, field,
+          sql_operators[filter.op]))
+      params.extend([sql_types[type(filter.value)], filter.value])
+    return ' AND '.join(where), params
+
+  def query(self, query):
+    '''Returns an iterable of objects matching criteria expressed in `query`
+    Translates the query into SQL, falling back to applying the parts that
+    cannot be translated naively.
+
+    Args:
+      query: Query object describing the objects to return.
+
+    Raturns:
+      Cursor with all objects matching criteria
+    '''
+    pushed = [f for f in query.filters if self._translatable_filter(query, f)]
+    naive = [f for f in query.filters if f not in pushed]
+    orders_pushed = not naive and all(self._translatable_order(query, o)
+        for o in query.orders)
+
+    where, params = self._sql_where(query, pushed)
+    sql = 'SELECT value FROM %s WHERE %s' % (self.table, where)
+
+    if not orders_pushed:
+      sql += ' ORDER BY key'
+      return query(self._value_gen(sql, params))
+
+    orders = ['%s %s' % (self._extract(o.field),
+        'ASC' if o.isAscending() else 'DESC') for o in query.orders]
+    sql += ' ORDER BY %s' % ', '.join(orders + ['key'])
+
+    if query.filters:
+      # rows are filtered again here, so limit and offset must follow.
+      cursor = Cursor(query, self._value_gen(sql, params))
+      cursor.apply_filter()
+      cursor.apply_offset()
+      cursor.apply_limit()
+      return cursor
+
+    if query.limit is None and not query.offset:
+      return Cursor(query, self._value_gen(sql, params))
+
+    sql += ' LIMIT ? OFFSET ?'
+    limit = -1 if query.limit is None else query.limit
+    skipped = lambda count: setattr(cursor, 'skipped', count)
+    cursor = Cursor(query, self._value_gen(sql, params + [limit,
+        query.offset], query.offset, skipped, where, params))
+    return cursor
+
+  def _value_gen(self, sql, params, offset=0, skipped=None, where=None,
+                 where_params=()):
+    '''Generator that fetches the results of `sql` in batches.
+
+    If `sql` has an `offset` pushed down, it also reports the number of rows
+    skipped, which sqlite does not, by calling `skipped` with it.
+    '''
+    with self._lock:
+      results = self._conn.execute(sql, params)
+      rows = results.fetchmany(self.fetch_size)
+
+    if rows and offset:
+      skipped(offset) # if anything is left, offset rows were skipped.
+    elif offset:
+      with self._lock:
+        count = self._conn.execute('SELECT COUNT(*) FROM %s WHERE %s'
+            % (self.table, where), where_params).fetchone()[0]
+      skipped(min(count, offset))
+
+    while rows:
+      for row in rows:
+        yield json.loads(row[0])
+
+      with self._lock:
+        rows = results.fetchmany(self.fetch_size)
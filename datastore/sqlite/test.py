@@ -0,0 +1,110 @@
+
+import os
+import shutil
+import unittest
+
+from datastore.core.key import Key
+from datastore.core.basic import DictDatastore
+from datastore.core.query import Query
+from datastore.core.test.test_basic import TestDatastore
+
+from . import SqliteDatastore
+
+
+class TestSqliteDatastore(TestDatastore):
+
+  tmp = os.path.normpath('/tmp/datastore.test.sqlite')
+
+  def setUp(self):
+    if os.path.exists(self.tmp):
+      shutil.rmtree(self.tmp)
+    os.makedirs(self.tmp)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def test_datastore(self):
+    s1 = SqliteDatastore(os.path.join(self.tmp, 'a.db'))
+    s2 = SqliteDatastore(os.path.join(self.tmp, 'b.db'), table='objects')
+    s3 = SqliteDatastore(':memory:')
+    self.subtest_simple([s1, s2, s3], numelems=500)
+
+  def subtest_queries(self, ds):
+    pkey = Key('/people')
+    people = [{'name': 'person%02d' % i, 'age': i % 30, 'kind': 'p'}
+        for i in range(0, 60)]
+    ds.put_many((pkey.child(p['name']), p) for p in people)
+    ds.put(Key('/other/x'), {'age': 5})
+
+    def check(query, expected, skipped=None):
+      cursor = ds.query(query)
+      result = list(cursor)
+      self.assertEqual(result, expected)
+      self.assertEqual(cursor.returned, len(expected))
+      if skipped is not None:
+        self.assertEqual(cursor.skipped, skipped)
+
+    by_name = sorted(people, key=lambda p: p['name'])
+    check(Query(pkey), by_name)
+
+    young = [p for p in by_name if p['age'] < 10]
+    check(Query(pkey).filter('age', '<', 10), young)
+    check(Query(pkey).filter('age', '<', 10).filter('name', '!=',
+        'person01'), [p for p in young if p['name'] != 'person01'])
+
+    ordered = sorted(people, key=lambda p: (-p['age'], p['name']))
+    check(Query(pkey).order('-age'), ordered)
+    check(Query(pkey, limit=5, offset=3).order('-age'), ordered[3:8], 3)
+    check(Query(pkey, offset=100).order('-age'), [], 60)
+
+    # untranslatable parts are applied naively.
+    check(Query(pkey).filter('age', '=', True),
+        [p for p in by_name if p['age']])
+    getattr_query = Query(pkey, object_getattr=lambda o, f: o[f])
+    check(getattr_query.filter('age', '<', 10), young)
+
+    ds.put_many([(pkey.child(p['name']), None) for p in people])
+    check(Query(pkey), [])
+
+  def test_queries(self):
+    self.subtest_queries(SqliteDatastore(':memory:'))
+    self.subtest_queries(SqliteDatastore(':memory:', indexed_fields=['age']))
+
+    ds = SqliteDatastore(':memory:')
+    ds.supports_json = False
+    self.subtest_queries(ds)
+
+  def test_filters_match_dict(self):
+    # filters convert stored values to the filter value's type: sqlite
+    # results must match those of a DictDatastore.
+    values = [{'id': 1, 'age': 5}, {'id': 2, 'age': '7'}, {'id': 3, 'age': 12},
+        {'id': 4, 'age': 5.5}, {'id': 5, 'age': '12'}, {'id': 6, 'age': 30}]
+    stores = [DictDatastore(), SqliteDatastore(':memory:'),
+        SqliteDatastore(':memory:', indexed_fields=['age'])]
+    for ds in stores:
+      for value in values:
+        ds.put(Key('/people/%d' % value['id']), value)
+
+    queries = [
+      lambda: Query(Key('/people')).filter('age', '<', 10),
+      lambda: Query(Key('/people')).filter('age', '=', '5'),
+      lambda: Query(Key('/people')).filter('age', '>=', 7.0),
+      lambda: Query(Key('/people')).filter('age', '!=', 5),
+      lambda: Query(Key('/people')).filter('age', '>', '2'),
+      lambda: Query(Key('/people'), limit=2).filter('age', '<', 10)
+          .order('id'),
+      lambda: Query(Key('/people'), offset=1).filter('age', '<', 13)
+          .order('-id'),
+    ]
+    for query in queries:
+      expected = list(stores[0].query(query()))
+      for ds in stores[1:]:
+        results = list(ds.query(query()))
+        if query().orders:
+          self.assertEqual(results, expected)
+        else:
+          self.assertEqual(sorted(results), sorted(expected))
+
+
+if __name__ == '__main__':
+  unittest.main()